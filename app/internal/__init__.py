@@ -1,10 +1,13 @@
 import os
 
-from app.internal.exception import exception_handler, http_exception_handler
+from app.internal.exception import exception_handler, http_exception_handler, unavailable_handler, deadline_handler
 from app.internal.config import get_config
 from app.internal.logging import logger
-from app.internal.dify import DifyClient, CompletionClient, ChatClient
+from app.internal.dify import DifyClient, CompletionClient, ChatClient, WorkflowClient
 
 ALLOWED_ORIGINS = os.environ.get("ALLOWED_ORIGINS", "http://localhost:3000")
 
-__all__ = ["get_config", "logger", "ALLOWED_ORIGINS", "exception_handler", "http_exception_handler"]
+__all__ = [
+    "get_config", "logger", "ALLOWED_ORIGINS", "exception_handler", "http_exception_handler", "unavailable_handler",
+    "deadline_handler"
+]
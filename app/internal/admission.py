@@ -0,0 +1,329 @@
+import asyncio
+import itertools
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from fastapi import Request
+from app.internal import deadline
+from app.internal.config import get_config, AdmissionConfig
+from app.internal.dify.errors import UpstreamUnavailableError, DeadlineExceededError
+from app.internal.logging import logger
+from app.internal.metrics import registry
+
+admission_wait = registry.histogram("admission_wait_seconds",
+                                    "Time requests spent queued before being admitted", ("client", "class"),
+                                    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+admission_rejected = registry.counter("admission_rejected_total", "Requests turned away by admission",
+                                      ("client", "reason"))
+
+
+class TokenBucket:
+    """``rate`` tokens per second, holding at most ``burst``; starts full."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated_at:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def ready_in(self, now: float, cost: float = 1) -> float:
+        """Seconds until ``cost`` tokens are available, 0 when they already are."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return max(cost - self.tokens, 0) / self.rate
+
+    def take(self, cost: float = 1):
+        if self.rate > 0:
+            self.tokens -= cost
+
+
+@dataclass(order=True)
+class _Waiter:
+    finish: float
+    seq: int
+    start: float = field(compare=False)
+    user: str = field(compare=False)
+    request_class: str = field(compare=False)
+    cost: float = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class AdmissionScheduler:
+    """
+    Admission of one client name's requests to upstream.
+
+    A request is admitted once both its user's bucket and the client's bucket hold a token. Otherwise it waits in a
+    queue bounded by ``max_queue`` for at most ``max_wait`` seconds, and is rejected with a 503 past either bound.
+
+    Waiting requests are served in weighted fair order: each user's requests get virtual finish tags spaced by
+    ``cost / weight`` of their request class, and the waiter with the smallest tag whose user bucket is ready goes
+    first. A user sending many bulk requests therefore only delays their own backlog, and an interactive request
+    (higher weight) from another user overtakes it.
+    """
+
+    def __init__(self, name: str, config: AdmissionConfig):
+        self.name = name
+        self.config = config
+        self.client_bucket = TokenBucket(config.client_rate, config.client_burst)
+        self.user_buckets: dict[str, TokenBucket] = {}
+        self._queue: list[_Waiter] = []
+        self._last_finish: dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _user_bucket(self, user: str) -> TokenBucket:
+        bucket = self.user_buckets.get(user)
+        if bucket is None:
+            if len(self.user_buckets) >= self.config.max_users:
+                self._forget_idle_users()
+            bucket = self.user_buckets[user] = TokenBucket(self.config.user_rate, self.config.user_burst)
+        return bucket
+
+    def _forget_idle_users(self):
+        # 已经回满的桶和新建的没有区别，可以直接丢掉
+        now = time.monotonic()
+        for user, bucket in list(self.user_buckets.items()):
+            if bucket.ready_in(now, bucket.burst) == 0:
+                del self.user_buckets[user]
+
+    def _ready_in(self, user: str, cost: float, now: float) -> float:
+        return max(self._user_bucket(user).ready_in(now, cost), self.client_bucket.ready_in(now, cost))
+
+    def _grant(self, user: str, cost: float):
+        self._user_bucket(user).take(cost)
+        self.client_bucket.take(cost)
+        self.admitted += 1
+
+    async def admit(self, user: str, request_class: str = "bulk", cost: float = 1):
+        now = time.monotonic()
+        if not self._queue and self._ready_in(user, cost, now) == 0:
+            self._grant(user, cost)
+            admission_wait.observe(self.name, request_class, value=0)
+            return
+        if len(self._queue) >= self.config.max_queue:
+            self.rejected += 1
+            admission_rejected.inc(self.name, "queue_full")
+            raise UpstreamUnavailableError(f"{self.name} admission queue is full", retry_after=1)
+
+        weight = self.config.weights.get(request_class, 1)
+        start = max(self._virtual_time, self._last_finish.get(user, 0.0))
+        waiter = _Waiter(start + cost / weight, next(self._seq), start, user, request_class, cost, now,
+                         asyncio.get_running_loop().create_future())
+        self._last_finish[user] = waiter.finish
+        self._queue.append(waiter)
+        self.queued += 1
+        self._wakeup.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+        max_wait = deadline.clamp(self.config.max_wait)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), max_wait)
+        except asyncio.TimeoutError:
+            # 超时的同时恰好被放行，就按放行处理
+            if self._remove(waiter):
+                self.timed_out += 1
+                if max_wait < self.config.max_wait:
+                    admission_rejected.inc(self.name, "deadline")
+                    raise DeadlineExceededError(f"{self.name} admission waited until the request deadline")
+                admission_rejected.inc(self.name, "timeout")
+                raise UpstreamUnavailableError(f"{self.name} admission timed out after {self.config.max_wait}s",
+                                               retry_after=self.config.max_wait)
+        except asyncio.CancelledError:
+            # 客户端断开时把名额让给后面的请求
+            if not self._remove(waiter):
+                self._refund(waiter)
+            raise
+        waited = time.monotonic() - waiter.enqueued_at
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        admission_wait.observe(self.name, request_class, value=waited)
+
+    def _remove(self, waiter: _Waiter) -> bool:
+        if waiter.future.done():
+            return False
+        waiter.future.cancel()
+        self._queue.remove(waiter)
+        return True
+
+    def _refund(self, waiter: _Waiter):
+        self._user_bucket(waiter.user).tokens += waiter.cost
+        self.client_bucket.tokens += waiter.cost
+
+    async def _dispatch(self):
+        while self._queue:
+            self._wakeup.clear()
+            now = time.monotonic()
+            next_ready = None
+            # 队列不长，每次按虚拟完成时间排序即可
+            for waiter in sorted(self._queue):
+                ready_in = self._ready_in(waiter.user, waiter.cost, now)
+                if ready_in == 0:
+                    self._queue.remove(waiter)
+                    self._virtual_time = max(self._virtual_time, waiter.start)
+                    self._grant(waiter.user, waiter.cost)
+                    waiter.future.set_result(None)
+                    break
+                next_ready = ready_in if next_ready is None else min(next_ready, ready_in)
+            else:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), next_ready)
+                except asyncio.TimeoutError:
+                    pass
+        if not self._queue:
+            # 队列清空后虚拟时间归零，避免浮点数无限增长
+            self._virtual_time = 0.0
+            self._last_finish.clear()
+
+    def stats(self) -> dict:
+        waiting: dict[str, int] = {}
+        for waiter in self._queue:
+            waiting[waiter.user] = waiting.get(waiter.user, 0) + 1
+        now = time.monotonic()
+        return {
+            "queue_depth": len(self._queue),
+            "max_queue": self.config.max_queue,
+            "oldest_wait": max((now - waiter.enqueued_at for waiter in self._queue), default=0.0),
+            "waiting_by_user": waiting,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_avg": self.wait_total / self.queued if self.queued else 0.0,
+            "wait_max": self.wait_max,
+            "client_tokens": self.client_bucket.tokens,
+        }
+
+
+_schedulers: dict[str, AdmissionScheduler] = {}
+_warned_untrusted_proxy = False
+
+registry.gauge("admission_queue_depth",
+               "Requests waiting for admission", ("client", ),
+               collect=lambda: {
+                   (name, ): len(scheduler._queue)
+                   for name, scheduler in _schedulers.items()
+               })
+
+
+def get_scheduler(name: str) -> AdmissionScheduler:
+    scheduler = _schedulers.get(name)
+    config = get_config().admission
+    if scheduler is None or scheduler.config != config:
+        # 配置重新加载后换成新的调度器，排队中的请求仍由旧调度器放行
+        scheduler = _schedulers[name] = AdmissionScheduler(name, config)
+    return scheduler
+
+
+def admission_stats() -> dict:
+    return {name: scheduler.stats() for name, scheduler in _schedulers.items()}
+
+
+def request_user(request: Request) -> str:
+    """
+    The identity a request is admitted as: the user an authentication layer in front of the routes put on
+    ``request.state.user``, or else the peer address. ``X-Forwarded-For`` is only read when the peer is one of
+    ``trusted_proxies``, and then only its last hop, the one that proxy added.
+
+    Behind a reverse proxy without an authentication layer ``trusted_proxies`` must list the proxy, otherwise every
+    user is the proxy's address and shares its one bucket; a warning is logged once when that seems to be the case.
+    """
+    global _warned_untrusted_proxy
+    user = getattr(request.state, "user", None)
+    if user:
+        return str(user)
+    peer = request.client.host if request.client else None
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded:
+        if peer in get_config().admission.trusted_proxies:
+            return forwarded.split(",")[-1].strip()
+        if not _warned_untrusted_proxy:
+            _warned_untrusted_proxy = True
+            logger.warning(f"X-Forwarded-For from {peer}, which is not in admission.trusted_proxies; "
+                           f"all users behind it share one admission bucket")
+    return peer or "anonymous"
+
+
+def request_class(request: Request, declared: str | None = None) -> str:
+    """
+    The class a request is queued as: the one its route declares, by default the lowest weighted class. The
+    ``X-Request-Class`` header can only pick a class weighted no higher, so a caller may volunteer as bulk but cannot
+    claim a bigger share.
+    """
+    weights = get_config().admission.weights
+    if declared is None:
+        declared = min(weights, key=weights.get) if weights else "bulk"
+    asked = request.headers.get("x-request-class")
+    if asked in weights and weights[asked] <= weights.get(declared, 1):
+        return asked
+    return declared
+
+
+async def admit(request: Request, name: str, declared: str | None = None):
+    """Admit ``request`` for client ``name``, for routes that first answer what they can without upstream."""
+    if not get_config().admission.enabled:
+        return
+    await get_scheduler(name).admit(request_user(request), request_class(request, declared))
+
+
+def admission(name: str, declared: str | None = None):
+    """
+    FastAPI dependency admitting a request for client ``name`` before the route calls upstream.
+
+    :param declared: request class of the route, see ``request_class``
+    """
+
+    async def dependency(request: Request):
+        await admit(request, name, declared)
+
+    return dependency
+
+
+@dataclass
+class _Deferred:
+    request: Request
+    name: str
+    declared: str | None
+    admitted: bool = False
+
+
+# 推迟到第一次真正调用上游时才准入的请求
+_deferred: ContextVar[_Deferred | None] = ContextVar("deferred_admission", default=None)
+
+
+def admission_on_miss(name: str, declared: str | None = None):
+    """
+    FastAPI dependency like ``admission`` for routes whose reads are mostly answered by the response cache: the
+    request is admitted by ``admit_deferred`` when the client is about to call upstream, so cache hits cost no tokens
+    and never queue.
+    """
+
+    async def dependency(request: Request):
+        # 请求在自己的任务里处理，设置后对路由函数及其调用的客户端都可见
+        _deferred.set(_Deferred(request, name, declared))
+
+    return dependency
+
+
+async def admit_deferred():
+    """Admit the request of ``admission_on_miss``, once, before its first upstream call; nothing for other requests."""
+    pending = _deferred.get()
+    if pending is None or pending.admitted:
+        return
+    pending.admitted = True
+    await admit(pending.request, pending.name, pending.declared)
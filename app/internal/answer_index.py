@@ -0,0 +1,330 @@
+import asyncio
+import gzip
+import json
+import math
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass, asdict
+from app.internal.config import get_config
+from app.internal.logging import logger
+from app.internal.metrics import registry
+from app.internal.shared_log import SharedLog
+from app.internal.dify.answer_cache import normalize_query
+
+# 连续的字母数字算一个词，中日韩文字按字切分后取相邻二元组
+_WORD = re.compile(r"[^\W_]+")
+_CJK = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Case, punctuation and word order insensitive terms of ``text``."""
+    tokens = []
+    for word in _WORD.findall(normalize_query(text)):
+        start = 0
+        for run in _CJK.finditer(word):
+            if run.start() > start:
+                tokens.append(word[start:run.start()])
+            chars = run.group()
+            tokens.extend([chars] if len(chars) == 1 else [chars[i:i + 2] for i in range(len(chars) - 1)])
+            start = run.end()
+        if start < len(word):
+            tokens.append(word[start:])
+    return tokens
+
+
+@dataclass
+class AnsweredQuery:
+    query: str
+    mode: str
+    # 回答在 answer_cache 中的 key
+    answer_key: str
+    preview: str
+    answered_at: float
+
+
+class AnswerIndex:
+    """
+    BM25 index over the queries of completed glossary answers.
+
+    Each normalized (query, mode) is one document; asking it again replaces it. Only the documents are persisted,
+    as gzipped JSON lines, and the postings are rebuilt from them on load, which for short queries takes a fraction
+    of a second even at ``max_documents``. The oldest documents are dropped past ``max_documents``.
+
+    The file is a ``SharedLog``: every worker appends the documents it added and picks up those the other workers
+    appended, so all of them end up with the same index and none loses the others' documents. Once the file holds
+    twice ``max_documents`` records it is compacted to the latest version of each document.
+
+    ``similarity`` in search results is the overlap of the query's terms with the document's (Dice coefficient,
+    0 to 1), which, unlike the BM25 score, can be compared against a fixed threshold.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, path: str, max_documents: int):
+        self.path = path
+        self.max_documents = max_documents
+        self.documents: dict[int, AnsweredQuery] = {}
+        self.terms: dict[int, Counter] = {}
+        self.lengths: dict[int, int] = {}
+        self.postings: dict[str, dict[int, int]] = {}
+        self.ids: dict[tuple[str, str], int] = {}
+        self.total_length = 0
+        self.next_id = 0
+        self.searches = 0
+        self.log = SharedLog(path)
+        # 本 worker 新加入、还没写入文件的文档
+        self.unsaved: list[AnsweredQuery] = []
+        # 文件中的记录数，包含已被替换的旧版本
+        self.logged = 0
+
+    def add(self, document: AnsweredQuery, save: bool = True):
+        key = (normalize_query(document.query), document.mode)
+        if not save:
+            # 从文件读到的旧版本、自己写入的同一份，或者比索引中最旧的还旧、加入后马上会被淘汰的文档
+            if key in self.ids and self.documents[self.ids[key]].answered_at >= document.answered_at:
+                return
+            if (key not in self.ids and len(self.documents) >= self.max_documents
+                    and next(iter(self.documents.values())).answered_at >= document.answered_at):
+                return
+        if key in self.ids:
+            self.remove(self.ids[key])
+        terms = Counter(tokenize(document.query))
+        if not terms:
+            return
+        doc_id = self.next_id
+        self.next_id += 1
+        self.documents[doc_id] = document
+        self.terms[doc_id] = terms
+        self.ids[key] = doc_id
+        self.lengths[doc_id] = sum(terms.values())
+        self.total_length += self.lengths[doc_id]
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[doc_id] = count
+        # 文档按加入顺序编号，dict 的第一个就是最旧的
+        while len(self.documents) > self.max_documents:
+            self.remove(next(iter(self.documents)))
+        if save:
+            self.unsaved.append(document)
+
+    def remove(self, doc_id: int):
+        document = self.documents.pop(doc_id)
+        terms = self.terms.pop(doc_id)
+        self.ids.pop((normalize_query(document.query), document.mode), None)
+        self.total_length -= self.lengths.pop(doc_id)
+        for term in terms:
+            posting = self.postings[term]
+            del posting[doc_id]
+            if not posting:
+                del self.postings[term]
+
+    def search(self, query: str, k: int = 5, mode: str | None = None) -> list[dict]:
+        self.searches += 1
+        terms = Counter(tokenize(query))
+        if not terms or not self.documents:
+            return []
+        count = len(self.documents)
+        average_length = self.total_length / count
+        scores: dict[int, float] = {}
+        for term in terms:
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, frequency in posting.items():
+                norm = frequency + self.K1 * (1 - self.B + self.B * self.lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.K1 + 1) / norm
+        if mode is not None:
+            scores = {doc_id: score for doc_id, score in scores.items() if self.documents[doc_id].mode == mode}
+        size = sum(terms.values())
+        results = []
+        for doc_id in sorted(scores, key=scores.get, reverse=True)[:k]:
+            overlap = sum((terms & self.terms[doc_id]).values())
+            results.append({
+                **asdict(self.documents[doc_id]),
+                "score": scores[doc_id],
+                "similarity": 2 * overlap / (size + self.lengths[doc_id]),
+            })
+        return results
+
+    def take_unsaved(self) -> list[AnsweredQuery]:
+        """The documents to ``save``, taken on the event loop so saving can run in a thread."""
+        unsaved, self.unsaved = self.unsaved, []
+        return unsaved
+
+    def save(self, documents: list[AnsweredQuery]):
+        if documents:
+            self.log.append(gzip.compress(_dump(documents)))
+
+    def read_new(self) -> list[AnsweredQuery]:
+        """The documents appended by any worker since the previous read, blocking, run it in a thread."""
+        data, reset = self.log.read_new()
+        return self._parse(data, reset)
+
+    def compact(self) -> list[AnsweredQuery]:
+        """Rewrite the file to the latest ``max_documents`` documents, returning those ``read_new`` had yet to return."""
+        data, reset = self.log.compact(lambda whole: gzip.compress(_dump(_latest(_load(whole), self.max_documents))))
+        documents = self._parse(data, reset)
+        self.logged = min(self.logged, self.max_documents)
+        return documents
+
+    def _parse(self, data: bytes, reset: bool) -> list[AnsweredQuery]:
+        documents = _load(data)
+        self.logged = len(documents) if reset else self.logged + len(documents)
+        return documents
+
+    def merge(self, documents: list[AnsweredQuery]):
+        for document in documents:
+            self.add(document, save=False)
+
+    def stats(self) -> dict:
+        return {
+            "documents": len(self.documents),
+            "max_documents": self.max_documents,
+            "terms": len(self.postings),
+            "searches": self.searches,
+            "pending": _queue.qsize() if _queue is not None else 0,
+            "unsaved": len(self.unsaved),
+            "logged": self.logged,
+        }
+
+
+def _dump(documents: list[AnsweredQuery]) -> bytes:
+    return "".join(
+        json.dumps(asdict(document), ensure_ascii=False, separators=(",", ":")) + "\n"
+        for document in documents).encode("utf-8")
+
+
+def _load(data: bytes) -> list[AnsweredQuery]:
+    if not data:
+        return []
+    documents = []
+    # 每次追加都是一个独立的 gzip member，连在一起仍是合法的 gzip 流
+    for line in gzip.decompress(data).decode("utf-8").splitlines():
+        try:
+            documents.append(AnsweredQuery(**json.loads(line)))
+        except (ValueError, TypeError) as e:
+            logger.error(f"skip malformed answer index document: {e}")
+    return documents
+
+
+def _latest(documents: list[AnsweredQuery], limit: int) -> list[AnsweredQuery]:
+    latest: dict[tuple[str, str], AnsweredQuery] = {}
+    for document in sorted(documents, key=lambda document: document.answered_at):
+        key = (normalize_query(document.query), document.mode)
+        latest.pop(key, None)
+        latest[key] = document
+    return list(latest.values())[-limit:]
+
+
+def answer_text(frames: list[bytes]) -> str:
+    """The answer a client would display after the stored ``message`` and ``message_replace`` frames."""
+    parts = []
+    for frame in frames:
+        try:
+            payload = json.loads(frame.removeprefix(b"data:"))
+        except ValueError:
+            continue
+        if payload.get("event") in ("message", "agent_message"):
+            parts.append(payload.get("answer") or "")
+        elif payload.get("event") == "message_replace":
+            parts = [payload.get("answer") or ""]
+    return "".join(parts)
+
+
+_index: AnswerIndex | None = None
+_queue: asyncio.Queue | None = None
+_indexer: asyncio.Task | None = None
+
+
+def get_answer_index() -> AnswerIndex:
+    global _index
+    if _index is None:
+        config = get_config().answer_index
+        _index = AnswerIndex(config.path, config.max_documents)
+    return _index
+
+
+def submit(query: str, mode: str, answer_key: str, frames: list[bytes]):
+    """
+    Queue a completed answer for indexing, called on the request path so it only enqueues.
+
+    Nothing is queued while the indexer is not running, and answers are dropped with a warning while
+    ``queue_size`` answers are pending.
+    """
+    if _queue is None:
+        return
+    try:
+        _queue.put_nowait((query, mode, answer_key, frames, time.time()))
+    except asyncio.QueueFull:
+        index_dropped.inc()
+        logger.warning("answer index queue is full, answer not indexed")
+
+
+def _add(index: AnswerIndex, item: tuple):
+    query, mode, answer_key, frames, answered_at = item
+    index.add(AnsweredQuery(query, mode, answer_key, answer_text(frames)[:200], answered_at))
+
+
+async def _sync(index: AnswerIndex):
+    """Save this worker's new documents, then take in those of the other workers."""
+    await asyncio.to_thread(index.save, index.take_unsaved())
+    index.merge(await asyncio.to_thread(index.read_new))
+    if index.logged > 2 * index.max_documents:
+        index.merge(await asyncio.to_thread(index.compact))
+
+
+async def _index_answers(index: AnswerIndex, queue: asyncio.Queue, flush_interval: float):
+    synced_at = time.monotonic()
+    while True:
+        try:
+            item = await asyncio.wait_for(queue.get(), max(flush_interval - (time.monotonic() - synced_at), 0.01))
+        except asyncio.TimeoutError:
+            item = None
+        if item is not None:
+            _add(index, item)
+        if time.monotonic() - synced_at >= flush_interval:
+            synced_at = time.monotonic()
+            try:
+                await _sync(index)
+            except (OSError, EOFError) as e:
+                logger.error(f"failed to sync answer index: {e}")
+
+
+async def start_answer_indexer():
+    global _queue, _indexer
+    config = get_config().answer_index
+    if not config.enabled:
+        return
+    index = get_answer_index()
+    try:
+        index.merge(await asyncio.to_thread(index.read_new))
+    except (OSError, EOFError) as e:
+        logger.error(f"failed to load answer index: {e}")
+    _queue = asyncio.Queue(maxsize=config.queue_size)
+    _indexer = asyncio.create_task(_index_answers(index, _queue, config.flush_interval))
+
+
+async def stop_answer_indexer():
+    global _queue, _indexer
+    if _indexer is not None:
+        _indexer.cancel()
+        try:
+            await _indexer
+        except asyncio.CancelledError:
+            pass
+        _indexer = None
+    # 还在排队的回答也写进索引再保存
+    while _queue is not None and not _queue.empty():
+        _add(_index, _queue.get_nowait())
+    _queue = None
+    if _index is not None and _index.unsaved:
+        await asyncio.to_thread(_index.save, _index.take_unsaved())
+
+
+index_dropped = registry.counter("answer_index_dropped_total",
+                                 "Completed answers not indexed because the queue was full")
+registry.gauge("answer_index_documents",
+               "Answered queries in the local answer index",
+               collect=lambda: {(): len(_index.documents)} if _index is not None else {})
@@ -1,3 +1,4 @@
+import functools
 import threading
 from pydantic import BaseModel
 from toml import dump, TomlPreserveInlineDictEncoder
@@ -5,14 +6,37 @@ from tomllib import load
 import os
 from dotenv import set_key
 from app.internal.logging import logger
-from cryptography.hazmat.primitives.ciphers.aead import AESGCMSIV
 import base64
 from typing import Optional
 
 
+def _aead(key: bytes):
+    # cryptography 加载较慢，首次读取配置时才导入
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCMSIV
+    return AESGCMSIV(key)
+
+
 class ModelConfig(BaseModel):
     api_key: str
+    base_url: str = "https://api.dify.ai/v1"
+    # 同一应用的更多密钥，base_urls 与其一一对应，缺省时用 base_url
+    api_keys: list[str] = []
+    base_urls: list[str] = []
+    # 每个密钥同时进行的请求上限，0 表示不限
+    max_in_flight: int = 0
+    # 密钥返回 429/5xx 后暂停使用的秒数
+    evict_seconds: float = 30
+    # 多个密钥时，会话、消息和任务固定到哪个密钥记录在该文件中，所有 worker 共用，重启后仍然有效；默认 data/pins/<应用名>.log
+    pins_path: Optional[str] = None
     _api_key_plaintext: Optional[str] = None
+    _api_keys_plaintext: list[str] = []
+
+    def endpoints(self) -> list[tuple[str, str]]:
+        """(plaintext key, base url) for the primary key followed by ``api_keys``."""
+        endpoints = [(self._api_key_plaintext, self.base_url)]
+        for i, api_key in enumerate(self._api_keys_plaintext):
+            endpoints.append((api_key, self.base_urls[i] if i < len(self.base_urls) else self.base_url))
+        return endpoints
 
 
 class GlossaryConfig(ModelConfig):
@@ -27,15 +51,218 @@ class DeepGeminiConfig(ModelConfig):
     pass
 
 
+class WorkflowConfig(ModelConfig):
+    pass
+
+
 class ProxyConfig(BaseModel):
     url: str | None = None
 
 
+class HttpConfig(BaseModel):
+    # 上游连接池
+    max_connections: int = 200
+    max_keepalive_connections: int = 50
+    keepalive_expiry: float = 30
+    connect_timeout: float = 10
+    read_timeout: float = 300
+    write_timeout: float = 30
+    pool_timeout: float = 10
+    retries: int = 3
+    # 重新加载配置换池后，旧池等进行中的流式响应结束的最长秒数，到时强制关闭（至少为 read_timeout）
+    retire_timeout: float = 3600
+    # 合并并发的相同 GET 请求
+    coalesce: bool = True
+
+
+class UploadConfig(BaseModel):
+    chunk_size: int = 256 * 1024
+    # 各类型文件的大小上限（MB），键为 FileType 的名称
+    limits_mb: dict[str, float] = {"document": 15, "image": 10, "audio": 50, "video": 100}
+    # 不属于任何 FileType 的文件的大小上限（MB），为空表示不限
+    default_mb: float | None = 15
+
+    def limit_for(self, file_type: str | None) -> int | None:
+        limit = self.limits_mb.get(file_type) if file_type is not None else self.default_mb
+        return int(limit * 1024 * 1024) if limit is not None else None
+
+
+class AudioCacheConfig(BaseModel):
+    enabled: bool = True
+    directory: str = "cache/audio"
+    max_mb: float = 512
+
+
+class AnswerCacheConfig(BaseModel):
+    # 没有 conversation_id 的 glossary 问答按 (query, mode, files) 缓存完整回答
+    enabled: bool = True
+    directory: str = "cache/answers"
+    ttl: float = 86400
+    memory_mb: float = 64
+    disk_mb: float = 1024
+    # 超过该大小的回答不缓存
+    max_answer_kb: float = 512
+    # 命中时每秒回放的事件数，0 表示不限速
+    replay_rate: float = 0
+
+
+class AnswerIndexConfig(BaseModel):
+    # 已回答问题的本地 BM25 索引，用于查找相似问题
+    enabled: bool = True
+    # 所有 worker 共用这个文件，各自追加新文档并读取其他 worker 追加的
+    path: str = "data/answer_index.jsonl.gz"
+    max_documents: int = 50000
+    flush_interval: float = 30
+    queue_size: int = 1000
+    # 相似度不低于该值时直接回放相似问题的缓存回答，0 表示不启用
+    serve_similarity: float = 0
+
+
+class WorkflowProfileConfig(BaseModel):
+    # 按工作流和节点统计耗时、token 和失败率
+    enabled: bool = True
+    # 每个节点保留最近多少次耗时用于计算分位数
+    samples: int = 1000
+
+
+class IngestConfig(BaseModel):
+    # 知识库批量导入：同时上传的文档数
+    concurrency: int = 4
+    # 已上传但还在建索引的文档上限，达到后暂停上传
+    max_indexing: int = 32
+    # 查询索引进度的间隔（秒），没有进展时按 poll_backoff 倍数增加到 poll_max
+    poll_interval: float = 1
+    poll_max: float = 30
+    poll_backoff: float = 1.5
+    # 连续多少次查询失败后放弃该文档
+    poll_errors: int = 5
+
+
+class UsageConfig(BaseModel):
+    enabled: bool = True
+    path: str = "data/usage.jsonl"
+    flush_interval: float = 60
+
+
+class ServerConfig(BaseModel):
+    host: str = "0.0.0.0"
+    port: int = 11160
+    # 0 表示按 CPU 核数启动；内存中的缓存、限流和统计是每个 worker 各自一份，见 app.main.serve
+    workers: int = 0
+    # SIGTERM 后等待进行中的 SSE 流结束的秒数
+    graceful_timeout: float = 30
+    loop: str = "auto"
+    http: str = "auto"
+    # 检查 config.toml 是否被修改的间隔秒数，0 表示只在收到 SIGHUP 时重新加载
+    reload_interval: float = 5
+
+
+class StreamConfig(BaseModel):
+    # 直接转发上游字节，不做逐行解析
+    raw: bool = False
+    # DEBUG 级别下每 n 帧记录一次，0 表示不记录
+    log_sample: int = 50
+
+
+class CacheConfig(BaseModel):
+    enabled: bool = True
+    max_entries: int = 1024
+    # 各读接口的缓存秒数，0 表示不缓存
+    conversations_ttl: float = 10
+    messages_ttl: float = 5
+    suggested_ttl: float = 300
+
+
+class AdmissionConfig(BaseModel):
+    enabled: bool = True
+    # 每个用户的令牌桶：每秒请求数与突发量，rate 为 0 表示不限
+    user_rate: float = 2
+    user_burst: float = 10
+    # 每个应用（client name）的令牌桶
+    client_rate: float = 50
+    client_burst: float = 100
+    # 排队上限与最长等待秒数，超出返回 503
+    max_queue: int = 256
+    max_wait: float = 10
+    # 排队时各类请求的权重。类别由接口声明，未声明的按权重最低的一类；X-Request-Class 请求头只能把类别往低调
+    weights: dict[str, float] = {"interactive": 4, "bulk": 1}
+    max_users: int = 10000
+    # 这些地址的对端是反向代理，用户取 X-Forwarded-For 中最后一跳的地址。
+    # 部署在反向代理后面且没有认证层时必须配置，否则所有用户都是代理的地址，共用一个令牌桶
+    trusted_proxies: list[str] = []
+
+
+class LimiterConfig(BaseModel):
+    # 按 client name 自适应调整同时进行的上游请求数
+    enabled: bool = True
+    initial_limit: int = 20
+    min_limit: int = 2
+    max_limit: int = 200
+    backoff: float = 0.9
+    # 首字节时间超过基线的多少倍视为拥塞
+    latency_tolerance: float = 2.0
+    # 基线延迟的重新测量周期（秒）
+    baseline_window: float = 60
+
+
+class RetryConfig(BaseModel):
+    # 首次请求之外的最多重试次数
+    retries: int = 2
+    backoff_base: float = 0.2
+    backoff_max: float = 5
+    # Retry-After 超过该秒数时不再等待，直接返回上游响应
+    max_retry_after: float = 10
+    statuses: list[int] = [429, 502, 503, 504]
+    # 非 GET 请求只在这些状态码时重试，上游返回它们时没有执行请求；502/504 时可能已经执行，重发会重复创建
+    unsent_statuses: list[int] = [429, 503]
+
+
+class BreakerConfig(BaseModel):
+    # 按上游接口熔断，连续失败 failures 次后打开 open_seconds 秒
+    enabled: bool = True
+    failures: int = 5
+    open_seconds: float = 30
+    half_open_probes: int = 1
+
+
+class TimeoutConfig(BaseModel):
+    # 按接口类型区分的读超时（秒），连接、写入和连接池等待仍使用 http 中的配置
+    # 会话列表、消息、推荐问题等元数据 GET
+    metadata: float = 10
+    # 反馈、停止、重命名、删除等非流式请求
+    command: float = 30
+    # 上传文件和语音转文字，从请求体发完开始计算
+    upload: float = 120
+    # 流式请求等待第一个字节，以及之后两次收到数据之间的最长间隔
+    stream_ttfb: float = 60
+    stream_idle: float = 30
+    # 客户端传入的截止时间，Unix 时间戳（秒）
+    deadline_header: str = "X-Request-Deadline"
+
+
 class ConfigInner(BaseModel):
     glossary: GlossaryConfig
     deep_search: DeepsearchConfig
     deep_gemini: DeepGeminiConfig
     proxy: ProxyConfig
+    # 工作流应用是可选的
+    workflow: Optional[WorkflowConfig] = None
+    server: ServerConfig = ServerConfig()
+    http: HttpConfig = HttpConfig()
+    stream: StreamConfig = StreamConfig()
+    cache: CacheConfig = CacheConfig()
+    upload: UploadConfig = UploadConfig()
+    audio_cache: AudioCacheConfig = AudioCacheConfig()
+    answer_cache: AnswerCacheConfig = AnswerCacheConfig()
+    answer_index: AnswerIndexConfig = AnswerIndexConfig()
+    workflow_profile: WorkflowProfileConfig = WorkflowProfileConfig()
+    ingest: IngestConfig = IngestConfig()
+    usage: UsageConfig = UsageConfig()
+    admission: AdmissionConfig = AdmissionConfig()
+    limiter: LimiterConfig = LimiterConfig()
+    retry: RetryConfig = RetryConfig()
+    breaker: BreakerConfig = BreakerConfig()
+    timeouts: TimeoutConfig = TimeoutConfig()
 
 
 class Config:
@@ -44,10 +271,13 @@ class Config:
     existed_dek: bool = True
     config: ConfigInner
     path: str
+    mtime: int
 
     def __init__(self, path: str):
         self.path = path
+        self.changed = False
         with open(path, 'rb') as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime_ns
             data = load(f)
             self.config = ConfigInner(**data)
 
@@ -67,54 +297,123 @@ class Config:
         for key, value in config.__dict__.items():
             if isinstance(value, ModelConfig):
                 value._api_key_plaintext = self.wrap_api_key(value)
+                value._api_keys_plaintext = self.wrap_api_keys(value)
                 setattr(config, key, value)
 
-        self.dump_config()
+        if os.getenv(CONFIG_BOOTSTRAPPED):
+            # 父进程已经加密并写回了配置，worker 只读
+            return
+
+        # 只有新加密了密钥时才写回配置，重启不再重写 config.toml
+        if self.changed or not self.existed_dek:
+            self.dump_config()
+        dek = base64.b64encode(self.API_KEY_DEK).decode('utf-8')
+        nonce = base64.b64encode(self.API_KEY_NONCE).decode('utf-8')
         if not self.existed_dek:
-            set_key(".env", "API_KEY_DEK", base64.b64encode(self.API_KEY_DEK).decode('utf-8'), quote_mode="always")
-            set_key(".env", "API_KEY_NONCE", base64.b64encode(self.API_KEY_NONCE).decode('utf-8'), quote_mode="always")
+            set_key(".env", "API_KEY_DEK", dek, quote_mode="always")
+            set_key(".env", "API_KEY_NONCE", nonce, quote_mode="always")
+        # worker 进程继承环境变量，用同一组密钥解密
+        os.environ["API_KEY_DEK"] = dek
+        os.environ["API_KEY_NONCE"] = nonce
 
     def dump_config(self):
-        data = self.config.model_dump()
+        # 只写回文件里原有的和新加密的字段，不把各节的默认值写进用户的 config.toml
+        data = self.config.model_dump(exclude_unset=True)
         with open(self.path, 'w') as f:
             dump(data, f)
+        # 自己写回的改动不算作需要重新加载的修改
+        self.mtime = os.stat(self.path).st_mtime_ns
 
     def wrap_api_key(self, model_config: ModelConfig) -> str:
         api_key = model_config.api_key
         if api_key is None:
             return None
-        cipher = AESGCMSIV(self.API_KEY_DEK)
+        model_config.api_key, plaintext_api_key = self._wrap(api_key)
+        return plaintext_api_key
+
+    def wrap_api_keys(self, model_config: ModelConfig) -> list[str]:
+        if not model_config.api_keys:
+            return []
+        wrapped = [self._wrap(api_key) for api_key in model_config.api_keys]
+        model_config.api_keys = [stored for stored, _ in wrapped]
+        return [plaintext_api_key for _, plaintext_api_key in wrapped]
+
+    def _wrap(self, api_key: str) -> tuple[str, str]:
+        """Returns (the key as stored in config.toml, the plaintext key)."""
         if self.existed_dek and not api_key.startswith("plaintext("):
-            model_config.api_key = api_key
-            return cipher.decrypt(self.API_KEY_NONCE, base64.b64decode(api_key.encode('utf-8')), None).decode('utf-8')
-        elif self.existed_dek and api_key.startswith("plaintext("):
+            return api_key, _decrypt(self.API_KEY_DEK, self.API_KEY_NONCE, api_key)
+        self.changed = True
+        plaintext_api_key = api_key
+        if api_key.startswith("plaintext("):
             plaintext_api_key = api_key.split("plaintext(")[1].split(")")[0]
-            model_config.api_key = base64.b64encode(
-                cipher.encrypt(self.API_KEY_NONCE, plaintext_api_key.encode('utf-8'), None)).decode('utf-8')
-            return plaintext_api_key
-        else:
-            encrypted_api_key = base64.b64encode(cipher.encrypt(self.API_KEY_NONCE, api_key.encode('utf-8'),
-                                                                None)).decode('utf-8')
-            model_config.api_key = encrypted_api_key
-            return api_key
+        ciphertext = _aead(self.API_KEY_DEK).encrypt(self.API_KEY_NONCE, plaintext_api_key.encode('utf-8'), None)
+        return base64.b64encode(ciphertext).decode('utf-8'), plaintext_api_key
 
     def _generate_dek_and_nonce(self) -> tuple[bytes, bytes]:
-        key = AESGCMSIV.generate_key(256)
+        key = os.urandom(32)
         nonce = os.urandom(12)
         return key, nonce
 
 
+@functools.lru_cache(maxsize=64)
+def _decrypt(dek: bytes, nonce: bytes, api_key: str) -> str:
+    # 同一密文只解密一次，重新加载配置时直接复用
+    return _aead(dek).decrypt(nonce, base64.b64decode(api_key.encode('utf-8')), None).decode('utf-8')
+
+
+CONFIG_BOOTSTRAPPED = "AI_ENDPOINT_CONFIG_BOOTSTRAPPED"
+
 config = None
 
 lock = threading.Lock()
 
 
+def _config_path() -> str:
+    return os.path.join(os.getcwd(), os.getenv("CONFIG", "config.toml"))
+
+
 def get_config() -> ConfigInner:
     global config
     if config is None:
         with lock:
             if config is None:
-                config_file = os.path.join(os.getcwd(), os.getenv("CONFIG", "config.toml"))
-                config = Config(config_file)
+                config = Config(_config_path())
                 config.load_config()
     return config.config
+
+
+def config_modified() -> int | None:
+    """The modification time of config.toml if it changed on disk since the current snapshot was loaded."""
+    if config is None:
+        return None
+    try:
+        mtime = os.stat(config.path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return mtime if mtime != config.mtime else None
+
+
+def reload_config() -> tuple[ConfigInner, ConfigInner]:
+    """
+    Load config.toml again and swap it in as the current snapshot, returning ``(old, new)``.
+
+    The previous ``ConfigInner`` is left untouched, so code still holding it keeps a consistent view. If the file does
+    not parse or validate, the error is raised and the current snapshot stays in place.
+    """
+    global config
+    old = get_config()
+    with lock:
+        fresh = Config(_config_path())
+        fresh.load_config()
+        config = fresh
+    return old, fresh.config
+
+
+def bootstrap_config() -> ConfigInner:
+    """
+    Load the config once in the launcher process, rewriting config.toml and .env if needed, and mark the environment
+    so worker processes only read them.
+    """
+    inner = get_config()
+    os.environ[CONFIG_BOOTSTRAPPED] = "1"
+    return inner
@@ -0,0 +1,71 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from fastapi import Request
+from app.internal.config import get_config
+from app.internal.dify.errors import DeadlineExceededError
+
+# time.monotonic() 时间点，超过后不再调用上游
+_deadline: ContextVar[float | None] = ContextVar("deadline", default=None)
+
+
+def current() -> float | None:
+    return _deadline.get()
+
+
+def remaining(at: float | None = None) -> float | None:
+    """Seconds left until ``at``, the current deadline by default, None when there is none."""
+    at = current() if at is None else at
+    return None if at is None else at - time.monotonic()
+
+
+def check(what: str = "request"):
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceededError(f"{what} is past its deadline by {-left:.3f}s")
+
+
+def clamp(timeout: float | None, at: float | None = None) -> float | None:
+    """``timeout`` shortened to what is left of the deadline."""
+    left = remaining(at)
+    if left is None:
+        return timeout
+    left = max(left, 0.0)
+    return left if timeout is None else min(timeout, left)
+
+
+@contextmanager
+def within(seconds: float):
+    """Runs the block with a deadline ``seconds`` from now, or the enclosing one if that is sooner."""
+    at = time.monotonic() + seconds
+    if current() is not None:
+        at = min(at, current())
+    token = _deadline.set(at)
+    try:
+        yield at
+    finally:
+        _deadline.reset(token)
+
+
+def parse(value: str) -> float:
+    """A deadline header, Unix time in seconds, as a ``time.monotonic()`` time point."""
+    return time.monotonic() + float(value) - time.time()
+
+
+async def request_deadline(request: Request):
+    """
+    FastAPI dependency taking the caller's deadline from the ``timeouts.deadline_header`` header.
+
+    Upstream calls made for the request, and the admission wait before them, are cut short at the deadline instead
+    of finishing work nobody waits for anymore. An unparsable header is ignored.
+    """
+    value = request.headers.get(get_config().timeouts.deadline_header)
+    if not value:
+        return
+    try:
+        at = parse(value)
+    except ValueError:
+        return
+    # 请求在自己的任务里处理，设置后对之后的依赖和路由函数都可见
+    _deadline.set(at)
+    check()
@@ -1 +1 @@
-from .client import DifyClient, CompletionClient, ChatClient, get_chat_client
+from .client import DifyClient, CompletionClient, ChatClient, WorkflowClient, get_chat_client, get_workflow_client
@@ -0,0 +1,283 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Iterable
+from app.internal.config import get_config
+from app.internal.logging import logger
+from app.internal.metrics import registry
+from app.internal.dify.models.chat import DifyEventType as ChatEventType, decoder as chat_decoder
+
+# 回放一个回答只需要这些事件，ping、tts 等不保存
+_KEPT_EVENTS = frozenset(
+    (ChatEventType.MESSAGE.value, ChatEventType.AGENT_MESSAGE.value, ChatEventType.AGENT_THOUGHT.value,
+     ChatEventType.MESSAGE_REPLACE.value, ChatEventType.MESSAGE_END.value))
+_WHITESPACE = re.compile(r"\s+")
+# 回放的回答不属于任何会话，这些字段置空，客户端不会拿它们续聊、反馈或停止
+_SESSION_FIELDS = ("conversation_id", "message_id", "task_id")
+# 保存格式的版本，旧版本的文件里还带着原会话的 ID，读到时当作未命中
+_FORMAT = 2
+
+
+def normalize_query(query: str) -> str:
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", query)).strip().casefold()
+
+
+@dataclass
+class CachedAnswer:
+    frames: list[bytes]
+    # Unix 时间，磁盘上的回答重启后仍按原来的时间过期
+    expires_at: float
+
+    @property
+    def size(self) -> int:
+        return sum(len(frame) for frame in self.frames)
+
+
+def _detach(frame: bytes) -> bytes:
+    """``frame`` with the ids of the conversation, message and task it was answered in set to null."""
+    event = json.loads(frame[len(b"data:"):])
+    # message 等事件的 id 就是 message_id
+    if "id" in event and event["id"] == event.get("message_id"):
+        event["id"] = None
+    for name in _SESSION_FIELDS:
+        if name in event:
+            event[name] = None
+    return b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8")
+
+
+def answer_frames(body: bytes) -> list[bytes] | None:
+    """
+    The SSE frames worth replaying from a relayed chat body, None unless the answer completed cleanly. They are
+    detached from the conversation they were answered in, so a replay cannot be continued as that conversation.
+    """
+    frames = []
+    ended = False
+    for frame in body.split(b"\n\n"):
+        frame = frame.strip()
+        if not frame.startswith(b"data:"):
+            continue
+        event = chat_decoder.peek(frame)
+        if event == ChatEventType.ERROR.value:
+            return None
+        if event in _KEPT_EVENTS:
+            try:
+                frames.append(_detach(frame) + b"\n\n")
+            except (ValueError, TypeError, AttributeError):
+                return None
+            ended = ended or event == ChatEventType.MESSAGE_END.value
+    return frames if ended else None
+
+
+class AnswerCache:
+    """
+    Completed glossary answers keyed by the normalized (query, mode, file ids) of a conversation-less chat.
+
+    A size bounded LRU in memory sits in front of files under ``directory``; a disk hit is promoted to memory.
+    Entries expire ``ttl`` seconds after they were stored, in wall time so that disk entries survive restarts, and
+    the oldest files are pruned once the directory exceeds ``disk_bytes``. Only answers that reached
+    ``message_end`` without an ``error`` event are stored.
+    """
+
+    def __init__(self, directory: str, memory_bytes: int, disk_bytes: int, ttl: float, max_answer_bytes: int):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self.max_answer_bytes = max_answer_bytes
+        self._memory: OrderedDict[str, CachedAnswer] = OrderedDict()
+        self._memory_size = 0
+        self._disk_size: int | None = None
+        self._lock = threading.Lock()
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self.stored = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(query: str, mode: str | None, file_ids: Iterable[str]) -> str:
+        digest = hashlib.sha256()
+        for part in (normalize_query(query), mode or "", *sorted(file_ids)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    async def get(self, key: str) -> CachedAnswer | None:
+        answer = self._memory.get(key)
+        if answer is not None:
+            if answer.expires_at > time.time():
+                self._memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return answer
+            del self._memory[key]
+            self._memory_size -= answer.size
+        answer = await asyncio.to_thread(self._read, key)
+        if answer is None:
+            self.misses += 1
+            return None
+        self.hits["disk"] += 1
+        self._remember(key, answer)
+        return answer
+
+    def _read(self, key: str) -> CachedAnswer | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                body = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        if header.get("expires_at", 0) <= time.time() or header.get("format") != _FORMAT:
+            self._unlink(path)
+            return None
+        os.utime(path)
+        return CachedAnswer([frame + b"\n\n" for frame in body.split(b"\n\n") if frame], header["expires_at"])
+
+    def _remember(self, key: str, answer: CachedAnswer):
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_size -= previous.size
+        if answer.size > self.memory_bytes:
+            return
+        self._memory[key] = answer
+        self._memory_size += answer.size
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= evicted.size
+
+    async def put(self, key: str, frames: list[bytes]):
+        answer = CachedAnswer(frames, time.time() + self.ttl)
+        self._remember(key, answer)
+        self.stored += 1
+        await asyncio.to_thread(self._write, key, answer)
+
+    def _write(self, key: str, answer: CachedAnswer):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(json.dumps({"expires_at": answer.expires_at, "format": _FORMAT}).encode("utf-8") + b"\n")
+            f.writelines(answer.frames)
+        with self._lock:
+            # 覆盖旧文件时只计入大小的差值
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(temp_path, path)
+            self._prune(os.path.getsize(path) - previous)
+
+    async def record(self,
+                     key: str,
+                     chunks: AsyncIterator[bytes],
+                     on_stored: Callable[[list[bytes]], None] | None = None) -> AsyncIterator[bytes]:
+        """
+        Relay ``chunks`` and store the answer under ``key`` once the stream completed.
+
+        A stream that is cancelled, fails or grows past ``max_answer_bytes`` is relayed but not stored.
+
+        :param on_stored: called with the stored frames once the answer was stored
+        """
+        body: bytearray | None = bytearray()
+        async for chunk in chunks:
+            if body is not None:
+                body += chunk
+                if len(body) > self.max_answer_bytes:
+                    body = None
+            yield chunk
+        frames = answer_frames(bytes(body)) if body is not None else None
+        if frames:
+            try:
+                await self.put(key, frames)
+            except OSError as e:
+                logger.error(f"failed to store answer {key}: {e}")
+                return
+            if on_stored is not None:
+                on_stored(frames)
+
+    @staticmethod
+    async def replay(answer: CachedAnswer, pace: float = 0) -> AsyncIterator[bytes]:
+        """Yield the stored frames, ``pace`` events per second if given, as fast as the client reads otherwise."""
+        for index, frame in enumerate(answer.frames):
+            if pace > 0 and index:
+                await asyncio.sleep(1 / pace)
+            yield frame
+
+    def _unlink(self, path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _scan(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _prune(self, size: int):
+        if self._disk_size is None:
+            self._disk_size = sum(entry[1] for entry in self._scan())
+        else:
+            self._disk_size += size
+        if self._disk_size <= self.disk_bytes:
+            return
+        for _, entry_size, path in sorted(self._scan()):
+            if self._disk_size <= self.disk_bytes:
+                break
+            self._unlink(path)
+            self._disk_size -= entry_size
+        logger.info(f"answer cache pruned to {self._disk_size} bytes")
+
+    def stats(self) -> dict:
+        return {
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "stored": self.stored,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "max_memory_bytes": self.memory_bytes,
+            "disk_bytes": self._disk_size,
+            "max_disk_bytes": self.disk_bytes,
+        }
+
+
+_answer_cache: AnswerCache | None = None
+
+
+def get_answer_cache() -> AnswerCache:
+    global _answer_cache
+    if _answer_cache is None:
+        config = get_config().answer_cache
+        _answer_cache = AnswerCache(config.directory,
+                                    memory_bytes=int(config.memory_mb * 1024 * 1024),
+                                    disk_bytes=int(config.disk_mb * 1024 * 1024),
+                                    ttl=config.ttl,
+                                    max_answer_bytes=int(config.max_answer_kb * 1024))
+    return _answer_cache
+
+
+def _collect_answer_cache_requests() -> dict[tuple[str, ...], float]:
+    cache = _answer_cache
+    if cache is None:
+        return {}
+    values = {(tier, "hit"): count for tier, count in cache.hits.items()}
+    values[("all", "miss")] = cache.misses
+    return values
+
+
+registry.counter_func("answer_cache_requests_total",
+                      "Glossary answer cache lookups by tier and result", ("tier", "result"),
+                      collect=_collect_answer_cache_requests)
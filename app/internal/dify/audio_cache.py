@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import mmap
+import os
+import threading
+import uuid
+from typing import AsyncIterator, Iterator
+import httpx
+from app.internal.config import get_config
+from app.internal.logging import logger
+
+
+class CachedAudio:
+    """
+    A cached audio file mapped read only into memory. Whoever opened it must ``close`` it, whether or not its content
+    was iterated.
+    """
+
+    def __init__(self, path: str, media_type: str):
+        self.media_type = media_type
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def iter_range(self, start: int, end: int, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        for offset in range(start, end + 1, chunk_size):
+            yield self.data[offset:min(offset + chunk_size, end + 1)]
+
+    def close(self):
+        self.data.close()
+
+
+class AudioCache:
+    """
+    Content addressed on-disk cache of generated audio, keyed by (text, message id, voice).
+
+    Files are written to a temporary name while the upstream stream is relayed and only renamed into place once it
+    completed, so a half generated file is never served. The oldest entries are dropped when ``max_mb`` is exceeded.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size: int | None = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(text: str | None, message_id: str | None, voice: str | None) -> str:
+        digest = hashlib.sha256()
+        for part in (text, message_id, voice):
+            digest.update((part or "").encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def open(self, key: str) -> CachedAudio | None:
+        """Map the entry stored under ``key``, blocking, run it in a thread."""
+        path = self._path(key)
+        try:
+            with open(f"{path}.type", "r", encoding="utf-8") as f:
+                media_type = f.read().strip()
+            audio = CachedAudio(path, media_type)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return audio
+
+    async def tee(self, key: str, response: httpx.Response) -> AsyncIterator[bytes]:
+        """
+        Relay ``response`` and store its body under ``key`` once it has been fully received.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        size = 0
+        completed = False
+        try:
+            with open(temp_path, "wb") as f:
+                async for chunk in response.aiter_bytes():
+                    await asyncio.to_thread(f.write, chunk)
+                    size += len(chunk)
+                    yield chunk
+            completed = size > 0
+        finally:
+            await response.aclose()
+            if completed:
+                with open(f"{path}.type", "w", encoding="utf-8") as f:
+                    f.write(response.headers.get("content-type", "audio/mpeg"))
+                os.replace(temp_path, path)
+                await asyncio.to_thread(self._account, size)
+            else:
+                os.unlink(temp_path)
+
+    def _scan(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".type") or name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _account(self, size: int):
+        with self._lock:
+            self._prune(size)
+
+    def _prune(self, size: int):
+        if self._size is None:
+            self._size = sum(entry[1] for entry in self._scan())
+        else:
+            self._size += size
+        if self._size <= self.max_bytes:
+            return
+        for _, entry_size, path in sorted(self._scan()):
+            if self._size <= self.max_bytes:
+                break
+            for stale in (path, f"{path}.type"):
+                try:
+                    os.unlink(stale)
+                except FileNotFoundError:
+                    pass
+            self._size -= entry_size
+        logger.info(f"audio cache pruned to {self._size} bytes")
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "bytes": self._size, "max_bytes": self.max_bytes}
+
+
+_audio_cache: AudioCache | None = None
+
+
+def get_audio_cache() -> AudioCache:
+    global _audio_cache
+    if _audio_cache is None:
+        config = get_config().audio_cache
+        _audio_cache = AudioCache(config.directory, int(config.max_mb * 1024 * 1024))
+    return _audio_cache
@@ -0,0 +1,247 @@
+import functools
+import inspect
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any
+import httpx
+from app.internal.config import get_config
+from app.internal.metrics import registry
+
+
+@dataclass
+class CachedResponse:
+    status_code: int
+    headers: list[tuple[bytes, bytes]]
+    content: bytes
+    expires_at: float
+    tags: frozenset[tuple[str, str, Any]]
+    request: httpx.Request | None = None
+
+    @classmethod
+    def snapshot(cls, response: httpx.Response, ttl: float, tags: frozenset) -> "CachedResponse":
+        return cls(status_code=response.status_code,
+                   headers=[(name, value) for name, value in response.headers.raw
+                            if name.lower() not in (b"content-encoding", b"content-length", b"transfer-encoding")],
+                   content=response.content,
+                   expires_at=time.monotonic() + ttl,
+                   tags=tags,
+                   request=response.request)
+
+    def to_response(self) -> httpx.Response:
+        # 保留 request，调用方依赖 raise_for_status()
+        return httpx.Response(self.status_code, headers=self.headers, content=self.content, request=self.request)
+
+
+class ResponseCache:
+    """
+    Size bounded LRU of upstream responses with a ttl per entry.
+
+    Entries are tagged with ``(api_key, namespace.argument, value)`` so writes can drop exactly the reads they affect.
+    A read in flight while one of its tags is invalidated may have fetched the old data, so each tag has a generation,
+    kept only while reads of it are in flight, and such a read is not stored.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, CachedResponse] = OrderedDict()
+        self._generations: dict[tuple[str, str, Any], int] = {}
+        self._readers: dict[tuple[str, str, Any], int] = {}
+        self.hits: dict[str, int] = {}
+        self.misses: dict[str, int] = {}
+        self.invalidations = 0
+
+    def get(self, namespace: str, key: tuple) -> CachedResponse | None:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses[namespace] = self.misses.get(namespace, 0) + 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits[namespace] = self.hits.get(namespace, 0) + 1
+        return entry
+
+    def put(self, key: tuple, entry: CachedResponse):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def begin_read(self, tags: frozenset) -> tuple[int, ...]:
+        """Mark a read of ``tags`` as in flight, returning the generations to pass to ``end_read``."""
+        for tag in tags:
+            self._readers[tag] = self._readers.get(tag, 0) + 1
+        return tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def end_read(self, tags: frozenset, generations: tuple[int, ...]) -> bool:
+        """Finish a read started by ``begin_read``, True if none of its tags was invalidated meanwhile."""
+        fresh = tuple(self._generations.get(tag, 0) for tag in tags) == generations
+        for tag in tags:
+            self._readers[tag] -= 1
+            if not self._readers[tag]:
+                del self._readers[tag]
+                self._generations.pop(tag, None)
+        return fresh
+
+    def invalidate(self, tags: set[tuple[str, str, Any]]):
+        if not tags:
+            return
+        for tag in tags:
+            if tag in self._readers:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+        stale = [key for key, entry in self._entries.items() if not entry.tags.isdisjoint(tags)]
+        for key in stale:
+            del self._entries[key]
+        self.invalidations += len(stale)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        namespaces = sorted(set(self.hits) | set(self.misses))
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "invalidations": self.invalidations,
+            "namespaces": {
+                namespace: {
+                    "hits": self.hits.get(namespace, 0),
+                    "misses": self.misses.get(namespace, 0),
+                }
+                for namespace in namespaces
+            },
+        }
+
+
+_cache: ResponseCache | None = None
+
+
+def get_response_cache() -> ResponseCache:
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache(max_entries=get_config().cache.max_entries)
+    return _cache
+
+
+def _collect_cache_requests() -> dict[tuple[str, ...], float]:
+    cache = _cache
+    if cache is None:
+        return {}
+    values = {(namespace, "hit"): count for namespace, count in cache.hits.items()}
+    values.update({(namespace, "miss"): count for namespace, count in cache.misses.items()})
+    return values
+
+
+registry.counter_func("dify_cache_requests_total",
+                      "Cached upstream reads by namespace and result", ("namespace", "result"),
+                      collect=_collect_cache_requests)
+
+# 当前读取的 (标签, 代数)，合并相同请求时只合并同一代的读取
+_read_generations: ContextVar[frozenset | None] = ContextVar("read_generations", default=None)
+
+
+def read_generations() -> frozenset | None:
+    """
+    ``(tag, generation)`` of the cached read being made, None outside one. A read that starts after an invalidation
+    has newer generations, so coalescing it by these never hands it a response fetched before the write.
+    """
+    return _read_generations.get()
+
+
+def _bind(signature: inspect.Signature, args: tuple, kwargs: dict) -> dict:
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    arguments.pop("self", None)
+    return arguments
+
+
+def cached(namespace: str, *tag_arguments: str):
+    """
+    Cache successful responses of a ``DifyClient`` read method.
+
+    :param namespace: name of the cached read, also the key of its ttl in ``[cache]``
+    :param tag_arguments: arguments whose values tag the entry, writes invalidate by these tags
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            ttl = getattr(get_config().cache, f"{namespace}_ttl", 0)
+            if not get_config().cache.enabled or ttl <= 0:
+                return await func(self, *args, **kwargs)
+
+            arguments = _bind(signature, (self, *args), kwargs)
+            key = (self.api_key, namespace, tuple(sorted(arguments.items())))
+            cache = get_response_cache()
+            entry = cache.get(namespace, key)
+            if entry is not None:
+                return entry.to_response()
+
+            tags = frozenset((self.api_key, f"{namespace}.{name}", arguments[name]) for name in tag_arguments
+                             if arguments.get(name) is not None)
+            generations = cache.begin_read(tags)
+            token = _read_generations.set(frozenset(zip(tags, generations)))
+            try:
+                response = await func(self, *args, **kwargs)
+            finally:
+                _read_generations.reset(token)
+                # 请求期间被写操作失效的读取结果可能已经过期，不再缓存
+                fresh = cache.end_read(tags, generations)
+            if response.is_success and fresh:
+                cache.put(key, CachedResponse.snapshot(response, ttl, tags))
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def invalidates(**namespaces: str):
+    """
+    Drop cached reads touched by a ``DifyClient`` write method.
+
+    ``@invalidates(conversations="user")`` drops every cached ``conversations`` read tagged with the same ``user``.
+    Streaming responses invalidate again once the stream is closed, since Dify persists the message at the end.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            arguments = _bind(signature, (self, *args), kwargs)
+            tags = {(self.api_key, f"{namespace}.{name}", arguments[name])
+                    for namespace, name in namespaces.items() if arguments.get(name) is not None}
+            cache = get_response_cache()
+            cache.invalidate(tags)
+            response = await func(self, *args, **kwargs)
+            if not response.is_stream_consumed and not response.is_closed:
+                response.stream = _InvalidateOnClose(response.stream, lambda: cache.invalidate(tags))
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+class _InvalidateOnClose(httpx.AsyncByteStream):
+
+    def __init__(self, stream: httpx.AsyncByteStream, callback):
+        self.stream = stream
+        self.callback = callback
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            self.callback()
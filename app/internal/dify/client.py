@@ -1,98 +1,246 @@
+import asyncio
 import json
+import os
+import time
 import httpx
-from typing import Literal
-import threading
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Iterable, Literal
+from pydantic import BaseModel
 from app.internal import logger, get_config
+from app.internal.config import ConfigInner, ModelConfig
 from app.utils.http import unambiguous
-
-lock = threading.Lock()
-
-_client: httpx.AsyncClient | None = None
+from app.internal.dify.cache import cached, invalidates, read_generations
+from app.internal.dify.pool import get_pool
+from app.internal.dify.coalesce import single_flight
+from app.internal.dify.multipart import MultipartStream
+from app.internal.dify.keys import KeyPool, KeySlot
+from app.internal.dify.limiter import get_limiter
+from app.internal.dify.resilience import resilient
+from app.internal.dify.timeouts import request_timeout, TimedStream
+from app.internal.dify.stream import iter_events
+from app.internal.dify.ingest import IngestEvent, ingest
+from app.internal.dify.models.workflow import decoder as workflow_decoder
+from app.internal import deadline
+# admission 经 deadline 间接导入本模块，按模块导入，用到时再取属性
+from app.internal import admission
+from app.internal.metrics import registry
 
 
 def _global_client() -> httpx.AsyncClient:
-    global _client
-    if _client is None:
-        with lock:
-            if _client is None:
-                proxy_url = get_config().proxy.url
-                if proxy_url:
-                    logger.info(f"using proxy: {proxy_url}")
-                    _client = httpx.AsyncClient(timeout=httpx.Timeout(timeout=300),
-                                                transport=httpx.AsyncHTTPTransport(retries=3,
-                                                                                   proxy=httpx.Proxy(url=proxy_url)))
-    return _client
+    return get_pool()
 
 
-_dify_clients = {}
+# 按 (name, 客户端类) 缓存，同一个应用可以同时有对话和工作流客户端
+_dify_clients: dict[tuple[str, type["DifyClient"]], "DifyClient"] = {}
 
 
 def get_chat_client(name: str) -> "ChatClient":
-    return _get_client(name)
+    return _get_client(name, ChatClient)
+
+
+def get_workflow_client(name: str) -> "WorkflowClient":
+    return _get_client(name, WorkflowClient)
 
 
-def _get_client(name: str) -> "DifyClient":
-    if name not in _dify_clients:
-        config = get_config()
-        if not hasattr(config, name):
+def _get_client(name: str, client_class: type["DifyClient"]) -> "DifyClient":
+    client = _dify_clients.get((name, client_class))
+    if client is None:
+        model_config = getattr(get_config(), name, None)
+        if model_config is None:
             raise ValueError(f"{name} is not configured")
-        _dify_clients[name] = ChatClient(api_key=getattr(config, name)._api_key_plaintext)
-    return _dify_clients[name]
+        # 同一个应用的各类客户端共用一个密钥池，并发上限和驱逐状态按应用计算
+        keys = next((other.keys for (other_name, _), other in _dify_clients.items() if other_name == name), None)
+        client = _dify_clients[name, client_class] = client_class(
+            api_key=model_config._api_key_plaintext,
+            base_url=model_config.base_url,
+            keys=keys or KeyPool.from_config(model_config, _pins_path(name, model_config)),
+            name=name)
+    return client
+
+
+def _pins_path(name: str, model_config: ModelConfig) -> str:
+    return model_config.pins_path or os.path.join("data", "pins", f"{name}.log")
+
+
+def drop_stale_clients(config: ConfigInner) -> list[str]:
+    """
+    Forget cached clients whose app is gone from ``config`` or whose API keys, base URLs or key limits changed,
+    returning their names.
+
+    Requests already holding a client finish with it; the next ``get_chat_client`` builds one with the new key.
+    """
+    stale = []
+    for key, client in list(_dify_clients.items()):
+        name = key[0]
+        model_config = getattr(config, name, None)
+        if (model_config is None or model_config.endpoints() != client.keys.endpoints
+                or model_config.max_in_flight != client.keys.slots[0].max_in_flight
+                or model_config.evict_seconds != client.keys.evict_seconds):
+            del _dify_clients[key]
+            if name not in stale:
+                stale.append(name)
+    return stale
+
+
+def _key_pools() -> dict[str, KeyPool]:
+    return {name: client.keys for (name, _), client in _dify_clients.items()}
+
+
+def key_pool_stats() -> dict:
+    return {name: keys.stats() for name, keys in _key_pools().items()}
+
+
+def _collect_keys(attribute: str) -> dict[tuple[str, ...], float]:
+    return {(name, slot.label): getattr(slot, attribute) for name, keys in _key_pools().items() for slot in keys.slots}
+
+
+registry.gauge("dify_api_key_in_flight",
+               "Upstream requests in flight per API key", ("client", "key"),
+               collect=lambda: _collect_keys("in_flight"))
+registry.counter_func("dify_api_key_failures_total",
+                      "429, 5xx and transport errors per API key, each one evicts the key for a while",
+                      ("client", "key"),
+                      collect=lambda: _collect_keys("failures"))
 
 
 class DifyClient:
 
-    def __init__(self, api_key: str, base_url: str = "https://api.dify.ai/v1"):
+    def __init__(self,
+                 api_key: str,
+                 base_url: str = "https://api.dify.ai/v1",
+                 keys: KeyPool | None = None,
+                 name: str | None = None):
         self.api_key = api_key
         self.base_url = base_url
+        self.keys = keys or KeyPool([KeySlot(api_key, base_url)])
+        # 配置中的名称，用于按应用自适应限流；直接构造的客户端不限流
+        self.name = name
+
+    async def _send(self, slot: KeySlot, request: httpx.Request, stream: bool) -> httpx.Response:
+        limiter = get_limiter(self.name) if self.name else None
+        if limiter is not None:
+            try:
+                limiter.acquire()
+            except Exception:
+                self.keys.release(slot)
+                raise
+        client = _global_client()
+        started_at = time.perf_counter()
+        sent_at = time.monotonic()
+        try:
+            response = await client.send(request, stream=stream)
+        except httpx.TransportError:
+            self.keys.release(slot, failed=True)
+            if limiter is not None:
+                limiter.release()
+                limiter.sample(None, failed=True)
+            raise
+        except BaseException:
+            self.keys.release(slot)
+            if limiter is not None:
+                limiter.release()
+            raise
+        if limiter is not None:
+            limiter.sample(time.perf_counter() - started_at,
+                           failed=response.status_code == 429 or response.status_code >= 500)
+        response = self.keys.track(slot, response, on_close=limiter.release if limiter is not None else None)
+        if stream and not (response.is_stream_consumed or response.is_closed):
+            timeouts = get_config().timeouts
+            response.stream = TimedStream(response.stream, sent_at, timeouts.stream_ttfb, timeouts.stream_idle,
+                                          deadline.current())
+        return response
 
     async def _send_request(self,
                             method: str,
                             endpoint: str,
                             data: dict | None = None,
                             params: dict | None = None,
-                            stream: bool = False) -> httpx.Response:
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
-
-        url = f"{self.base_url}{endpoint}"
-
+                            stream: bool = False,
+                            pinned_to: str | None = None) -> httpx.Response:
         if params:
             params = unambiguous(**params)
 
         if data:
             data = unambiguous(**data)
 
-        return await _global_client().send(_global_client().build_request(method,
-                                                                          url,
-                                                                          json=data,
-                                                                          headers=headers,
-                                                                          params=params),
-                                           stream=stream)
+        # 缓存未命中、确实要调用上游时才准入
+        await admission.admit_deferred()
 
-    async def _send_request_with_files(self, method: str, endpoint: str, data: dict, files: dict) -> httpx.Response:
-        headers = {"Authorization": f"Bearer {self.api_key}"}
+        # 会话、消息和任务固定在创建它们的密钥上
+        for arguments in (data, params):
+            for name in ("conversation_id", "message_id"):
+                pinned_to = pinned_to or (arguments or {}).get(name)
 
-        url = f"{self.base_url}{endpoint}"
-        return await _global_client().request(method, url, data=data, headers=headers, files=files)
-
-    async def file_upload(self, user: str, files: dict) -> httpx.Response:
+        async def attempt() -> httpx.Response:
+            slot = self.keys.acquire(pinned_to)
+            headers = {
+                "Authorization": f"Bearer {slot.api_key}",
+                "Content-Type": "application/json",
+            }
+            request = _global_client().build_request(method,
+                                                     f"{slot.base_url}{endpoint}",
+                                                     json=data,
+                                                     headers=headers,
+                                                     params=params,
+                                                     timeout=request_timeout(method, stream))
+            return await self._send(slot, request, stream)
+
+        async def send() -> httpx.Response:
+            return await resilient(self.name or self.base_url, method, endpoint, attempt, stream=stream)
+
+        if method == "GET" and not stream and get_config().http.coalesce:
+            # 失效之后开始的读取不能搭上失效之前发出的请求
+            key = (self.api_key, method, endpoint, tuple(sorted((params or {}).items())), read_generations())
+            return await single_flight.do(key, send)
+        return await send()
+
+    async def _send_request_with_files(self,
+                                       method: str,
+                                       endpoint: str,
+                                       data: dict,
+                                       files: dict,
+                                       limits: dict[str, int] | None = None,
+                                       sizes: dict[str, int | None] | None = None) -> httpx.Response:
+        body = MultipartStream(data, files, limits=limits, sizes=sizes, chunk_size=get_config().upload.chunk_size)
+
+        async def attempt() -> httpx.Response:
+            slot = self.keys.acquire()
+            headers = {"Authorization": f"Bearer {slot.api_key}", **body.headers}
+            url = f"{slot.base_url}{endpoint}"
+            request = _global_client().build_request(method,
+                                                     url,
+                                                     headers=headers,
+                                                     content=body,
+                                                     timeout=request_timeout(method, upload=True))
+            return await self._send(slot, request, False)
+
+        # 上传的请求体只能读一次，只熔断不重试
+        return await resilient(self.name or self.base_url, method, endpoint, attempt, replayable=False)
+
+    async def file_upload(self,
+                          user: str,
+                          files: dict,
+                          limits: dict[str, int] | None = None,
+                          sizes: dict[str, int | None] | None = None) -> httpx.Response:
         data = {"user": user}
-        return await self._send_request_with_files("POST", "/files/upload", data=data, files=files)
+        return await self._send_request_with_files("POST",
+                                                   "/files/upload",
+                                                   data=data,
+                                                   files=files,
+                                                   limits=limits,
+                                                   sizes=sizes)
 
-    async def text_to_audio(self, message_id: str, text: str, user: str):
-        data = {"message_id": message_id, "text": text, "user": user}
-        return await self._send_request("POST", "/text-to-audio", data=data)
+    async def text_to_audio(self, message_id: str, text: str, user: str, voice: str | None = None):
+        data = {"message_id": message_id, "text": text, "user": user, "voice": voice}
+        return await self._send_request("POST", "/text-to-audio", data=data, stream=True)
 
     async def get_meta(self, user):
         params = {"user": user}
         return await self._send_request("GET", "/meta", params=params)
 
+    @invalidates(messages="user")
     async def create_feedbacks(self, message_id: str, rating: str, user: str, content: str):
         data = {"rating": rating, "user": user, "content": content}
-        return await self._send_request("POST", f"/messages/{message_id}/feedbacks", data=data)
+        return await self._send_request("POST", f"/messages/{message_id}/feedbacks", data=data, pinned_to=message_id)
 
 
 class CompletionClient(DifyClient):
@@ -123,6 +271,7 @@ class CompletionClient(DifyClient):
 
 class ChatClient(DifyClient):
 
+    @invalidates(conversations="user", messages="conversation_id")
     async def create_chat_message(
         self,
         inputs: dict,
@@ -149,14 +298,16 @@ class ChatClient(DifyClient):
             stream=True if response_mode == "streaming" else False,
         )
 
+    @cached("suggested", "message_id", "user")
     async def get_suggested(self, message_id, user: str):
         params = {"user": user}
-        return await self._send_request("GET", f"/messages/{message_id}/suggested", params=params)
+        return await self._send_request("GET", f"/messages/{message_id}/suggested", params=params, pinned_to=message_id)
 
     async def stop_message(self, task_id, user):
         data = {"user": user}
-        return await self._send_request("POST", f"/chat-messages/{task_id}/stop", data)
+        return await self._send_request("POST", f"/chat-messages/{task_id}/stop", data, pinned_to=task_id)
 
+    @cached("conversations", "user")
     async def get_conversations(self,
                                 user: str,
                                 last_id: str | None = None,
@@ -165,6 +316,7 @@ class ChatClient(DifyClient):
         params = {"user": user, "last_id": last_id, "limit": limit, "pinned": pinned}
         return await self._send_request("GET", "/conversations", params=params)
 
+    @cached("messages", "user", "conversation_id")
     async def get_conversation_messages(self,
                                         user: str,
                                         conversation_id: str | None = None,
@@ -181,34 +333,70 @@ class ChatClient(DifyClient):
 
         return await self._send_request("GET", "/messages", params=params)
 
+    @invalidates(conversations="user")
     async def rename_conversation(self, conversation_id, name, auto_generate: bool, user: str):
         data = {"name": name, "auto_generate": auto_generate, "user": user}
-        return await self._send_request("POST", f"/conversations/{conversation_id}/name", data)
+        return await self._send_request("POST",
+                                        f"/conversations/{conversation_id}/name",
+                                        data,
+                                        pinned_to=conversation_id)
 
+    @invalidates(conversations="user", messages="conversation_id")
     async def delete_conversation(self, conversation_id, user):
         data = {"user": user}
-        return await self._send_request("DELETE", f"/conversations/{conversation_id}", data)
+        return await self._send_request("DELETE", f"/conversations/{conversation_id}", data, pinned_to=conversation_id)
 
-    async def audio_to_text(self, audio_file, user):
+    async def audio_to_text(self, audio_file, user, limit: int | None = None, size: int | None = None):
         data = {"user": user}
         files = {"audio_file": audio_file}
-        return await self._send_request_with_files("POST", "/audio-to-text", data, files)
+        return await self._send_request_with_files("POST",
+                                                   "/audio-to-text",
+                                                   data,
+                                                   files,
+                                                   limits={"audio_file": limit},
+                                                   sizes={"audio_file": size})
 
 
 class WorkflowClient(DifyClient):
 
     async def run(self, inputs: dict, response_mode: str = "streaming", user: str = "abc-123"):
         data = {"inputs": inputs, "response_mode": response_mode, "user": user}
-        return await self._send_request("POST", "/workflows/run", data)
+        return await self._send_request("POST", "/workflows/run", data, stream=response_mode == "streaming")
+
+    async def run_events(self, inputs: dict, user: str = "abc-123") -> AsyncIterator[BaseModel]:
+        """
+        Run the workflow in streaming mode and yield its typed events (``WorkflowStartedEvent``,
+        ``NodeFinishedEvent``, ``MessageEvent``...) as each one arrives; pings and tts chunks are skipped, and so are
+        event types the models do not know yet.
+
+        The response is closed when the iteration ends or is abandoned. A failed run raises ``httpx.HTTPStatusError``
+        before the first event.
+        """
+        response = await self.run(inputs, "streaming", user)
+        if not response.is_success:
+            await response.aread()
+            await response.aclose()
+            response.raise_for_status()
+        async for event in iter_events(response, workflow_decoder):
+            yield event
 
     async def stop(self, task_id, user):
         data = {"user": user}
-        return await self._send_request("POST", f"/workflows/tasks/{task_id}/stop", data)
+        return await self._send_request("POST", f"/workflows/tasks/{task_id}/stop", data, pinned_to=task_id)
 
     async def get_result(self, workflow_run_id):
         return await self._send_request("GET", f"/workflows/run/{workflow_run_id}")
 
 
+def _open_sized(file_path) -> tuple[BinaryIO, int]:
+    file = open(file_path, "rb")
+    try:
+        return file, os.fstat(file.fileno()).st_size
+    except BaseException:
+        file.close()
+        raise
+
+
 class KnowledgeBaseClient(DifyClient):
 
     def __init__(
@@ -280,7 +468,7 @@ class KnowledgeBaseClient(DifyClient):
         }
         if extra_params is not None and isinstance(extra_params, dict):
             data.update(extra_params)
-        url = f"/datasets/{self._get_dataset_id()}/document/create_by_text"
+        url = f"/datasets/{await self._get_dataset_id()}/document/create_by_text"
         return await self._send_request("POST", url, json=data, **kwargs)
 
     async def update_document_by_text(self, document_id, name, text, extra_params: dict | None = None, **kwargs):
@@ -313,7 +501,7 @@ class KnowledgeBaseClient(DifyClient):
         data = {"name": name, "text": text}
         if extra_params is not None and isinstance(extra_params, dict):
             data.update(extra_params)
-        url = (f"/datasets/{self._get_dataset_id()}/documents/{document_id}/update_by_text")
+        url = (f"/datasets/{await self._get_dataset_id()}/documents/{document_id}/update_by_text")
         return await self._send_request("POST", url, json=data, **kwargs)
 
     async def create_document_by_file(self, file_path, original_document_id=None, extra_params: dict | None = None):
@@ -342,7 +530,6 @@ class KnowledgeBaseClient(DifyClient):
         }
         :return: Response from the API
         """
-        files = {"file": open(file_path, "rb")}
         data = {
             "process_rule": {
                 "mode": "automatic"
@@ -353,8 +540,8 @@ class KnowledgeBaseClient(DifyClient):
             data.update(extra_params)
         if original_document_id is not None:
             data["original_document_id"] = original_document_id
-        url = f"/datasets/{self._get_dataset_id()}/document/create_by_file"
-        return await self._send_request_with_files("POST", url, {"data": json.dumps(data)}, files)
+        url = f"/datasets/{await self._get_dataset_id()}/document/create_by_file"
+        return await self._send_file(url, data, file_path)
 
     async def update_document_by_file(self, document_id, file_path, extra_params: dict | None = None):
         """
@@ -382,12 +569,37 @@ class KnowledgeBaseClient(DifyClient):
         }
         :return:
         """
-        files = {"file": open(file_path, "rb")}
         data = {}
         if extra_params is not None and isinstance(extra_params, dict):
             data.update(extra_params)
-        url = (f"/datasets/{self._get_dataset_id()}/documents/{document_id}/update_by_file")
-        return await self._send_request_with_files("POST", url, {"data": json.dumps(data)}, files)
+        url = (f"/datasets/{await self._get_dataset_id()}/documents/{document_id}/update_by_file")
+        return await self._send_file(url, data, file_path)
+
+    async def _send_file(self, url: str, data: dict, file_path) -> httpx.Response:
+        # 在线程中打开、分块读取，请求结束就关闭，批量导入时文件描述符不会越积越多
+        file, size = await asyncio.to_thread(_open_sized, file_path)
+        try:
+            return await self._send_request_with_files("POST",
+                                                       url, {"data": json.dumps(data)}, {"file": file},
+                                                       sizes={"file": size})
+        finally:
+            file.close()
+
+    def ingest(self,
+               source: str | os.PathLike | Iterable | AsyncIterable,
+               extra_params: dict | None = None,
+               patterns: Iterable[str] | None = None) -> AsyncIterator[IngestEvent]:
+        """
+        Upload every file of a directory, or of an iterator of paths, into this dataset and follow their indexing.
+
+        See ``app.internal.dify.ingest.ingest``, the settings are the ``ingest`` config section.
+
+        :param source: directory walked recursively, or a sync or async iterable of file paths
+        :param extra_params: extra parameters of every document, as in ``create_document_by_file``
+        :param patterns: glob patterns the file names of a directory must match, all files when omitted
+        :return: progress events, the last one is ``done``
+        """
+        return ingest(self, source, extra_params, patterns)
 
     async def batch_indexing_status(self, batch_id: str, **kwargs):
         """
@@ -396,7 +608,7 @@ class KnowledgeBaseClient(DifyClient):
         :param batch_id: ID of the batch uploading
         :return: Response from the API
         """
-        url = f"/datasets/{self._get_dataset_id()}/documents/{batch_id}/indexing-status"
+        url = f"/datasets/{await self._get_dataset_id()}/documents/{batch_id}/indexing-status"
         return await self._send_request("GET", url, **kwargs)
 
     async def delete_dataset(self):
@@ -405,7 +617,7 @@ class KnowledgeBaseClient(DifyClient):
 
         :return: Response from the API
         """
-        url = f"/datasets/{self._get_dataset_id()}"
+        url = f"/datasets/{await self._get_dataset_id()}"
         return await self._send_request("DELETE", url)
 
     async def delete_document(self, document_id):
@@ -415,7 +627,7 @@ class KnowledgeBaseClient(DifyClient):
         :param document_id: ID of the document
         :return: Response from the API
         """
-        url = f"/datasets/{self._get_dataset_id()}/documents/{document_id}"
+        url = f"/datasets/{await self._get_dataset_id()}/documents/{document_id}"
         return await self._send_request("DELETE", url)
 
     async def list_documents(
@@ -437,7 +649,7 @@ class KnowledgeBaseClient(DifyClient):
             params["limit"] = page_size
         if keyword is not None:
             params["keyword"] = keyword
-        url = f"/datasets/{self._get_dataset_id()}/documents"
+        url = f"/datasets/{await self._get_dataset_id()}/documents"
         return await self._send_request("GET", url, params=params, **kwargs)
 
     async def add_segments(self, document_id: str, segments: list[dict], **kwargs) -> httpx.Response:
@@ -449,7 +661,7 @@ class KnowledgeBaseClient(DifyClient):
         :return: Response from the API
         """
         data = {"segments": segments}
-        url = f"/datasets/{self._get_dataset_id()}/documents/{document_id}/segments"
+        url = f"/datasets/{await self._get_dataset_id()}/documents/{document_id}/segments"
         return await self._send_request("POST", url, json=data, **kwargs)
 
     async def query_segments(
@@ -466,7 +678,7 @@ class KnowledgeBaseClient(DifyClient):
         :param keyword: query keyword, optional
         :param status: status of the segment, optional, e.g. completed
         """
-        url = f"/datasets/{self._get_dataset_id()}/documents/{document_id}/segments"
+        url = f"/datasets/{await self._get_dataset_id()}/documents/{document_id}/segments"
         params = {}
         if keyword is not None:
             params["keyword"] = keyword
@@ -484,7 +696,7 @@ class KnowledgeBaseClient(DifyClient):
         :param segment_id: ID of the segment
         :return: Response from the API
         """
-        url = f"/datasets/{self._get_dataset_id()}/documents/{document_id}/segments/{segment_id}"
+        url = f"/datasets/{await self._get_dataset_id()}/documents/{document_id}/segments/{segment_id}"
         return await self._send_request("DELETE", url)
 
     async def update_document_segment(self, document_id, segment_id, segment_data, **kwargs):
@@ -497,5 +709,5 @@ class KnowledgeBaseClient(DifyClient):
         :return: Response from the API
         """
         data = {"segment": segment_data}
-        url = f"/datasets/{self._get_dataset_id()}/documents/{document_id}/segments/{segment_id}"
+        url = f"/datasets/{await self._get_dataset_id()}/documents/{document_id}/segments/{segment_id}"
         return await self._send_request("POST", url, json=data, **kwargs)
@@ -0,0 +1,71 @@
+import asyncio
+from typing import Awaitable, Callable
+import httpx
+from app.internal.dify.cache import CachedResponse
+from app.internal.metrics import registry
+
+
+class _LeaderCancelled(Exception):
+    pass
+
+
+class SingleFlight:
+    """
+    Coalesce identical in-flight upstream calls: the first caller (leader) sends the request, callers arriving
+    before it completes (followers) wait for the same result and get their own copy of the response.
+
+    Nothing is kept once the call completes, so coalescing never serves stale data.
+    """
+
+    def __init__(self):
+        self._calls: dict[tuple, asyncio.Future] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: tuple, call: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        future = self._calls.get(key)
+        if future is not None:
+            self.followers += 1
+            try:
+                snapshot = await asyncio.shield(future)
+            except _LeaderCancelled:
+                return await call()
+            return snapshot.to_response()
+
+        future = asyncio.get_running_loop().create_future()
+        # 没有 follower 时也要取走异常，避免 "exception was never retrieved"
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+        self.leaders += 1
+        try:
+            response = await call()
+            await response.aread()
+            future.set_result(CachedResponse.snapshot(response, ttl=0, tags=frozenset()))
+            return response
+        except asyncio.CancelledError:
+            future.set_exception(_LeaderCancelled())
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._calls.pop(key, None)
+
+    def stats(self) -> dict:
+        total = self.leaders + self.followers
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "coalesce_rate": self.followers / total if total else 0.0,
+        }
+
+
+single_flight = SingleFlight()
+
+registry.counter_func("dify_coalesced_requests_total",
+                      "Upstream GETs that sent the request (leader) or shared an in-flight one (follower)", ("role", ),
+                      collect=lambda: {
+                          ("leader", ): single_flight.leaders,
+                          ("follower", ): single_flight.followers
+                      })
@@ -0,0 +1,14 @@
+class UpstreamUnavailableError(Exception):
+    """
+    Raised before calling Dify when the request cannot be sent right now, answered with a 503.
+
+    :param retry_after: seconds the caller should wait before retrying, sent as ``Retry-After``
+    """
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(Exception):
+    """Raised when the caller's deadline passed before Dify answered, answered with a 504."""
@@ -0,0 +1,273 @@
+import asyncio
+import fnmatch
+import os
+import time
+from dataclasses import dataclass, field, asdict
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator
+from app.internal.config import get_config
+from app.internal.logging import logger
+from app.internal.metrics import registry
+from app.internal.dify.multipart import UploadTooLargeError
+
+# indexing-status 中表示已结束的状态
+_FINISHED = {"completed", "error", "paused", "stopped"}
+# 在线程中遍历目录时每次取出的路径数
+_WALK_BATCH = 64
+
+
+@dataclass
+class IngestStats:
+    started_at: float = field(default_factory=time.monotonic)
+    uploaded: int = 0
+    indexed: int = 0
+    failed: int = 0
+    bytes: int = 0
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def as_dict(self) -> dict:
+        elapsed = self.elapsed
+        return {
+            "uploaded": self.uploaded,
+            "indexed": self.indexed,
+            "failed": self.failed,
+            "bytes": self.bytes,
+            "elapsed": elapsed,
+            "docs_per_second": self.indexed / elapsed if elapsed > 0 else 0.0,
+            "upload_docs_per_second": self.uploaded / elapsed if elapsed > 0 else 0.0,
+            "mb_per_second": self.bytes / 1024 / 1024 / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+@dataclass
+class IngestEvent:
+    """
+    One step of a bulk ingestion.
+
+    ``event`` is ``uploaded``, ``indexing`` (segments progressed), ``indexed``, ``failed`` or, last of all, ``done``;
+    ``stats`` holds the totals and throughput of the whole run at that moment.
+    """
+    event: str
+    stats: dict
+    path: str | None = None
+    document_id: str | None = None
+    batch: str | None = None
+    status: str | None = None
+    completed_segments: int | None = None
+    total_segments: int | None = None
+    error: str | None = None
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def _walk(directory: str, patterns: list[str] | None) -> Iterator[str]:
+    # 用栈代替递归，只持有当前目录的 scandir 句柄
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file() and (not patterns or any(fnmatch.fnmatch(entry.name, p) for p in patterns)):
+                    yield entry.path
+
+
+def _take(iterator: Iterator[str], count: int) -> list[str]:
+    return [path for _, path in zip(range(count), iterator)]
+
+
+async def _paths(source, patterns: Iterable[str] | None) -> AsyncIterator[str]:
+    if isinstance(source, (str, os.PathLike)):
+        iterator = _walk(os.fspath(source), list(patterns) if patterns else None)
+        while paths := await asyncio.to_thread(_take, iterator, _WALK_BATCH):
+            for path in paths:
+                yield path
+    elif isinstance(source, AsyncIterable):
+        async for path in source:
+            yield os.fspath(path)
+    else:
+        for path in source:
+            yield os.fspath(path)
+
+
+class _Ingestion:
+
+    def __init__(self, client, source, extra_params: dict | None, patterns: Iterable[str] | None):
+        self.client = client
+        self.extra_params = extra_params
+        self.config = get_config().ingest
+        self.limit = get_config().upload.limit_for("document")
+        self.paths = _paths(source, patterns)
+        self.paths_lock = asyncio.Lock()
+        self.indexing = asyncio.Semaphore(self.config.max_indexing)
+        # 消费方读得慢时上传和轮询都会停下来等它
+        self.events: asyncio.Queue = asyncio.Queue(maxsize=self.config.concurrency * 4)
+        self.pollers: set[asyncio.Task] = set()
+        self.stats = IngestStats()
+
+    async def emit(self, event: str, **kwargs):
+        await self.events.put(IngestEvent(event, self.stats.as_dict(), **kwargs))
+
+    async def next_path(self) -> str | None:
+        async with self.paths_lock:
+            return await anext(self.paths, None)
+
+    async def upload_worker(self):
+        while True:
+            await self.indexing.acquire()
+            path = await self.next_path()
+            if path is None:
+                self.indexing.release()
+                return
+            if not await self.upload(path):
+                self.indexing.release()
+
+    async def upload(self, path: str) -> bool:
+        try:
+            size = (await asyncio.to_thread(os.stat, path)).st_size
+            if self.limit is not None and size > self.limit:
+                raise UploadTooLargeError(os.path.basename(path), self.limit)
+            response = await self.client.create_document_by_file(path, extra_params=self.extra_params)
+            response.raise_for_status()
+            body = response.json()
+            document_id, batch = body["document"]["id"], body["batch"]
+        except Exception as e:
+            # 单个文件的任何错误都只算这个文件失败，不能中断整个导入
+            logger.error(f"failed to upload {path} to dataset {self.client.dataset_id}: {e!r}")
+            self.stats.failed += 1
+            ingest_documents.inc("failed")
+            await self.emit("failed", path=path, error=str(e))
+            return False
+        self.stats.uploaded += 1
+        self.stats.bytes += size
+        ingest_documents.inc("uploaded")
+        ingest_bytes.inc(amount=size)
+        await self.emit("uploaded", path=path, document_id=document_id, batch=batch)
+        poller = asyncio.create_task(self.poll(path, document_id, batch))
+        self.pollers.add(poller)
+        poller.add_done_callback(self.pollers.discard)
+        return True
+
+    async def poll(self, path: str, document_id: str, batch: str):
+        """
+        Follow one document until Dify finished indexing it. The interval grows by ``poll_backoff`` up to ``poll_max``
+        while nothing changes and drops back to ``poll_interval`` once segments progress.
+        """
+        try:
+            interval = self.config.poll_interval
+            errors = 0
+            completed = None
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    response = await self.client.batch_indexing_status(batch)
+                    response.raise_for_status()
+                    status = next((item for item in response.json()["data"] if item.get("id") == document_id), None)
+                    if status is None:
+                        raise ValueError(f"document {document_id} not in batch {batch}")
+                except Exception as e:
+                    errors += 1
+                    if errors >= self.config.poll_errors:
+                        await self.finish("failed", path, document_id, batch, error=f"indexing status unknown: {e}")
+                        return
+                    interval = self.config.poll_max
+                    continue
+                errors = 0
+                segments = {
+                    "completed_segments": status.get("completed_segments"),
+                    "total_segments": status.get("total_segments"),
+                }
+                state = status.get("indexing_status")
+                if state in _FINISHED:
+                    await self.finish("indexed" if state == "completed" else "failed",
+                                      path,
+                                      document_id,
+                                      batch,
+                                      status=state,
+                                      error=status.get("error"),
+                                      **segments)
+                    return
+                if segments["completed_segments"] != completed:
+                    completed = segments["completed_segments"]
+                    interval = self.config.poll_interval
+                    await self.emit("indexing",
+                                    path=path,
+                                    document_id=document_id,
+                                    batch=batch,
+                                    status=state,
+                                    **segments)
+                else:
+                    interval = min(interval * self.config.poll_backoff, self.config.poll_max)
+        except Exception as e:
+            # 意外的错误也只让这个文档失败，轮询任务出错会让整个导入中止
+            await self.finish("failed", path, document_id, batch, error=repr(e))
+        finally:
+            self.indexing.release()
+
+    async def finish(self, event: str, path: str, document_id: str, batch: str, **kwargs):
+        if event == "indexed":
+            self.stats.indexed += 1
+        else:
+            self.stats.failed += 1
+            logger.error(f"failed to index {path} as document {document_id}: {kwargs.get('error')}")
+        ingest_documents.inc(event)
+        await self.emit(event, path=path, document_id=document_id, batch=batch, **kwargs)
+
+    async def run(self):
+        workers = [asyncio.create_task(self.upload_worker()) for _ in range(self.config.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+            # 上传全部结束后不会再有新的轮询任务
+            while self.pollers:
+                await asyncio.gather(*self.pollers)
+        finally:
+            for task in (*workers, *self.pollers):
+                task.cancel()
+            await self.paths.aclose()
+        await self.emit("done")
+
+
+async def ingest(client,
+                 source: str | os.PathLike | Iterable | AsyncIterable,
+                 extra_params: dict | None = None,
+                 patterns: Iterable[str] | None = None) -> AsyncIterator[IngestEvent]:
+    """
+    Bulk upload files into ``client``'s dataset, yielding progress as documents are uploaded and indexed.
+
+    Paths are pulled from ``source`` only when an upload slot is free, so a directory of any size or an endless
+    iterator costs the same memory. At most ``concurrency`` files are open and being read, in chunks off the event
+    loop, at a time, and uploading pauses while ``max_indexing`` documents are still being indexed by Dify. A
+    document that fails to upload or to index is reported and the run goes on.
+
+    Stopping the iteration early cancels the uploads and polls still running.
+    """
+    ingestion = _Ingestion(client, source, extra_params, patterns)
+    runner = asyncio.create_task(ingestion.run())
+    try:
+        while True:
+            getter = asyncio.ensure_future(ingestion.events.get())
+            await asyncio.wait((getter, runner), return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                # 正常结束时最后放入的是 done 事件，getter 一定已经拿到，这里只可能是出错退出
+                runner.result()
+                return
+            event = getter.result()
+            yield event
+            if event.event == "done":
+                return
+    finally:
+        if not runner.done():
+            runner.cancel()
+            try:
+                await runner
+            except asyncio.CancelledError:
+                pass
+
+
+ingest_documents = registry.counter("dify_ingest_documents_total", "Documents handled by knowledge base bulk ingestion",
+                                    ("result", ))
+ingest_bytes = registry.counter("dify_ingest_bytes_total", "File bytes uploaded by knowledge base bulk ingestion")
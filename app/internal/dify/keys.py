@@ -0,0 +1,283 @@
+import hashlib
+import re
+import time
+from typing import Callable
+from collections import OrderedDict
+import httpx
+from app.internal.config import ModelConfig
+from app.internal.dify.errors import UpstreamUnavailableError
+from app.internal.logging import logger
+from app.internal.shared_log import SharedLog
+
+# 响应中的这些 id 把之后针对同一会话、消息或任务的请求固定到同一个密钥
+_PINNED_ID = re.compile(rb'"(conversation_id|message_id|task_id)"\s*:\s*"([^"\\]+)"')
+_PINNED_FIELDS = 3
+# 只在响应开头这么多字节中查找
+_PIN_SCAN_BYTES = 64 * 1024
+
+
+class KeySlot:
+
+    def __init__(self, api_key: str, base_url: str, max_in_flight: int = 0):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.evicted_until = 0.0
+
+    @property
+    def full(self) -> bool:
+        return 0 < self.max_in_flight <= self.in_flight
+
+    @property
+    def load(self) -> float:
+        return self.in_flight / self.max_in_flight if self.max_in_flight else self.in_flight
+
+    @property
+    def fingerprint(self) -> str:
+        # 固定记录里用它标识密钥，不把明文密钥写到磁盘上
+        return hashlib.sha256(f"{self.api_key}\0{self.base_url}".encode("utf-8")).hexdigest()[:16]
+
+    @property
+    def label(self) -> str:
+        # 只露出密钥末尾几位
+        return f"...{self.api_key[-4:]}" if self.api_key else "none"
+
+    def as_dict(self) -> dict:
+        return {
+            "key": self.label,
+            "base_url": self.base_url,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "evicted_for": max(self.evicted_until - time.monotonic(), 0.0),
+        }
+
+
+class KeyPool:
+    """
+    The API keys of one Dify app, picked per request.
+
+    A request goes to the least loaded key that is neither at its ``max_in_flight`` cap nor evicted; a key is
+    evicted for ``evict_seconds`` (or the upstream ``Retry-After``) after a 429, a 5xx or a transport error. When
+    every key is evicted the one coming back first is used rather than failing.
+
+    Conversations, messages and tasks stay on the key that created them: the ``conversation_id``, ``message_id`` and
+    ``task_id`` seen at the start of a response pin them, and requests for a pinned id never move to another key, which
+    may belong to another deployment.
+
+    With ``pins_path`` the pins are also appended to a ``SharedLog``, so the worker processes of ``serve`` and the
+    process after a restart send follow-ups to the same key. An id not pinned in memory is looked up in what the
+    other workers appended since the last lookup. The file is compacted to the latest ``max_pins`` pins once it
+    holds twice as many.
+
+    :param slots: the keys, usually from ``KeyPool.from_config``
+    :param evict_seconds: default eviction when upstream does not send ``Retry-After``
+    :param max_pins: pinned ids kept, least recently used ones are forgotten first
+    :param pins_path: file the pins are shared through, only useful with more than one key
+    """
+
+    def __init__(self,
+                 slots: list[KeySlot],
+                 evict_seconds: float = 30,
+                 max_pins: int = 10000,
+                 pins_path: str | None = None):
+        self.slots = slots
+        self.evict_seconds = evict_seconds
+        self.max_pins = max_pins
+        self._pins: OrderedDict[str, KeySlot] = OrderedDict()
+        self._pin_log = SharedLog(pins_path) if pins_path else None
+        self._by_fingerprint = {slot.fingerprint: slot for slot in slots}
+        # 固定记录文件中的记录数，超过 max_pins 的两倍时压缩
+        self._logged_pins = 0
+
+    @classmethod
+    def from_config(cls, model_config: ModelConfig, pins_path: str | None = None) -> "KeyPool":
+        slots = [
+            KeySlot(api_key, base_url, model_config.max_in_flight) for api_key, base_url in model_config.endpoints()
+        ]
+        # 只有一个密钥时无处可偏离，不需要记录
+        return cls(slots, evict_seconds=model_config.evict_seconds, pins_path=pins_path if len(slots) > 1 else None)
+
+    @property
+    def endpoints(self) -> list[tuple[str, str]]:
+        return [(slot.api_key, slot.base_url) for slot in self.slots]
+
+    def acquire(self, pinned_to: str | None = None) -> KeySlot:
+        """
+        :param pinned_to: conversation, message or task id of the request, its key is used if it was pinned
+        """
+        pinned = self._pins.get(pinned_to) if pinned_to else None
+        if pinned is None and pinned_to and self._pin_log is not None:
+            self._read_pins()
+            pinned = self._pins.get(pinned_to)
+        if pinned is not None:
+            self._pins.move_to_end(pinned_to)
+            if pinned.full:
+                raise UpstreamUnavailableError(f"the key of {pinned_to} is at capacity", retry_after=1)
+            slot = pinned
+        else:
+            candidates = [slot for slot in self.slots if not slot.full]
+            if not candidates:
+                raise UpstreamUnavailableError("every api key is at capacity", retry_after=1)
+            now = time.monotonic()
+            healthy = [slot for slot in candidates if slot.evicted_until <= now]
+            if healthy:
+                slot = min(healthy, key=lambda slot: (slot.load, slot.requests))
+            else:
+                slot = min(candidates, key=lambda slot: slot.evicted_until)
+        slot.in_flight += 1
+        slot.requests += 1
+        return slot
+
+    def release(self, slot: KeySlot, failed: bool = False, retry_after: float | None = None):
+        slot.in_flight -= 1
+        if failed:
+            slot.failures += 1
+            slot.evicted_until = time.monotonic() + (retry_after if retry_after is not None else self.evict_seconds)
+            logger.warning(f"api key {slot.label} evicted for {slot.evicted_until - time.monotonic():.0f}s")
+
+    def pin(self, pinned_id: str, slot: KeySlot):
+        if self._pins.get(pinned_id) is slot:
+            return
+        self._remember(pinned_id, slot)
+        if self._pin_log is not None:
+            self._write_pin(pinned_id, slot)
+
+    def _remember(self, pinned_id: str, slot: KeySlot):
+        self._pins[pinned_id] = slot
+        self._pins.move_to_end(pinned_id)
+        while len(self._pins) > self.max_pins:
+            self._pins.popitem(last=False)
+
+    def _write_pin(self, pinned_id: str, slot: KeySlot):
+        # 一次加锁的短小追加，在事件循环里直接写；后续请求可能马上落到别的 worker，不能攒着批量写
+        try:
+            self._pin_log.append(f"{pinned_id}\t{slot.fingerprint}\n".encode("utf-8"))
+        except OSError as e:
+            logger.error(f"failed to share the pin of {pinned_id}: {e}")
+            return
+        self._logged_pins += 1
+        if self._logged_pins > 2 * self.max_pins:
+            self._compact_pins()
+
+    def _read_pins(self):
+        try:
+            data, reset = self._pin_log.read_new()
+        except OSError as e:
+            logger.error(f"failed to read shared pins: {e}")
+            return
+        self._apply_pins(data, reset)
+
+    def _apply_pins(self, data: bytes, reset: bool):
+        if reset:
+            self._logged_pins = 0
+        for line in data.splitlines():
+            pinned_id, _, fingerprint = line.decode("utf-8", "replace").partition("\t")
+            self._logged_pins += 1
+            slot = self._by_fingerprint.get(fingerprint)
+            # 配置改过之后，记录里可能是已经不在池中的密钥
+            if slot is not None:
+                self._remember(pinned_id, slot)
+
+    def _compact_pins(self):
+
+        def rewrite(whole: bytes) -> bytes:
+            latest: OrderedDict[bytes, bytes] = OrderedDict()
+            for line in whole.splitlines():
+                pinned_id, _, fingerprint = line.partition(b"\t")
+                latest[pinned_id] = fingerprint
+                latest.move_to_end(pinned_id)
+            kept = list(latest.items())[-self.max_pins:]
+            return b"".join(pinned_id + b"\t" + fingerprint + b"\n" for pinned_id, fingerprint in kept)
+
+        try:
+            data, reset = self._pin_log.compact(rewrite)
+        except OSError as e:
+            logger.error(f"failed to compact shared pins: {e}")
+            return
+        self._apply_pins(data, reset)
+        self._logged_pins = min(self._logged_pins, self.max_pins)
+
+    def track(self,
+              slot: KeySlot,
+              response: httpx.Response,
+              on_close: Callable[[], None] | None = None) -> httpx.Response:
+        """
+        Release ``slot`` once ``response`` is closed, judging the key by its status and pinning the ids it returns.
+
+        :param on_close: also called once the response is closed
+        """
+        status = response.status_code
+        failed = status == 429 or status >= 500
+        retry_after = parse_retry_after(response) if failed else None
+        if response.is_stream_consumed or response.is_closed:
+            self.release(slot, failed, retry_after)
+            self._pin_from(response.content[:_PIN_SCAN_BYTES], slot)
+            if on_close is not None:
+                on_close()
+        else:
+            response.stream = _TrackedStream(response.stream, self, slot, failed, retry_after, on_close)
+        return response
+
+    def _pin_from(self, data: bytes, slot: KeySlot) -> set[bytes]:
+        """Pin every id found in ``data`` to ``slot``, returning the names of the fields found."""
+        fields = set()
+        for matched in _PINNED_ID.finditer(data):
+            fields.add(matched.group(1))
+            self.pin(matched.group(2).decode("utf-8"), slot)
+        return fields
+
+    def stats(self) -> dict:
+        return {"pinned": len(self._pins), "keys": [slot.as_dict() for slot in self.slots]}
+
+
+def parse_retry_after(response: httpx.Response) -> float | None:
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+
+    def __init__(self,
+                 stream: httpx.AsyncByteStream,
+                 pool: KeyPool,
+                 slot: KeySlot,
+                 failed: bool,
+                 retry_after: float | None,
+                 on_close: Callable[[], None] | None = None):
+        self.stream = stream
+        self.on_close = on_close
+        self.pool = pool
+        self.slot = slot
+        self.failed = failed
+        self.retry_after = retry_after
+        self.fields: set[bytes] = set()
+        self.scanned = 0
+        self.released = False
+        # id 可能跨分片，保留上一片的末尾
+        self._tail = b""
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            if len(self.fields) < _PINNED_FIELDS and self.scanned < _PIN_SCAN_BYTES:
+                window = self._tail + chunk
+                self.fields |= self.pool._pin_from(window, self.slot)
+                self.scanned += len(chunk)
+                self._tail = window[-128:]
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                self.pool.release(self.slot, self.failed, self.retry_after)
+                if self.on_close is not None:
+                    self.on_close()
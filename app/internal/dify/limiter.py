@@ -0,0 +1,129 @@
+import time
+from app.internal.config import get_config, LimiterConfig
+from app.internal.dify.errors import UpstreamUnavailableError
+from app.internal.logging import logger
+from app.internal.metrics import registry
+
+limiter_shed = registry.counter("dify_limiter_shed_total", "Upstream calls refused because the limit was reached",
+                                ("client", ))
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the upstream calls of one client name that are in flight at once.
+
+    Each call reports its time to response headers. The limit grows by ``1 / limit`` per call that comes back fast
+    while the limit is actually used, so by about one per round of calls, and is multiplied by ``backoff`` when a
+    call fails (429, 5xx, transport error) or takes longer than ``latency_tolerance`` times the baseline. The
+    baseline is the fastest recent response, re-measured every ``baseline_window`` seconds so it follows a slower
+    upstream instead of pinning the limit down for good. At most one decrease happens per recent latency, so a
+    burst of slow responses from the same moment only counts once.
+
+    Calls over the limit are refused right away with a 503 instead of queueing into the read timeout.
+    """
+
+    def __init__(self, name: str, config: LimiterConfig):
+        self.name = name
+        self.config = config
+        self.limit = float(config.initial_limit)
+        self.in_flight = 0
+        self.baseline: float | None = None
+        self.recent: float | None = None
+        self._baseline_candidate: float | None = None
+        self._baseline_started_at = time.monotonic()
+        self._last_decrease = 0.0
+        self.requests = 0
+        self.shed = 0
+        self.decreases = 0
+
+    def acquire(self):
+        if self.in_flight >= int(self.limit):
+            self.shed += 1
+            limiter_shed.inc(self.name)
+            raise UpstreamUnavailableError(f"{self.name} is at its upstream concurrency limit of {int(self.limit)}",
+                                           retry_after=1)
+        self.in_flight += 1
+        self.requests += 1
+
+    def release(self):
+        self.in_flight -= 1
+
+    def sample(self, latency: float | None, failed: bool = False):
+        """Feed the outcome of one call, ``latency`` being its time to response headers, None if it had none."""
+        now = time.monotonic()
+        if latency is not None:
+            self._observe(latency, now)
+        congested = failed or (latency is not None and self.baseline is not None
+                               and latency > self.baseline * self.config.latency_tolerance)
+        if congested:
+            if now - self._last_decrease >= (self.recent or 0):
+                self._last_decrease = now
+                self.decreases += 1
+                self.limit = max(self.config.min_limit, self.limit * self.config.backoff)
+                logger.debug("%s upstream limit lowered to %.1f, latency: %s, failed: %s", self.name, self.limit,
+                             latency, failed)
+        elif self.in_flight * 2 >= self.limit:
+            # 只有在确实用到限额时才放大，空闲时不让限额无限增长
+            self.limit = min(self.config.max_limit, self.limit + 1 / self.limit)
+
+    def _observe(self, latency: float, now: float):
+        self.recent = latency if self.recent is None else self.recent * 0.9 + latency * 0.1
+        self._baseline_candidate = min(self._baseline_candidate or latency, latency)
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        if now - self._baseline_started_at >= self.config.baseline_window:
+            self.baseline = self._baseline_candidate
+            self._baseline_candidate = None
+            self._baseline_started_at = now
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "baseline_latency": self.baseline,
+            "recent_latency": self.recent,
+            "requests": self.requests,
+            "shed": self.shed,
+            "decreases": self.decreases,
+        }
+
+
+_limiters: dict[str, AdaptiveLimiter] = {}
+
+
+def get_limiter(name: str) -> AdaptiveLimiter | None:
+    config = get_config().limiter
+    if not config.enabled:
+        return None
+    limiter = _limiters.get(name)
+    if limiter is None:
+        limiter = _limiters[name] = AdaptiveLimiter(name, config)
+    elif limiter.config != config:
+        # 重新加载配置时保留已经学到的限额和延迟
+        limiter.config = config
+        limiter.limit = min(max(limiter.limit, config.min_limit), config.max_limit)
+    return limiter
+
+
+def limiter_stats() -> dict:
+    return {name: limiter.stats() for name, limiter in _limiters.items()}
+
+
+def _collect(attribute: str) -> dict[tuple[str, ...], float]:
+    return {(name, ): getattr(limiter, attribute) for name, limiter in _limiters.items()}
+
+
+registry.gauge("dify_limiter_limit",
+               "Current adaptive limit of in-flight upstream calls", ("client", ),
+               collect=lambda: _collect("limit"))
+registry.gauge("dify_limiter_in_flight",
+               "Upstream calls in flight counted by the limiter", ("client", ),
+               collect=lambda: _collect("in_flight"))
+registry.gauge("dify_limiter_latency_seconds",
+               "Latency estimates driving the limiter", ("client", "estimate"),
+               collect=lambda: {
+                   (name, estimate): value
+                   for name, limiter in _limiters.items()
+                   for estimate, value in (("baseline", limiter.baseline), ("recent", limiter.recent))
+                   if value is not None
+               })
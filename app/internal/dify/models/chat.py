@@ -1,7 +1,7 @@
 from enum import Enum
 from typing import Optional, List, Dict, Any
 from pydantic import BaseModel, Field
-import json
+from .decoder import EventDecoder
 
 
 # 定义事件类型枚举
@@ -33,30 +33,7 @@ class BaseEvent(BaseModel):
     def form_raw(cls, data: str) -> "BaseEvent":
         """从原始数据解析事件"""
         try:
-            if data.startswith("data: "):
-                data = data[6:]
-            event_dict = json.loads(data)
-            event_type = event_dict.get("event")
-
-            # 根据事件类型选择对应的模型
-            event_map = {
-                DifyEventType.MESSAGE.value: MessageEvent,
-                DifyEventType.AGENT_MESSAGE.value: AgentMessageEvent,
-                DifyEventType.AGENT_THOUGHT.value: AgentThoughtEvent,
-                DifyEventType.MESSAGE_FILE.value: MessageFileEvent,
-                DifyEventType.MESSAGE_END.value: MessageEndEvent,
-                DifyEventType.TTS_MESSAGE.value: TTSMessageEvent,
-                DifyEventType.TTS_MESSAGE_END.value: TTSMessageEndEvent,
-                DifyEventType.MESSAGE_REPLACE.value: MessageReplaceEvent,
-                DifyEventType.ERROR.value: ErrorEvent,
-                DifyEventType.PING.value: PingEvent,
-            }
-
-            model_class = event_map.get(event_type)
-            if not model_class:
-                raise ValueError(f"Unknown event type: {event_type}")
-
-            return model_class(**event_dict)
+            return decoder.lazy(data).model
         except Exception as e:
             raise ValueError(f"Failed to parse event: {e}")
 
@@ -137,3 +114,21 @@ class ErrorEvent(BaseEvent):
 
 class PingEvent(BaseEvent):
     pass
+
+
+# 事件类型到模型的映射，模块加载时只构建一次
+decoder = EventDecoder(
+    {
+        DifyEventType.MESSAGE.value: MessageEvent,
+        DifyEventType.AGENT_MESSAGE.value: AgentMessageEvent,
+        DifyEventType.AGENT_THOUGHT.value: AgentThoughtEvent,
+        DifyEventType.MESSAGE_FILE.value: MessageFileEvent,
+        DifyEventType.MESSAGE_END.value: MessageEndEvent,
+        DifyEventType.TTS_MESSAGE.value: TTSMessageEvent,
+        DifyEventType.TTS_MESSAGE_END.value: TTSMessageEndEvent,
+        DifyEventType.MESSAGE_REPLACE.value: MessageReplaceEvent,
+        DifyEventType.ERROR.value: ErrorEvent,
+        DifyEventType.PING.value: PingEvent,
+    },
+    skip=(DifyEventType.PING.value, DifyEventType.TTS_MESSAGE.value, DifyEventType.TTS_MESSAGE_END.value),
+)
@@ -0,0 +1,96 @@
+import json
+import re
+from typing import Any, Callable, Iterable
+from pydantic import BaseModel
+
+try:
+    import orjson
+
+    loads: Callable[[str | bytes], Any] = orjson.loads
+except ImportError:  # pragma: no cover - orjson is optional
+    loads = json.loads
+
+# Dify 总是把 event 放在第一个字段，命中时无需解析整个 JSON
+_EVENT_PEEK = re.compile(r'\s*\{\s*"event"\s*:\s*"([^"\\]+)"')
+_EVENT_PEEK_BYTES = re.compile(rb'\s*\{\s*"event"\s*:\s*"([^"\\]+)"')
+
+
+def strip_data_prefix(data: str | bytes) -> str | bytes:
+    if isinstance(data, str):
+        if data.startswith("data:"):
+            data = data[5:]
+    elif data.startswith(b"data:"):
+        data = data[5:]
+    return data
+
+
+class LazyEvent:
+    """
+    An SSE frame whose payload is only parsed, and whose model is only validated, on first access.
+    """
+
+    __slots__ = ("event", "raw", "_decoder", "_payload", "_model")
+
+    def __init__(self, decoder: "EventDecoder", event: str | None, raw: str | bytes):
+        self.event = event
+        self.raw = raw
+        self._decoder = decoder
+        self._payload = None
+        self._model = None
+
+    @property
+    def payload(self) -> dict:
+        if self._payload is None:
+            self._payload = loads(self.raw)
+        return self._payload
+
+    @property
+    def model(self) -> BaseModel:
+        if self._model is None:
+            self._model = self._decoder.validate(self.event, self.payload)
+        return self._model
+
+
+class EventDecoder:
+    """
+    Decode Dify SSE frames into event models.
+
+    :param event_map: event name -> model class, built once per models module
+    :param skip: event names that ``decode`` drops without parsing, e.g. pings and tts chunks
+    """
+
+    def __init__(self, event_map: dict[str, type[BaseModel]], skip: Iterable[str] = ()):
+        self.event_map = event_map
+        self.skip = frozenset(skip)
+
+    def peek(self, data: str | bytes) -> str | None:
+        return self._peek(strip_data_prefix(data))
+
+    def _peek(self, data: str | bytes) -> str | None:
+        pattern = _EVENT_PEEK if isinstance(data, str) else _EVENT_PEEK_BYTES
+        matched = pattern.match(data)
+        if matched is None:
+            return None
+        event = matched.group(1)
+        return event if isinstance(event, str) else event.decode("utf-8")
+
+    def lazy(self, data: str | bytes) -> LazyEvent:
+        data = strip_data_prefix(data)
+        event = self._peek(data)
+        lazy_event = LazyEvent(self, event, data)
+        if event is None:
+            lazy_event.event = lazy_event.payload.get("event")
+        return lazy_event
+
+    def validate(self, event: str | None, payload: dict) -> BaseModel:
+        model_class = self.event_map.get(event)
+        if not model_class:
+            raise ValueError(f"Unknown event type: {event}")
+        return model_class.model_validate(payload)
+
+    def decode(self, data: str | bytes) -> BaseModel | None:
+        data = strip_data_prefix(data)
+        if self._peek(data) in self.skip:
+            return None
+        payload = loads(data)
+        return self.validate(payload.get("event"), payload)
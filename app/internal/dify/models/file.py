@@ -32,7 +32,12 @@ class FileType(Enum):
 
     @staticmethod
     def from_meta(meta: FileMeta) -> Optional["FileType"]:
+        return FileType.from_extension(meta.extension)
+
+    @staticmethod
+    def from_extension(extension: str) -> Optional["FileType"]:
+        extension = extension.lstrip(".").upper()
         for file_type in FileType:
-            if meta.extension in file_type.value[1]:
-                return file_type(meta)
+            if extension in file_type.value[1]:
+                return file_type
         return None
@@ -1,7 +1,7 @@
 from enum import Enum
 from typing import Optional, Dict, Any, List
 from pydantic import BaseModel, Field
-import json
+from .decoder import EventDecoder
 
 
 # 定义事件类型枚举
@@ -16,6 +16,7 @@ class DifyEventType(str, Enum):
     MESSAGE = "message"
     MESSAGE_FILE = "message_file"
     MESSAGE_END = "message_end"
+    TEXT_CHUNK = "text_chunk"
     ITERATION_STARTED = "iteration_started"
     ITERATION_NEXT = "iteration_next"
     ITERATION_COMPLETED = "iteration_completed"
@@ -39,36 +40,7 @@ class BaseEvent(BaseModel):
     def from_raw(cls, data: str) -> "BaseEvent":
         """从原始数据解析事件"""
         try:
-            # 假设数据以 "data: " 开头，去掉前缀并解析 JSON
-            if data.startswith("data: "):
-                data = data[6:]
-            event_dict = json.loads(data)
-            event_type = event_dict.get("event")
-
-            # 根据事件类型选择对应的模型
-            event_map = {
-                DifyEventType.WORKFLOW_STARTED.value: WorkflowStartedEvent,
-                DifyEventType.NODE_STARTED.value: NodeStartedEvent,
-                DifyEventType.NODE_FINISHED.value: NodeFinishedEvent,
-                DifyEventType.WORKFLOW_FINISHED.value: WorkflowFinishedEvent,
-                DifyEventType.TTS_MESSAGE.value: TTSMessageEvent,
-                DifyEventType.TTS_MESSAGE_END.value: TTSMessageEndEvent,
-                DifyEventType.PING.value: PingEvent,
-                DifyEventType.MESSAGE.value: MessageEvent,
-                DifyEventType.MESSAGE_FILE.value: MessageFileEvent,
-                DifyEventType.MESSAGE_END.value: MessageEndEvent,
-                DifyEventType.ITERATION_STARTED.value: IterationStartedEvent,
-                DifyEventType.ITERATION_NEXT.value: IterationNextEvent,
-                DifyEventType.ITERATION_COMPLETED.value: IterationCompletedEvent,
-                DifyEventType.PARALLEL_BRANCH_STARTED.value: ParallelBranchStartedEvent,
-                DifyEventType.PARALLEL_BRANCH_FINISHED.value: ParallelBranchFinishedEvent,
-            }
-
-            model_class = event_map.get(event_type)
-            if not model_class:
-                raise ValueError(f"Unknown event type: {event_type}")
-
-            return model_class(**event_dict)
+            return decoder.lazy(data).model
         except Exception as e:
             raise ValueError(f"Failed to parse event: {e}")
 
@@ -94,6 +66,8 @@ class NodeStartedData(BaseModel):
     index: int
     predecessor_node_id: Optional[str] = None
     inputs: Optional[Dict[str, Any]] = None
+    parallel_id: Optional[str] = None
+    parallel_start_node_id: Optional[str] = None
     created_at: int
 
 
@@ -111,6 +85,8 @@ class ExecutionMetadata(BaseModel):
 class NodeFinishedData(BaseModel):
     id: str
     node_id: str
+    node_type: Optional[str] = None
+    title: Optional[str] = None
     index: int
     predecessor_node_id: Optional[str] = None
     inputs: Optional[Dict[str, Any]] = None
@@ -120,6 +96,8 @@ class NodeFinishedData(BaseModel):
     error: Optional[str] = None
     elapsed_time: Optional[float] = None
     execution_metadata: Optional[ExecutionMetadata] = None
+    parallel_id: Optional[str] = None
+    parallel_start_node_id: Optional[str] = None
     created_at: int
 
 
@@ -206,6 +184,16 @@ class MessageEndEvent(BaseEvent):
     metadata: Dict[str, Any] = Field(default_factory=dict)  # 包含 usage 和 retriever_resources
 
 
+# 文本块事件，工作流输出节点流式产生的文本
+class TextChunkData(BaseModel):
+    text: str
+    from_variable_selector: Optional[List[str]] = None
+
+
+class TextChunkEvent(BaseEvent):
+    data: TextChunkData
+
+
 class IterationStartedEvent(BaseEvent):
     pass
 
@@ -218,9 +206,44 @@ class IterationNextEvent(BaseEvent):
     pass
 
 
+# 并行分支事件
+class ParallelBranchData(BaseModel):
+    parallel_id: str
+    parallel_start_node_id: str
+    parent_parallel_id: Optional[str] = None
+    parent_parallel_start_node_id: Optional[str] = None
+    status: Optional[str] = None  # succeeded / failed，仅结束事件
+    error: Optional[str] = None
+    created_at: Optional[int] = None
+
+
 class ParallelBranchStartedEvent(BaseEvent):
-    pass
+    data: Optional[ParallelBranchData] = None
 
 
 class ParallelBranchFinishedEvent(BaseEvent):
-    pass
+    data: Optional[ParallelBranchData] = None
+
+
+# 事件类型到模型的映射，模块加载时只构建一次
+decoder = EventDecoder(
+    {
+        DifyEventType.WORKFLOW_STARTED.value: WorkflowStartedEvent,
+        DifyEventType.NODE_STARTED.value: NodeStartedEvent,
+        DifyEventType.NODE_FINISHED.value: NodeFinishedEvent,
+        DifyEventType.WORKFLOW_FINISHED.value: WorkflowFinishedEvent,
+        DifyEventType.TTS_MESSAGE.value: TTSMessageEvent,
+        DifyEventType.TTS_MESSAGE_END.value: TTSMessageEndEvent,
+        DifyEventType.PING.value: PingEvent,
+        DifyEventType.MESSAGE.value: MessageEvent,
+        DifyEventType.MESSAGE_FILE.value: MessageFileEvent,
+        DifyEventType.MESSAGE_END.value: MessageEndEvent,
+        DifyEventType.TEXT_CHUNK.value: TextChunkEvent,
+        DifyEventType.ITERATION_STARTED.value: IterationStartedEvent,
+        DifyEventType.ITERATION_NEXT.value: IterationNextEvent,
+        DifyEventType.ITERATION_COMPLETED.value: IterationCompletedEvent,
+        DifyEventType.PARALLEL_BRANCH_STARTED.value: ParallelBranchStartedEvent,
+        DifyEventType.PARALLEL_BRANCH_FINISHED.value: ParallelBranchFinishedEvent,
+    },
+    skip=(DifyEventType.PING.value, DifyEventType.TTS_MESSAGE.value, DifyEventType.TTS_MESSAGE_END.value),
+)
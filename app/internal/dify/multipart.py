@@ -0,0 +1,116 @@
+import asyncio
+import mimetypes
+import os
+import uuid
+from typing import Any, AsyncIterator
+import httpx
+
+
+class UploadTooLargeError(ValueError):
+
+    def __init__(self, filename: str, limit: int):
+        super().__init__(f"{filename} exceeds the upload limit of {limit} bytes")
+        self.filename = filename
+        self.limit = limit
+
+
+def _quote(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\r", "%0D").replace("\n", "%0A")
+
+
+class MultipartStream(httpx.AsyncByteStream):
+    """
+    ``multipart/form-data`` request body that is generated while it is sent.
+
+    File contents are read ``chunk_size`` bytes at a time, so only one chunk per upload is held in memory whatever
+    the file size. A file may be given as bytes, a sync file object (read in a worker thread) or anything with an
+    async ``read(size)`` such as Starlette's ``UploadFile``.
+
+    :param data: plain form fields
+    :param files: field name -> ``(filename, file, content_type)`` or a bare file object
+    :param limits: field name -> max bytes, enforced while streaming
+    :param sizes: field name -> known file size, used to send a Content-Length instead of chunked encoding
+    """
+
+    def __init__(self,
+                 data: dict[str, Any] | None,
+                 files: dict[str, Any],
+                 limits: dict[str, int] | None = None,
+                 sizes: dict[str, int | None] | None = None,
+                 chunk_size: int = 256 * 1024):
+        self.boundary = uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        self.limits = limits or {}
+        self.fields = [(name, str(value)) for name, value in (data or {}).items() if value is not None]
+        self.files = []
+        for name, value in files.items():
+            if isinstance(value, tuple):
+                filename, file, content_type = (*value, None)[:3]
+            else:
+                file = value
+                filename = os.path.basename(getattr(value, "name", name))
+                content_type = None
+            content_type = content_type or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            self.files.append((name, filename, file, content_type))
+        self.sizes = sizes or {}
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def _field_header(self, name: str) -> bytes:
+        return f'--{self.boundary}\r\nContent-Disposition: form-data; name="{_quote(name)}"\r\n\r\n'.encode("utf-8")
+
+    def _file_header(self, name: str, filename: str, content_type: str) -> bytes:
+        return (f'--{self.boundary}\r\nContent-Disposition: form-data; name="{_quote(name)}"; '
+                f'filename="{_quote(filename)}"\r\nContent-Type: {content_type}\r\n\r\n').encode("utf-8")
+
+    @property
+    def content_length(self) -> int | None:
+        length = len(f"--{self.boundary}--\r\n")
+        for name, value in self.fields:
+            length += len(self._field_header(name)) + len(value.encode("utf-8")) + 2
+        for name, filename, file, content_type in self.files:
+            size = len(file) if isinstance(file, bytes) else self.sizes.get(name)
+            if size is None:
+                return None
+            length += len(self._file_header(name, filename, content_type)) + size + 2
+        return length
+
+    @property
+    def headers(self) -> dict[str, str]:
+        headers = {"Content-Type": self.content_type}
+        content_length = self.content_length
+        if content_length is not None:
+            headers["Content-Length"] = str(content_length)
+        return headers
+
+    async def _read_chunks(self, file: Any) -> AsyncIterator[bytes]:
+        if isinstance(file, bytes):
+            for offset in range(0, len(file), self.chunk_size):
+                yield file[offset:offset + self.chunk_size]
+            return
+        read = file.read
+        while True:
+            if asyncio.iscoroutinefunction(read):
+                chunk = await read(self.chunk_size)
+            else:
+                chunk = await asyncio.to_thread(read, self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for name, value in self.fields:
+            yield self._field_header(name) + value.encode("utf-8") + b"\r\n"
+        for name, filename, file, content_type in self.files:
+            yield self._file_header(name, filename, content_type)
+            limit = self.limits.get(name)
+            sent = 0
+            async for chunk in self._read_chunks(file):
+                sent += len(chunk)
+                if limit is not None and sent > limit:
+                    raise UploadTooLargeError(filename, limit)
+                yield chunk
+            yield b"\r\n"
+        yield f"--{self.boundary}--\r\n".encode("utf-8")
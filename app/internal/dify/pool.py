@@ -0,0 +1,235 @@
+import asyncio
+import time
+import httpx
+from app.internal.config import get_config, HttpConfig
+from app.internal.logging import logger
+from app.internal.metrics import registry, endpoint_label
+
+upstream_connect = registry.histogram("dify_upstream_connect_seconds", "Time to open a new upstream connection",
+                                      ("endpoint", ))
+upstream_pool_wait = registry.histogram("dify_upstream_pool_wait_seconds",
+                                        "Time a request waited for a pooled upstream connection", ("endpoint", ))
+upstream_ttfb = registry.histogram("dify_upstream_ttfb_seconds", "Time until upstream response headers arrived",
+                                   ("method", "endpoint"))
+upstream_duration = registry.histogram("dify_upstream_duration_seconds",
+                                       "Time until the upstream response body was fully consumed or closed",
+                                       ("method", "endpoint"))
+upstream_responses = registry.counter("dify_upstream_responses_total", "Upstream responses by status code",
+                                      ("method", "endpoint", "status"))
+upstream_errors = registry.counter("dify_upstream_errors_total", "Upstream requests that failed without a response",
+                                   ("method", "endpoint", "error"))
+
+
+class PoolStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        self.in_flight = 0
+
+    def record_checkout(self, wait: float, reused: bool):
+        self.checkout_wait_total += wait
+        self.checkout_wait_max = max(self.checkout_wait_max, wait)
+        if reused:
+            self.reused_connections += 1
+        else:
+            self.new_connections += 1
+
+    def as_dict(self) -> dict:
+        checkouts = self.new_connections + self.reused_connections
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "new_connections": self.new_connections,
+            "reused_connections": self.reused_connections,
+            "reuse_ratio": self.reused_connections / checkouts if checkouts else 0.0,
+            "checkout_wait_avg": self.checkout_wait_total / checkouts if checkouts else 0.0,
+            "checkout_wait_max": self.checkout_wait_max,
+        }
+
+
+stats = PoolStats()
+
+registry.gauge("dify_upstream_pool_in_flight",
+               "Upstream requests holding a pooled connection",
+               collect=lambda: {(): stats.in_flight})
+registry.gauge("dify_upstream_pool_max_connections",
+               "Configured upper bound of the upstream pool",
+               collect=lambda: {(): get_config().http.max_connections})
+registry.counter_func("dify_upstream_connections_total",
+                      "Upstream connection checkouts by whether a kept-alive connection was reused", ("reused", ),
+                      collect=lambda: {
+                          ("true", ): stats.reused_connections,
+                          ("false", ): stats.new_connections
+                      })
+
+
+class _ReleaseOnClose(httpx.AsyncByteStream):
+
+    def __init__(self, stream: httpx.AsyncByteStream, labels: tuple[str, str], started_at: float,
+                 transport: "MeteredTransport"):
+        self.stream = stream
+        self.labels = labels
+        self.started_at = started_at
+        self.transport = transport
+        self.released = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                stats.in_flight -= 1
+                self.transport.in_flight -= 1
+                upstream_duration.observe(*self.labels, value=time.perf_counter() - self.started_at)
+
+
+class MeteredTransport(httpx.AsyncHTTPTransport):
+    """
+    ``AsyncHTTPTransport`` that measures each upstream request through httpcore's trace extension: pool wait,
+    connect time, time to response headers and total duration until the response is closed.
+
+    The first trace event of a request is either ``connection.connect_tcp.started`` (a new connection had to be
+    opened) or ``*.send_request_headers.started`` (an idle connection was reused); the time until it is the
+    checkout wait.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 本连接池上尚未关闭的响应数，换池后据此判断旧池何时可以关闭
+        self.in_flight = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started_at = time.perf_counter()
+        labels = (request.method, endpoint_label(request.url.path))
+        checked_out = False
+        connect_started_at = None
+        upstream_trace = request.extensions.get("trace")
+
+        async def trace(event_name: str, info: dict):
+            nonlocal checked_out, connect_started_at
+            if not checked_out and event_name.endswith(".started"):
+                checked_out = True
+                now = time.perf_counter()
+                reused = not event_name.startswith("connection.connect_tcp")
+                stats.record_checkout(now - started_at, reused=reused)
+                upstream_pool_wait.observe(labels[1], value=now - started_at)
+                if not reused:
+                    connect_started_at = now
+            elif connect_started_at is not None and event_name.endswith("send_request_headers.started"):
+                upstream_connect.observe(labels[1], value=time.perf_counter() - connect_started_at)
+                connect_started_at = None
+            elif event_name.endswith("receive_response_headers.complete"):
+                upstream_ttfb.observe(*labels, value=time.perf_counter() - started_at)
+            if upstream_trace is not None:
+                await upstream_trace(event_name, info)
+
+        request.extensions["trace"] = trace
+        stats.requests += 1
+        stats.in_flight += 1
+        self.in_flight += 1
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException as e:
+            stats.in_flight -= 1
+            self.in_flight -= 1
+            upstream_errors.inc(*labels, type(e).__name__)
+            raise
+        upstream_responses.inc(*labels, str(response.status_code))
+        response.stream = _ReleaseOnClose(response.stream, labels, started_at, self)
+        return response
+
+
+def create_client(http: HttpConfig, proxy_url: str | None = None) -> httpx.AsyncClient:
+    return _create(http, proxy_url)[0]
+
+
+def _create(http: HttpConfig, proxy_url: str | None) -> tuple[httpx.AsyncClient, MeteredTransport]:
+    limits = httpx.Limits(max_connections=http.max_connections,
+                          max_keepalive_connections=http.max_keepalive_connections,
+                          keepalive_expiry=http.keepalive_expiry)
+    timeout = httpx.Timeout(connect=http.connect_timeout,
+                            read=http.read_timeout,
+                            write=http.write_timeout,
+                            pool=http.pool_timeout)
+    proxy = httpx.Proxy(url=proxy_url) if proxy_url else None
+    transport = MeteredTransport(retries=http.retries, limits=limits, proxy=proxy)
+    return httpx.AsyncClient(timeout=timeout, transport=transport), transport
+
+
+_retiring: set[asyncio.Task] = set()
+
+_client: httpx.AsyncClient | None = None
+# _client 的 transport，换池时用它判断旧池中的响应是否都已关闭
+_transport: MeteredTransport | None = None
+
+
+def _install(http: HttpConfig, proxy_url: str | None) -> httpx.AsyncClient:
+    global _client, _transport
+    _client, _transport = _create(http, proxy_url)
+    return _client
+
+
+def get_pool() -> httpx.AsyncClient:
+    if _client is None:
+        config = get_config()
+        if config.proxy.url:
+            logger.info(f"using proxy: {config.proxy.url}")
+        _install(config.http, config.proxy.url)
+    return _client
+
+
+async def open_pool():
+    http = get_config().http
+    logger.info(f"opening upstream pool, max connections: {http.max_connections}, "
+                f"keepalive: {http.max_keepalive_connections}, keepalive expiry: {http.keepalive_expiry}s")
+    get_pool()
+
+
+async def _retire(client: httpx.AsyncClient, transport: MeteredTransport | None, timeout: float):
+    deadline = time.monotonic() + timeout
+    try:
+        while transport is not None and transport.in_flight > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+    finally:
+        if transport is not None and transport.in_flight > 0:
+            logger.warning(f"closing retired upstream pool with {transport.in_flight} responses still open")
+        await client.aclose()
+        logger.info("retired upstream pool closed")
+
+
+async def swap_pool(http: HttpConfig, proxy_url: str | None = None):
+    """
+    Replace the pool with one built from ``http`` and ``proxy_url``.
+
+    Requests sent from now on use the new pool. Responses already streaming keep their connection on the old one,
+    which is closed once they are all closed. SSE answers easily outlast ``read_timeout``, so the old pool is only
+    forced closed after ``retire_timeout`` (at least ``read_timeout``).
+    """
+    old, old_transport = _client, _transport
+    _install(http, proxy_url)
+    logger.info(f"upstream pool replaced, max connections: {http.max_connections}, proxy: {proxy_url}")
+    if old is None:
+        return
+    task = asyncio.create_task(_retire(old, old_transport, max(http.read_timeout, http.retire_timeout)))
+    _retiring.add(task)
+    task.add_done_callback(_retiring.discard)
+
+
+async def close_pool():
+    global _client, _transport
+    for task in list(_retiring):
+        task.cancel()
+    await asyncio.gather(*_retiring, return_exceptions=True)
+    if _client is not None:
+        client, _client, _transport = _client, None, None
+        await client.aclose()
+        logger.info(f"upstream pool closed, stats: {stats.as_dict()}")
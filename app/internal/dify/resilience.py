@@ -0,0 +1,214 @@
+import asyncio
+import random
+import time
+import httpx
+from typing import Awaitable, Callable
+from app.internal import deadline
+from app.internal.config import get_config, RetryConfig, BreakerConfig
+from app.internal.dify.errors import UpstreamUnavailableError
+from app.internal.dify.keys import parse_retry_after
+from app.internal.logging import logger
+from app.internal.metrics import registry, endpoint_label
+
+retries_total = registry.counter("dify_retries_total", "Upstream calls retried, by the reason of the retry",
+                                 ("method", "endpoint", "reason"))
+breaker_rejected = registry.counter("dify_breaker_rejected_total", "Upstream calls refused by an open circuit",
+                                    ("client", "method", "endpoint"))
+
+# 请求一定没有发出去的错误，POST 也可以安全重试
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class RetryPolicy:
+    """
+    When and after how long an upstream call is tried again.
+
+    GETs are retried on any transport error. POSTs are retried only where no response byte has been relayed yet:
+    streamed POSTs on any error before the response headers, buffered POSTs only when the request surely never
+    left (connect and pool errors). GETs are retried on the configured ``statuses``, 429 and 502-504 by default;
+    other methods only on those of them in ``unsent_statuses``, 429 and 503, which upstream answers without running
+    the request. A 502 or 504 may come after Dify already created the message, run or document, and resending would
+    create it twice.
+
+    The wait is exponential with full jitter, ``uniform(0, min(backoff_max, backoff_base * 2 ** attempt))``, or
+    what ``Retry-After`` asks for; a ``Retry-After`` longer than ``max_retry_after`` is not waited for and the
+    response is returned as is.
+    """
+
+    def __init__(self, config: RetryConfig):
+        self.config = config
+
+    def retries_error(self, method: str, stream: bool, error: httpx.TransportError) -> bool:
+        return method == "GET" or stream or isinstance(error, _NOT_SENT)
+
+    def retries_status(self, method: str, status_code: int) -> bool:
+        if status_code not in self.config.statuses:
+            return False
+        return method == "GET" or status_code in self.config.unsent_statuses
+
+    def delay(self, attempt: int, response: httpx.Response | None = None) -> float | None:
+        """Seconds to wait before retry number ``attempt + 1``, None when it is not worth waiting for."""
+        wait = parse_retry_after(response) if response is not None else None
+        if wait is not None:
+            wait = max(wait, 0.0)
+            return wait if wait <= self.config.max_retry_after else None
+        return random.uniform(0, min(self.config.backoff_max, self.config.backoff_base * 2**attempt))
+
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+
+class CircuitBreaker:
+    """
+    Fails calls to one upstream endpoint fast while it keeps failing.
+
+    ``failures`` consecutive failures (transport errors and 5xx) open the circuit: calls are refused with a 503
+    for ``open_seconds``. Then it is half open and lets ``half_open_probes`` calls through; one success closes it,
+    one failure opens it again.
+    """
+
+    def __init__(self, name: str, method: str, endpoint: str, config: BreakerConfig):
+        self.labels = (name, method, endpoint)
+        self.config = config
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.opened = 0
+
+    def before(self):
+        """Raises ``UpstreamUnavailableError`` when the call must not be sent."""
+        if self.state == CLOSED:
+            return
+        now = time.monotonic()
+        if self.state == OPEN:
+            remaining = self.opened_at + self.config.open_seconds - now
+            if remaining > 0:
+                breaker_rejected.inc(*self.labels)
+                raise UpstreamUnavailableError(f"{self.labels[1]} {self.labels[2]} is failing, circuit open",
+                                               retry_after=remaining)
+            self.state = HALF_OPEN
+            self.probes = 0
+        if self.probes >= self.config.half_open_probes:
+            breaker_rejected.inc(*self.labels)
+            raise UpstreamUnavailableError(f"{self.labels[1]} {self.labels[2]} is being probed, circuit half open",
+                                           retry_after=1)
+        self.probes += 1
+
+    def record(self, ok: bool):
+        if ok:
+            if self.state != CLOSED:
+                logger.info(f"circuit of {self.labels} closed")
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            return
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.config.failures:
+            if self.state != OPEN:
+                logger.warning(f"circuit of {self.labels} opened after {self.consecutive_failures} failures")
+                self.opened += 1
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def cancel(self):
+        """The call ended without an outcome, e.g. it was cancelled; give its probe back."""
+        if self.state == HALF_OPEN and self.probes > 0:
+            self.probes -= 1
+
+    def stats(self) -> dict:
+        return {
+            "state":
+            self.state,
+            "consecutive_failures":
+            self.consecutive_failures,
+            "opened":
+            self.opened,
+            "open_for":
+            max(self.opened_at + self.config.open_seconds - time.monotonic(), 0.0) if self.state == OPEN else 0.0,
+        }
+
+
+_breakers: dict[tuple[str, str, str], CircuitBreaker] = {}
+
+
+def get_breaker(name: str, method: str, path: str) -> CircuitBreaker | None:
+    config = get_config().breaker
+    if not config.enabled:
+        return None
+    key = (name, method, endpoint_label(path))
+    breaker = _breakers.get(key)
+    if breaker is None:
+        breaker = _breakers[key] = CircuitBreaker(*key, config)
+    breaker.config = config
+    return breaker
+
+
+def breaker_stats() -> dict:
+    return {" ".join(key): breaker.stats() for key, breaker in _breakers.items()}
+
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+registry.gauge("dify_breaker_state",
+               "Circuit state per upstream endpoint, 0 closed, 1 half open, 2 open", ("client", "method", "endpoint"),
+               collect=lambda: {
+                   key: _STATE_VALUES[breaker.state]
+                   for key, breaker in _breakers.items()
+               })
+
+
+def _in_time(delay: float) -> bool:
+    # 等待之后已经来不及时不再重试
+    left = deadline.remaining()
+    return left is None or left > delay
+
+
+async def resilient(name: str,
+                    method: str,
+                    path: str,
+                    send: Callable[[], Awaitable[httpx.Response]],
+                    stream: bool = False,
+                    replayable: bool = True) -> httpx.Response:
+    """
+    Calls ``send`` under the circuit breaker of ``method path`` and retries it by the retry policy.
+
+    Every attempt goes through ``send`` again, so it picks a key and a limiter slot of its own and a key evicted by
+    the failed attempt is skipped. Retried responses are closed before waiting.
+
+    :param replayable: False when the request body can only be sent once, a streamed upload; it is then not retried
+    """
+    config = get_config().retry
+    policy = RetryPolicy(config)
+    retries = config.retries if replayable else 0
+    breaker = get_breaker(name, method, path)
+    attempt = 0
+    while True:
+        deadline.check(f"{method} {path}")
+        if breaker is not None:
+            breaker.before()
+        try:
+            response = await send()
+        except httpx.TransportError as e:
+            if breaker is not None:
+                breaker.record(False)
+            delay, reason = policy.delay(attempt), type(e).__name__
+            if attempt >= retries or not policy.retries_error(method, stream, e) or not _in_time(delay):
+                raise
+        except BaseException:
+            if breaker is not None:
+                breaker.cancel()
+            raise
+        else:
+            # 429 是单个密钥的限额问题，交给密钥池处理，不算接口故障
+            if breaker is not None:
+                breaker.record(response.status_code < 500)
+            if attempt >= retries or not policy.retries_status(method, response.status_code):
+                return response
+            delay = policy.delay(attempt, response)
+            if delay is None or not _in_time(delay):
+                return response
+            reason = str(response.status_code)
+            await response.aclose()
+        retries_total.inc(method, endpoint_label(path), reason)
+        attempt += 1
+        await asyncio.sleep(delay)
@@ -0,0 +1,211 @@
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable
+import httpx
+from pydantic import BaseModel
+from app.internal.logging import logger
+from app.internal.metrics import registry
+from app.internal.dify.models.decoder import EventDecoder, LazyEvent
+
+
+@dataclass
+class StreamStats:
+    name: str
+    started_at: float = field(default_factory=time.perf_counter)
+    first_byte_at: float | None = None
+    finished_at: float | None = None
+    events: int = 0
+    bytes: int = 0
+
+    @property
+    def ttfb(self) -> float | None:
+        if self.first_byte_at is None:
+            return None
+        return self.first_byte_at - self.started_at
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    @property
+    def events_per_second(self) -> float:
+        if self.first_byte_at is None:
+            return 0.0
+        elapsed = (self.finished_at or time.perf_counter()) - self.first_byte_at
+        return self.events / elapsed if elapsed > 0 else float(self.events)
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "ttfb": self.ttfb,
+            "duration": self.duration,
+            "events": self.events,
+            "bytes": self.bytes,
+            "events_per_second": self.events_per_second,
+        }
+
+
+# 正在转发的流，key 为 id(relay)
+active_streams: dict[int, StreamStats] = {}
+
+
+def _count_active_streams() -> dict[tuple[str, ...], float]:
+    counts = {}
+    for stats in list(active_streams.values()):
+        counts[(stats.name, )] = counts.get((stats.name, ), 0) + 1
+    return counts
+
+
+registry.gauge("sse_active_streams",
+               "SSE streams currently relayed to clients", ("stream", ),
+               collect=_count_active_streams)
+stream_ttfb = registry.histogram("sse_stream_ttfb_seconds", "Time until the first upstream event of a stream",
+                                 ("stream", ))
+stream_events = registry.counter("sse_stream_events_total", "SSE events relayed to clients", ("stream", ))
+
+
+class SSERelay:
+    """
+    Forward an upstream SSE response to the downstream client.
+
+    The relay is pull based: a chunk is only read from the upstream httpx stream when the downstream
+    ``StreamingResponse`` asks for the next one, which in turn only happens once the previous chunk was handed to
+    the socket. Slow readers therefore push back on the upstream connection instead of being buffered in memory.
+
+    :param response: streamed httpx response, it is always closed when the relay finishes or is cancelled
+    :param name: label used in the summary log line
+    :param raw: forward the upstream bytes untouched instead of re-framing ``data:`` lines
+    :param started_at: ``time.perf_counter()`` when the upstream request was sent, used for ttfb
+    :param decoder: decoder used to peek at event names when ``handlers`` are given
+    :param handlers: event name -> callback, only frames with a handler are parsed, everything else is forwarded
+        without touching its JSON
+    :param log_sample: log every n-th frame at debug level, 0 disables per-frame logging
+    """
+
+    def __init__(self,
+                 response: httpx.Response,
+                 name: str = "stream",
+                 raw: bool = False,
+                 started_at: float | None = None,
+                 decoder: EventDecoder | None = None,
+                 handlers: dict[str, Callable[[LazyEvent], None]] | None = None,
+                 log_sample: int = 0):
+        self.response = response
+        self.raw = raw
+        self.decoder = decoder
+        self.handlers = handlers if decoder is not None else None
+        self.log_sample = log_sample if logger.isEnabledFor(logging.DEBUG) else 0
+        self.stats = StreamStats(name=name)
+        if started_at is not None:
+            self.stats.started_at = started_at
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        active_streams[id(self)] = self.stats
+        try:
+            if self.raw:
+                async for chunk in self._relay_bytes():
+                    yield chunk
+            else:
+                async for chunk in self._relay_lines():
+                    yield chunk
+        finally:
+            self.stats.finished_at = time.perf_counter()
+            active_streams.pop(id(self), None)
+            stream_events.inc(self.stats.name, amount=self.stats.events)
+            if self.stats.ttfb is not None:
+                stream_ttfb.observe(self.stats.name, value=self.stats.ttfb)
+            await self.response.aclose()
+            logger.info("stream %s closed, status: %s, ttfb: %.3fs, events: %d, bytes: %d, events/s: %.1f",
+                        self.stats.name, self.response.status_code, self.stats.ttfb or 0, self.stats.events,
+                        self.stats.bytes, self.stats.events_per_second)
+
+    def _mark_first_byte(self):
+        if self.stats.first_byte_at is None:
+            self.stats.first_byte_at = time.perf_counter()
+
+    def _dispatch(self, data: str | bytes):
+        event = self.decoder.peek(data)
+        if event is not None and event not in self.handlers:
+            return
+        try:
+            lazy_event = self.decoder.lazy(data)
+            handler = self.handlers.get(lazy_event.event)
+            if handler is not None:
+                handler(lazy_event)
+        except Exception as e:
+            logger.error("stream %s failed to handle event %s: %s", self.stats.name, event, e)
+
+    async def _relay_lines(self) -> AsyncIterator[bytes]:
+        async for line in self.response.aiter_lines():
+            if not line:
+                continue
+            if line.startswith("data:"):
+                self._mark_first_byte()
+                frame = f"{line}\n\n".encode("utf-8")
+                self.stats.events += 1
+                self.stats.bytes += len(frame)
+                if self.handlers:
+                    self._dispatch(line)
+                if self._sampled(self.stats.events - 1):
+                    logger.debug("stream %s event %d: %s", self.stats.name, self.stats.events, line)
+                yield frame
+            elif not line.startswith(":"):
+                logger.error("stream %s unknown chunk: %s", self.stats.name, line)
+
+    def _sampled(self, before: int) -> bool:
+        """Whether one of the events after the first ``before`` up to now is one to log: the 1st, n+1-th, 2n+1-th..."""
+        n = self.log_sample
+        return n > 0 and (self.stats.events + n - 1) // n > (before + n - 1) // n
+
+    async def _relay_bytes(self) -> AsyncIterator[bytes]:
+        # aiter_raw skips the decoder entirely, it is only safe when upstream did not compress the body
+        if self.response.headers.get("content-encoding", "identity") == "identity":
+            chunks = self.response.aiter_raw()
+        else:
+            chunks = self.response.aiter_bytes()
+        trailing_newline = False
+        pending = bytearray()
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            self._mark_first_byte()
+            self.stats.bytes += len(chunk)
+            events = self.stats.events
+            self.stats.events += chunk.count(b"\n\n") + (trailing_newline and chunk[:1] == b"\n")
+            trailing_newline = chunk[-1:] == b"\n"
+            if self._sampled(events):
+                logger.debug("stream %s chunk of %d bytes: %r", self.stats.name, len(chunk), chunk[:200])
+            if self.handlers:
+                # 只为了把完整的帧交给 handler，转发的仍是原始 chunk
+                pending += chunk
+                *frames, tail = bytes(pending).split(b"\n\n")
+                pending[:] = tail
+                for frame in frames:
+                    frame = frame.strip()
+                    if frame.startswith(b"data:"):
+                        self._dispatch(frame)
+            yield chunk
+
+
+async def iter_events(response: httpx.Response, decoder: EventDecoder) -> AsyncIterator[BaseModel]:
+    """
+    Parse a streamed SSE response into event models as the frames arrive, closing the response at the end.
+
+    Frames in ``decoder.skip`` are dropped before their JSON is parsed. Frames that do not decode, such as event
+    types added upstream after the models were written, are logged and skipped.
+    """
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            try:
+                event = decoder.decode(line)
+            except ValueError as e:
+                # 上游新增的事件类型不应中断整个流
+                logger.warning("skipped undecodable event %r: %s", line[:200], e)
+                continue
+            if event is not None:
+                yield event
+    finally:
+        await response.aclose()
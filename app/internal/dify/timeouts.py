@@ -0,0 +1,70 @@
+import asyncio
+import time
+import httpx
+from app.internal import deadline
+from app.internal.config import get_config
+from app.internal.dify.errors import DeadlineExceededError
+
+
+def request_timeout(method: str, stream: bool = False, upload: bool = False) -> httpx.Timeout:
+    """
+    Timeout profile of one upstream request, cut to the caller's deadline.
+
+    Metadata GETs, other buffered calls and uploads each get their own read timeout. A streamed request reads with
+    the larger of ``stream_ttfb`` and ``stream_idle``; ``TimedStream`` then holds the body to each of them.
+    """
+    timeouts = get_config().timeouts
+    if stream:
+        read = max(timeouts.stream_ttfb, timeouts.stream_idle)
+    elif upload:
+        read = timeouts.upload
+    else:
+        read = timeouts.metadata if method == "GET" else timeouts.command
+    http = get_config().http
+    return httpx.Timeout(connect=deadline.clamp(http.connect_timeout),
+                         read=deadline.clamp(read),
+                         write=deadline.clamp(http.write_timeout),
+                         pool=deadline.clamp(http.pool_timeout))
+
+
+class TimedStream(httpx.AsyncByteStream):
+    """
+    Streamed response body that must send its first chunk within ``ttfb`` of the request and every following one
+    within ``idle`` of the previous, and stops at ``deadline_at``.
+
+    A silent upstream raises ``httpx.ReadTimeout``, a passed deadline ``DeadlineExceededError``; the caller closes
+    the response either way, which drops the upstream connection.
+
+    :param started_at: ``time.monotonic()`` when the request was sent
+    :param deadline_at: ``time.monotonic()`` deadline of the caller, None for none
+    """
+
+    def __init__(self,
+                 stream: httpx.AsyncByteStream,
+                 started_at: float,
+                 ttfb: float,
+                 idle: float,
+                 deadline_at: float | None = None):
+        self.stream = stream
+        self.next_by = started_at + ttfb
+        self.idle = idle
+        self.deadline_at = deadline_at
+
+    async def __aiter__(self):
+        chunks = self.stream.__aiter__()
+        while True:
+            until = self.next_by if self.deadline_at is None else min(self.next_by, self.deadline_at)
+            try:
+                async with asyncio.timeout(max(until - time.monotonic(), 0)):
+                    chunk = await anext(chunks)
+            except StopAsyncIteration:
+                return
+            except TimeoutError:
+                if self.deadline_at is not None and time.monotonic() >= self.deadline_at:
+                    raise DeadlineExceededError("upstream stream is past the request deadline")
+                raise httpx.ReadTimeout("upstream stream went silent")
+            self.next_by = time.monotonic() + self.idle
+            yield chunk
+
+    async def aclose(self):
+        await self.stream.aclose()
@@ -20,3 +20,24 @@ async def exception_handler(request: Request, exc: Exception):
                             "message": str(exc),
                             "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                         })
+
+
+async def unavailable_handler(request: Request, exc: Exception):
+    retry_after = getattr(exc, "retry_after", None)
+    headers = {"Retry-After": str(max(int(retry_after), 1))} if retry_after is not None else None
+    return JSONResponse(status_code=503,
+                        headers=headers,
+                        content={
+                            "status": 503,
+                            "message": str(exc),
+                            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                        })
+
+
+async def deadline_handler(request: Request, exc: Exception):
+    return JSONResponse(status_code=504,
+                        content={
+                            "status": 504,
+                            "message": str(exc),
+                            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                        })
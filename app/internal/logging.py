@@ -1,6 +1,8 @@
 from datetime import datetime
+import atexit
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+import queue
 import sys
 import os
 
@@ -39,6 +41,21 @@ file_handler = TimedRotatingFileNameHandler(
     encoding="utf-8",
 )
 file_handler.setFormatter(log_formatter)
-logger.setLevel(logging.INFO)
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    把日志记录原样放入队列，格式化和写盘都交给 QueueListener 的后台线程，事件循环里只剩一次入队。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+log_queue = queue.SimpleQueue()
+queue_listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+queue_listener.start()
+atexit.register(queue_listener.stop)
+
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.addHandler(DeferredQueueHandler(log_queue))
@@ -0,0 +1,210 @@
+import bisect
+import re
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable
+
+# 指标在事件循环里更新，单线程下普通的 dict/list 操作足够，不加锁
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+Labels = tuple[str, ...]
+
+
+def _format_labels(names: Iterable[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    @abstractmethod
+    def samples(self) -> Iterable[str]:
+        """Exposition lines of this metric, without the HELP and TYPE header."""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    """
+    A gauge set by the caller, or read from ``collect`` at scrape time when the value already lives elsewhere.
+    """
+    kind = "gauge"
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Iterable[str] = (),
+                 collect: Callable[[], dict[Labels, float]] | None = None):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[Labels, float] = {}
+        self.collect = collect
+
+    def set(self, *labels: str, value: float):
+        self.values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def samples(self) -> Iterable[str]:
+        values = self.collect() if self.collect is not None else self.values
+        for labels, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class CounterFunc(Gauge):
+    """A counter whose value is kept by another module and read at scrape time."""
+    kind = "counter"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [每个桶的计数..., +Inf 计数, sum]
+        self.values: dict[Labels, list[float]] = {}
+
+    def observe(self, *labels: str, value: float):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(counts[-1])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.metrics.get(name) or self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self,
+              name: str,
+              documentation: str,
+              labelnames: Iterable[str] = (),
+              collect: Callable[[], dict[Labels, float]] | None = None) -> Gauge:
+        return self.metrics.get(name) or self.register(Gauge(name, documentation, labelnames, collect))
+
+    def counter_func(self,
+                     name: str,
+                     documentation: str,
+                     labelnames: Iterable[str] = (),
+                     collect: Callable[[], dict[Labels, float]] | None = None) -> CounterFunc:
+        return self.metrics.get(name) or self.register(CounterFunc(name, documentation, labelnames, collect))
+
+    def histogram(self,
+                  name: str,
+                  documentation: str,
+                  labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.metrics.get(name) or self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+_ID_SEGMENT = re.compile(r"/(?=[^/]*\d)[0-9a-zA-Z_-]{8,}(?=/|$)")
+
+
+def endpoint_label(path: str) -> str:
+    """Collapse ids in an upstream path, ``/messages/3f2c.../suggested`` -> ``/messages/:id/suggested``."""
+    return _ID_SEGMENT.sub("/:id", path)
+
+
+request_duration = registry.histogram("http_request_duration_seconds", "Duration of requests served by this app",
+                                      ("method", "route", "status"))
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording ``http_request_duration_seconds`` per route template.
+
+    Streaming responses are measured until their last chunk has been sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started_at = time.perf_counter()
+        status = "500"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            request_duration.observe(scope["method"],
+                                     getattr(route, "path", "unmatched"),
+                                     status,
+                                     value=time.perf_counter() - started_at)
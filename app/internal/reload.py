@@ -0,0 +1,71 @@
+import asyncio
+import signal
+from app.internal.config import get_config, config_modified, reload_config
+from app.internal.logging import logger
+from app.internal.metrics import registry
+from app.internal.dify import pool
+from app.internal.dify.client import drop_stale_clients
+
+config_reloads = registry.counter("config_reloads_total", "Config reloads by trigger and result", ("trigger", "result"))
+
+_watcher: asyncio.Task | None = None
+_reloading = asyncio.Lock()
+
+
+async def reload(trigger: str = "manual") -> bool:
+    """
+    Swap in a freshly loaded config and rebuild what depends on the parts that changed.
+
+    Cached Dify clients are dropped when their API key changed, and the upstream pool is replaced when the ``http`` or
+    ``proxy`` section changed. Streams already in flight finish on the client and pool they started with.
+    """
+    async with _reloading:
+        try:
+            old, new = await asyncio.to_thread(reload_config)
+        except Exception as e:
+            config_reloads.inc(trigger, "error")
+            logger.error(f"config reload ({trigger}) failed, keeping the current config: {e}")
+            return False
+        stale = drop_stale_clients(new)
+        if old.http != new.http or old.proxy != new.proxy:
+            await pool.swap_pool(new.http, new.proxy.url)
+        config_reloads.inc(trigger, "ok")
+        logger.info(f"config reloaded ({trigger}), rebuilt clients: {stale}")
+        return True
+
+
+async def _watch(interval: float):
+    failed = None
+    while True:
+        await asyncio.sleep(interval)
+        mtime = config_modified()
+        # 加载失败的版本不再重试，等文件再次被修改
+        if mtime is not None and mtime != failed and not await reload("watch"):
+            failed = mtime
+
+
+def _on_sighup():
+    asyncio.get_running_loop().create_task(reload("sighup"))
+
+
+async def start_config_watcher():
+    global _watcher
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, _on_sighup)
+    except (NotImplementedError, AttributeError, RuntimeError):
+        # Windows 没有 SIGHUP，只能靠轮询
+        pass
+    interval = get_config().server.reload_interval
+    if interval > 0:
+        _watcher = asyncio.create_task(_watch(interval))
+
+
+async def stop_config_watcher():
+    global _watcher
+    try:
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+    except (NotImplementedError, AttributeError, RuntimeError):
+        pass
+    if _watcher is not None:
+        _watcher.cancel()
+        _watcher = None
@@ -0,0 +1,94 @@
+import os
+from typing import BinaryIO, Callable
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - 没有 fcntl 的平台只能单 worker 运行
+    fcntl = None
+
+
+class SharedLog:
+    """
+    Append-only file shared by the worker processes of ``serve``.
+
+    Each worker appends its own records with one locked write and picks up the records of the others by reading on
+    from where it stopped last time, so no worker overwrites what another one wrote. ``compact`` rewrites the file
+    under the same lock; readers notice the new file and read it again from the start.
+
+    The locks are ``flock`` advisory locks, on platforms without ``fcntl`` only a single worker is safe.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+        self.inode: int | None = None
+
+    def _open_locked(self, flags: int, exclusive: bool) -> int | None:
+        """A locked descriptor of the file currently at ``path``, None if there is none and ``flags`` do not create it."""
+        while True:
+            try:
+                fd = os.open(self.path, flags, 0o644)
+            except FileNotFoundError:
+                return None
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                # 等锁期间文件可能已被 compact 替换，要锁住替换后的新文件
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _follow(self, f: BinaryIO) -> tuple[bytes, bool]:
+        inode = os.fstat(f.fileno()).st_ino
+        reset = inode != self.inode
+        if reset:
+            self.inode = inode
+            self.offset = 0
+        f.seek(self.offset)
+        data = f.read()
+        self.offset += len(data)
+        return data, reset
+
+    def append(self, data: bytes):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = self._open_locked(os.O_WRONLY | os.O_APPEND | os.O_CREAT, exclusive=True)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            # 关闭描述符即释放锁
+            os.close(fd)
+
+    def read_new(self) -> tuple[bytes, bool]:
+        """
+        The bytes appended since the previous call, by any worker, and whether the file was replaced or read for the
+        first time, in which case they are the whole file.
+        """
+        fd = self._open_locked(os.O_RDONLY, exclusive=False)
+        if fd is None:
+            return b"", False
+        with os.fdopen(fd, "rb") as f:
+            return self._follow(f)
+
+    def compact(self, rewrite: Callable[[bytes], bytes]) -> tuple[bytes, bool]:
+        """
+        Replace the file with ``rewrite(whole file)``. Appends wait for the lock meanwhile, so none of them is lost.
+
+        Returns what ``read_new`` would have returned just before, since reading on after the rewrite would skip it.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = self._open_locked(os.O_RDWR | os.O_CREAT, exclusive=True)
+        with os.fdopen(fd, "r+b") as f:
+            new, reset = self._follow(f)
+            f.seek(0)
+            data = rewrite(f.read())
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "wb") as temp:
+                temp.write(data)
+            os.replace(temp_path, self.path)
+            self.inode = os.stat(self.path).st_ino
+            self.offset = len(data)
+        return new, reset
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import threading
+import time
+from dataclasses import dataclass, asdict
+from decimal import Decimal, InvalidOperation
+from app.internal.config import get_config
+from app.internal.logging import logger
+from app.internal.metrics import registry
+from app.internal.shared_log import SharedLog
+
+UsageKey = tuple[str, str, str]
+
+
+@dataclass
+class UsageAggregate:
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    total_price: Decimal = Decimal(0)
+    latency: float = 0.0
+    currency: str = ""
+
+    def add(self, other: "UsageAggregate"):
+        self.requests += other.requests
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.total_tokens += other.total_tokens
+        self.total_price += other.total_price
+        self.latency += other.latency
+        self.currency = other.currency or self.currency
+
+    def as_dict(self) -> dict:
+        data = asdict(self)
+        data["total_price"] = str(self.total_price)
+        return data
+
+
+def _price(value) -> Decimal:
+    try:
+        return Decimal(str(value))
+    except (InvalidOperation, TypeError):
+        return Decimal(0)
+
+
+class UsageLedger:
+    """
+    Token usage per (client name, user, mode).
+
+    ``record`` only touches memory so it is safe to call from the SSE relay. ``flush`` appends what was recorded since
+    the previous flush to a JSON lines file shared by all workers, and ``refresh`` folds in whatever any worker
+    appended since the last refresh, so every worker reports the same totals, give or take what the others have not
+    flushed yet.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.log = SharedLog(path)
+        # 所有 worker 已经写入文件的用量
+        self.totals: dict[UsageKey, UsageAggregate] = {}
+        # 本 worker 还没写入文件的用量
+        self.pending: dict[UsageKey, UsageAggregate] = {}
+        # 并发的 refresh 各自在线程中读同一个偏移，要串行，否则记录会被重复累计或漏掉
+        self._refresh_lock = threading.Lock()
+
+    def record(self, client: str, user: str, mode: str, usage: dict):
+        aggregate = UsageAggregate(requests=1,
+                                   prompt_tokens=int(usage.get("prompt_tokens") or 0),
+                                   completion_tokens=int(usage.get("completion_tokens") or 0),
+                                   total_tokens=int(usage.get("total_tokens") or 0),
+                                   total_price=_price(usage.get("total_price")),
+                                   latency=float(usage.get("latency") or 0),
+                                   currency=usage.get("currency") or "")
+        self.pending.setdefault((client, user, mode), UsageAggregate()).add(aggregate)
+        tokens_used.inc(client, mode, "prompt", amount=aggregate.prompt_tokens)
+        tokens_used.inc(client, mode, "completion", amount=aggregate.completion_tokens)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        now = int(time.time())
+        lines = []
+        for (client, user, mode), aggregate in pending.items():
+            record = {"ts": now, "client": client, "user": user, "mode": mode, **aggregate.as_dict()}
+            lines.append(json.dumps(record, ensure_ascii=False))
+        await asyncio.to_thread(self.log.append, ("\n".join(lines) + "\n").encode("utf-8"))
+
+    def refresh(self):
+        """Fold in the records appended by every worker since the previous refresh, blocking, run it in a thread."""
+        with self._refresh_lock:
+            self._refresh()
+
+    def _refresh(self):
+        data, reset = self.log.read_new()
+        totals = {} if reset else dict(self.totals)
+        for line in data.decode("utf-8").splitlines():
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                key = (record.pop("client"), record.pop("user"), record.pop("mode"))
+                record.pop("ts", None)
+                record["total_price"] = _price(record.get("total_price"))
+                aggregate = UsageAggregate()
+                aggregate.add(totals.get(key, UsageAggregate()))
+                aggregate.add(UsageAggregate(**record))
+                totals[key] = aggregate
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"skip malformed usage record: {e}")
+        # 在线程中构建好再整体替换，事件循环上读到的总是完整的结果
+        self.totals = totals
+
+    def report(self, client: str | None = None, user: str | None = None, mode: str | None = None) -> list[dict]:
+        merged: dict[UsageKey, UsageAggregate] = {}
+        for source in (self.totals, self.pending):
+            for key, aggregate in source.items():
+                merged.setdefault(key, UsageAggregate()).add(aggregate)
+        rows = []
+        for (row_client, row_user, row_mode), aggregate in merged.items():
+            if (client and row_client != client) or (user and row_user != user) or (mode and row_mode != mode):
+                continue
+            requests = aggregate.requests or 1
+            rows.append({
+                "client": row_client,
+                "user": row_user,
+                "mode": row_mode,
+                **aggregate.as_dict(),
+                "tokens_per_request": aggregate.total_tokens / requests,
+                "price_per_request": str(aggregate.total_price / requests),
+                "latency_per_request": aggregate.latency / requests,
+            })
+        return sorted(rows, key=lambda row: row["tokens_per_request"], reverse=True)
+
+
+tokens_used = registry.counter("dify_tokens_total", "Tokens reported by message_end events", ("client", "mode", "kind"))
+
+_ledger: UsageLedger | None = None
+_flusher: asyncio.Task | None = None
+
+
+def get_usage_ledger() -> UsageLedger:
+    global _ledger
+    if _ledger is None:
+        _ledger = UsageLedger(get_config().usage.path)
+    return _ledger
+
+
+async def _flush_periodically(ledger: UsageLedger, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await ledger.flush()
+        except OSError as e:
+            logger.error(f"failed to flush usage: {e}")
+
+
+async def start_usage_flusher():
+    global _flusher
+    config = get_config().usage
+    if not config.enabled:
+        return
+    ledger = get_usage_ledger()
+    await asyncio.to_thread(ledger.refresh)
+    _flusher = asyncio.create_task(_flush_periodically(ledger, config.flush_interval))
+
+
+async def stop_usage_flusher():
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        _flusher = None
+    if _ledger is not None:
+        await _ledger.flush()
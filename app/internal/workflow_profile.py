@@ -0,0 +1,269 @@
+import time
+from collections import deque
+from typing import Callable
+from dataclasses import dataclass, field
+from app.internal.config import get_config
+from app.internal.dify.models.decoder import LazyEvent
+from app.internal.dify.models.workflow import (DifyEventType as WorkflowEventType, NodeFinishedEvent,
+                                               ParallelBranchFinishedEvent, ParallelBranchStartedEvent,
+                                               WorkflowFinishedEvent, WorkflowStartedEvent)
+from app.internal.metrics import registry
+
+
+def percentile(values, q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+@dataclass
+class Samples:
+    """Count, failures and the last ``size`` values of one measured thing."""
+    size: int
+    count: int = 0
+    failures: int = 0
+    total: float = 0.0
+    values: deque = field(init=False)
+
+    def __post_init__(self):
+        self.values = deque(maxlen=self.size)
+
+    def add(self, value: float | None, failed: bool = False):
+        self.count += 1
+        self.failures += failed
+        if value is not None:
+            self.total += value
+            self.values.append(value)
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "failure_rate": self.failures / self.count if self.count else 0.0,
+            "p50": percentile(self.values, 0.5),
+            "p95": percentile(self.values, 0.95),
+            "total": self.total,
+        }
+
+
+@dataclass
+class NodeProfile:
+    title: str | None
+    node_type: str | None
+    parallel_id: str | None
+    latency: Samples
+    tokens: int = 0
+    price: float = 0.0
+    critical: int = 0
+
+    def as_dict(self, runs: int) -> dict:
+        return {
+            "title": self.title,
+            "node_type": self.node_type,
+            "parallel_id": self.parallel_id,
+            "latency": self.latency.as_dict(),
+            "tokens": self.tokens,
+            "tokens_per_run": self.tokens / self.latency.count if self.latency.count else 0.0,
+            "price": self.price,
+            "critical_path_share": self.critical / runs if runs else 0.0,
+        }
+
+
+@dataclass
+class WorkflowProfile:
+    latency: Samples
+    critical_path: Samples
+    steps: Samples
+    nodes: dict[str, NodeProfile] = field(default_factory=dict)
+    # (parallel_id, 分支起始节点) -> 分支耗时
+    branches: dict[tuple[str, str], Samples] = field(default_factory=dict)
+    critical_branches: dict[tuple[str, str], int] = field(default_factory=dict)
+    tokens: int = 0
+
+
+class WorkflowProfiler:
+    """
+    Per workflow and per node latency, token cost and failure rate aggregated across runs.
+
+    Node latencies are Dify's own ``elapsed_time``. The critical path of a run is the chain of predecessors of the
+    node that finished last, the nodes that actually held the run up while parallel branches ran beside them; its
+    time is the sum of their latencies. Parallel branches are timed from their started to their finished event as
+    seen by this app, and the slowest branch of each parallel block counts as its critical one.
+
+    Percentiles are over the last ``samples`` values of each series.
+    """
+
+    def __init__(self, samples: int):
+        self.samples = samples
+        self.workflows: dict[str, WorkflowProfile] = {}
+
+    def _workflow(self, workflow_id: str) -> WorkflowProfile:
+        profile = self.workflows.get(workflow_id)
+        if profile is None:
+            profile = self.workflows[workflow_id] = WorkflowProfile(Samples(self.samples), Samples(self.samples),
+                                                                    Samples(self.samples))
+        return profile
+
+    def track(self) -> "RunTracker":
+        return RunTracker(self)
+
+    def stats(self) -> dict:
+        result = {}
+        for workflow_id, profile in self.workflows.items():
+            runs = profile.latency.count
+            result[workflow_id] = {
+                "runs": runs,
+                "latency": profile.latency.as_dict(),
+                "critical_path": profile.critical_path.as_dict(),
+                "steps": profile.steps.as_dict(),
+                "tokens": profile.tokens,
+                "nodes": {
+                    node_id: node.as_dict(runs)
+                    for node_id, node in sorted(profile.nodes.items(), key=lambda item: -item[1].latency.total)
+                },
+                "parallel_branches": {
+                    f"{parallel_id}/{start_node_id}": {
+                        **samples.as_dict(), "critical_share":
+                        profile.critical_branches.get((parallel_id, start_node_id), 0) / samples.count
+                    }
+                    for (parallel_id, start_node_id), samples in profile.branches.items()
+                },
+            }
+        return result
+
+    def folded(self) -> str:
+        """
+        Total node time in folded stack format, ``workflow;parallel;node milliseconds`` per line, which
+        flamegraph.pl and speedscope read as is.
+        """
+        lines = []
+        for workflow_id, profile in self.workflows.items():
+            for node_id, node in profile.nodes.items():
+                frames = [f"workflow {workflow_id}"]
+                if node.parallel_id:
+                    frames.append(f"parallel {node.parallel_id}")
+                frames.append(f"{node.title or node_id} ({node.node_type or 'node'})")
+                # 分号和空格是格式的分隔符
+                stack = ";".join(frame.replace(";", ",") for frame in frames)
+                lines.append(f"{stack} {round(node.latency.total * 1000)}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+@dataclass
+class _NodeRun:
+    predecessor: str | None
+    elapsed: float
+    order: int
+
+
+class RunTracker:
+    """
+    Follows the events of one workflow run, folding node results into the profiler as they finish and the run's
+    totals and critical path once ``workflow_finished`` arrives. A run cut short contributes only its finished nodes.
+    """
+
+    def __init__(self, profiler: WorkflowProfiler):
+        self.profiler = profiler
+        self.workflow_id: str | None = None
+        self.nodes: dict[str, _NodeRun] = {}
+        self.finished_nodes = 0
+        self.branch_started: dict[tuple[str, str], float] = {}
+        self.branch_elapsed: dict[tuple[str, str], tuple[float, bool]] = {}
+
+    @property
+    def handlers(self) -> dict[str, Callable[[LazyEvent], None]]:
+        """SSERelay handlers feeding this tracker."""
+        return {
+            event: lambda lazy_event: self.observe(lazy_event.model)
+            for event in (WorkflowEventType.WORKFLOW_STARTED.value, WorkflowEventType.NODE_FINISHED.value,
+                          WorkflowEventType.WORKFLOW_FINISHED.value, WorkflowEventType.PARALLEL_BRANCH_STARTED.value,
+                          WorkflowEventType.PARALLEL_BRANCH_FINISHED.value)
+        }
+
+    def observe(self, event):
+        if isinstance(event, WorkflowStartedEvent):
+            self.workflow_id = event.data.workflow_id
+        elif self.workflow_id is None:
+            return
+        elif isinstance(event, NodeFinishedEvent):
+            self._node_finished(event)
+        elif isinstance(event, ParallelBranchStartedEvent) and event.data is not None:
+            self.branch_started[(event.data.parallel_id, event.data.parallel_start_node_id)] = time.monotonic()
+        elif isinstance(event, ParallelBranchFinishedEvent) and event.data is not None:
+            key = (event.data.parallel_id, event.data.parallel_start_node_id)
+            if key in self.branch_started:
+                self.branch_elapsed[key] = (time.monotonic() - self.branch_started.pop(key),
+                                            event.data.status == "failed")
+        elif isinstance(event, WorkflowFinishedEvent):
+            self._finished(event)
+
+    def _node_finished(self, event: NodeFinishedEvent):
+        data = event.data
+        profile = self.profiler._workflow(self.workflow_id)
+        node = profile.nodes.get(data.node_id)
+        if node is None:
+            node = profile.nodes[data.node_id] = NodeProfile(data.title, data.node_type, data.parallel_id,
+                                                             Samples(self.profiler.samples))
+        node.title = data.title or node.title
+        node.node_type = data.node_type or node.node_type
+        node.latency.add(data.elapsed_time, failed=data.status == "failed")
+        metadata = data.execution_metadata
+        if metadata is not None:
+            node.tokens += metadata.total_tokens or 0
+            node.price += metadata.total_price or 0.0
+            profile.tokens += metadata.total_tokens or 0
+        node_latency.observe(self.workflow_id, data.node_id, value=data.elapsed_time or 0.0)
+        # 迭代中的节点会多次执行，累计到同一个节点上
+        previous = self.nodes.get(data.node_id)
+        self.finished_nodes += 1
+        self.nodes[data.node_id] = _NodeRun(data.predecessor_node_id,
+                                            (data.elapsed_time or 0.0) + (previous.elapsed if previous else 0.0),
+                                            self.finished_nodes)
+
+    def _finished(self, event: WorkflowFinishedEvent):
+        data = event.data
+        profile = self.profiler._workflow(self.workflow_id)
+        profile.latency.add(data.elapsed_time, failed=data.status != "succeeded")
+        profile.steps.add(data.total_steps)
+        critical = self._critical_path()
+        profile.critical_path.add(sum(self.nodes[node_id].elapsed for node_id in critical) if critical else None)
+        for node_id in critical:
+            if node_id in profile.nodes:
+                profile.nodes[node_id].critical += 1
+        parallels: dict[str, tuple[str, float]] = {}
+        for (parallel_id, start_node_id), (elapsed, failed) in self.branch_elapsed.items():
+            samples = profile.branches.get((parallel_id, start_node_id))
+            if samples is None:
+                samples = profile.branches[(parallel_id, start_node_id)] = Samples(self.profiler.samples)
+            samples.add(elapsed, failed)
+            if parallel_id not in parallels or elapsed > parallels[parallel_id][1]:
+                parallels[parallel_id] = (start_node_id, elapsed)
+        for parallel_id, (start_node_id, _) in parallels.items():
+            key = (parallel_id, start_node_id)
+            profile.critical_branches[key] = profile.critical_branches.get(key, 0) + 1
+        self.workflow_id = None
+
+    def _critical_path(self) -> list[str]:
+        if not self.nodes:
+            return []
+        node_id = max(self.nodes, key=lambda node: self.nodes[node].order)
+        path = []
+        while node_id in self.nodes and node_id not in path:
+            path.append(node_id)
+            node_id = self.nodes[node_id].predecessor
+        return path
+
+
+node_latency = registry.histogram("workflow_node_latency_seconds",
+                                  "Dify workflow node execution time as reported by node_finished",
+                                  ("workflow", "node"),
+                                  buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+_profiler: WorkflowProfiler | None = None
+
+
+def get_workflow_profiler() -> WorkflowProfiler:
+    global _profiler
+    if _profiler is None:
+        _profiler = WorkflowProfiler(get_config().workflow_profile.samples)
+    return _profiler
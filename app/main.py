@@ -3,16 +3,44 @@ from dotenv import load_dotenv
 load_dotenv()
 import app.internal as internel
 
+import os
+from contextlib import asynccontextmanager
 import fastapi
 from fastapi import HTTPException
-from app.routers import glossary
+from app.routers import glossary, workflow, stats, metrics
 from fastapi.middleware.cors import CORSMiddleware
+from app.internal.dify import pool
+from app.internal.dify.stream import active_streams
+from app.internal.dify.errors import UpstreamUnavailableError, DeadlineExceededError
+from app.internal.metrics import MetricsMiddleware
+from app.internal import usage, reload, answer_index
 
-app = fastapi.FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    await pool.open_pool()
+    await usage.start_usage_flusher()
+    await answer_index.start_answer_indexer()
+    await reload.start_config_watcher()
+    yield
+    await reload.stop_config_watcher()
+    if active_streams:
+        internel.logger.warning(f"shutting down with {len(active_streams)} streams still open")
+    await usage.stop_usage_flusher()
+    await answer_index.stop_answer_indexer()
+    await pool.close_pool()
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
 
 app.include_router(glossary.router)
+app.include_router(workflow.router)
+app.include_router(stats.router)
+app.include_router(metrics.router)
 
 app.add_exception_handler(HTTPException, internel.http_exception_handler)
+app.add_exception_handler(UpstreamUnavailableError, internel.unavailable_handler)
+app.add_exception_handler(DeadlineExceededError, internel.deadline_handler)
 app.add_exception_handler(Exception, internel.exception_handler)
 app.add_middleware(
     CORSMiddleware,
@@ -21,6 +49,7 @@ app.add_middleware(
     allow_methods=["GET", "POST", "PATCH", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 
 def start():
@@ -28,3 +57,32 @@ def start():
     internel.logger.info("Starting ai endpoint...")
     internel.get_config()
     uvicorn.run("app.main:app", host="0.0.0.0", port=11160, log_config=None, reload=True)
+
+
+def serve():
+    """
+    Production entry point: several worker processes, no reloader.
+
+    The config is bootstrapped here, before the workers are forked, so they never race on rewriting config.toml.
+
+    Workers share only files. The usage ledger, the answer index and the key pins of apps with several API keys are
+    append-only files that every worker follows, and cached answers and audio are read from the shared disk cache.
+    Everything else is per worker: the in-memory caches, admission buckets, concurrency limits, circuit breakers, key
+    load and eviction and the ``/metrics`` and ``/stats`` figures other than usage. Per-user admission rates and
+    limiter targets therefore apply per worker, and scrapes should go to every worker, or ``workers = 1`` should be
+    used where exact figures matter.
+    """
+    import uvicorn
+    from app.internal.config import bootstrap_config
+    server = bootstrap_config().server
+    workers = server.workers or os.cpu_count() or 1
+    internel.logger.info(f"Starting ai endpoint with {workers} workers on {server.host}:{server.port}, "
+                         f"loop: {server.loop}, http: {server.http}")
+    uvicorn.run("app.main:app",
+                host=server.host,
+                port=server.port,
+                workers=workers,
+                loop=server.loop,
+                http=server.http,
+                timeout_graceful_shutdown=server.graceful_timeout,
+                log_config=None)
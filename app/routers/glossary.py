@@ -1,13 +1,27 @@
 import asyncio
-from typing import AsyncGenerator, Annotated, Optional
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Path, Body, Query
-from fastapi.responses import StreamingResponse, JSONResponse
+import os
+import time
+from typing import Annotated, Optional
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Path, Body, Query, Header, Depends, Request
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from starlette.types import Receive, Scope, Send
 from pydantic import BaseModel
 from enum import Enum
 from app.internal.dify import get_chat_client
-from app.internal.dify.models.workflow import DifyEventType, BaseEvent
-from app.internal import logger
-from httpx import Response
+from app.internal.dify.stream import SSERelay
+from app.internal.dify.multipart import UploadTooLargeError
+from app.internal.dify.audio_cache import AudioCache, CachedAudio, get_audio_cache
+from app.internal.dify.answer_cache import AnswerCache, CachedAnswer, get_answer_cache
+from app.internal import answer_index
+from app.internal.dify.models.chat import DifyEventType as ChatEventType, decoder as chat_decoder
+from app.internal.dify.models.decoder import LazyEvent
+from app.internal.usage import get_usage_ledger
+from app.internal.admission import admission, admission_on_miss, admit
+from app.internal.deadline import request_deadline
+from app.internal import logger, get_config
+from app.utils.http import parse_range
+from urllib.parse import quote
+import httpx
 from app.internal.dify.models import FileMeta, FileType
 import json
 
@@ -17,6 +31,13 @@ _CLIENT_NAME = "glossary"
 
 _USERNAME = "heliannuuthus"
 
+# 调用上游的接口都要先经过准入，截止时间先于准入解析，排队时间也算在内
+_admitted = [Depends(request_deadline), Depends(admission(_CLIENT_NAME, "interactive"))]
+# 先查缓存的接口在缓存未命中后才准入，命中缓存不消耗令牌
+_deadline = [Depends(request_deadline)]
+# 读取接口的缓存在客户端里，由客户端在调用上游前准入
+_admitted_on_miss = [Depends(request_deadline), Depends(admission_on_miss(_CLIENT_NAME, "interactive"))]
+
 
 class FeedbackRequest(BaseModel):
     rating: Optional[str] = None
@@ -33,14 +54,14 @@ async def file_types():
         })
 
 
-@router.get("/conversations")
+@router.get("/conversations", dependencies=_admitted_on_miss)
 async def conversations(limit: Annotated[int, Query()] = 20):
     client = get_chat_client(_CLIENT_NAME)
     response = await client.get_conversations(_USERNAME, limit=limit)
     return response.json()
 
 
-@router.get("/conversations/{conversation_id}/messages")
+@router.get("/conversations/{conversation_id}/messages", dependencies=_admitted_on_miss)
 async def conversation_messages(conversation_id: Annotated[str, Path()],
                                 limit: Annotated[int, Query()] = 20,
                                 first_id: Annotated[str, Query()] = None):
@@ -50,7 +71,7 @@ async def conversation_messages(conversation_id: Annotated[str, Path()],
     return response.json()
 
 
-@router.post("/feedback")
+@router.post("/feedback", dependencies=_admitted)
 async def feedback(message_id: Annotated[str, Path()], request: Annotated[FeedbackRequest, Body()]):
     logger.info(f"feedback request: {request}")
 
@@ -60,7 +81,7 @@ async def feedback(message_id: Annotated[str, Path()], request: Annotated[Feedba
     return response.json()
 
 
-@router.get("/suggested/{message_id}/")
+@router.get("/suggested/{message_id}/", dependencies=_admitted_on_miss)
 async def suggested(message_id: Annotated[str, Path()]):
     client = get_chat_client(_CLIENT_NAME)
     response = await client.get_suggested(message_id, _USERNAME)
@@ -68,7 +89,15 @@ async def suggested(message_id: Annotated[str, Path()]):
     return response.json()
 
 
-@router.post("/upload")
+def _upload_limit(file: UploadFile, file_type: FileType | None) -> int | None:
+    # 未知类型照常转发给 Dify，使用默认上限
+    limit = get_config().upload.limit_for(file_type.value[0] if file_type is not None else None)
+    if limit is not None and file.size is not None and file.size > limit:
+        raise HTTPException(status_code=413, detail=f"{file.filename} exceeds the upload limit of {limit} bytes")
+    return limit
+
+
+@router.post("/upload", dependencies=_admitted)
 async def upload(file: Annotated[UploadFile, Form()], user: Annotated[str, Form()] = None):
 
     logger.info(f"upload file: {file.filename}, user: {user}")
@@ -76,21 +105,33 @@ async def upload(file: Annotated[UploadFile, Form()], user: Annotated[str, Form(
     if file.filename is None:
         raise HTTPException(status_code=400, detail="No file uploaded")
 
+    limit = _upload_limit(file, FileType.from_extension(os.path.splitext(file.filename)[1]))
     client = get_chat_client(_CLIENT_NAME)
 
-    response = await client.file_upload(_USERNAME,
-                                        files={"file": (file.filename, await file.read(), file.content_type)})
+    try:
+        response = await client.file_upload(_USERNAME,
+                                            files={"file": (file.filename, file, file.content_type)},
+                                            limits={"file": limit},
+                                            sizes={"file": file.size})
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     if response.status_code // 100 != 2:
         logger.error(f"Failed to upload file, code: {response.status_code}, message: {response.text}")
         raise HTTPException(status_code=400, detail="Failed to upload file")
     return FileMeta.from_response(**response.json())
 
 
-@router.post("/audio-to-text")
+@router.post("/audio-to-text", dependencies=_admitted)
 async def audio_to_text(file: Annotated[UploadFile, Form()]):
+    limit = _upload_limit(file, FileType.AUDIO)
     client = get_chat_client(_CLIENT_NAME)
-    response = await client.audio_to_text(_USERNAME,
-                                          files={"file": (file.filename, await file.read(), file.content_type)})
+    try:
+        response = await client.audio_to_text((file.filename, file, file.content_type),
+                                              _USERNAME,
+                                              limit=limit,
+                                              size=file.size)
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     response.raise_for_status()
     return response.json()
 
@@ -98,22 +139,84 @@ async def audio_to_text(file: Annotated[UploadFile, Form()]):
 class TextToAudioRequest(BaseModel):
     text: Optional[str] = None
     id: Optional[str] = None
-
-
-@router.post("/text-to-audio")
-async def text_to_audio(request: Annotated[TextToAudioRequest, Body()]):
+    voice: Optional[str] = None
+
+
+class _AudioResponse(StreamingResponse):
+    """Streams a range of a cached audio file and unmaps it however the response ends."""
+
+    def __init__(self, audio: CachedAudio, start: int, end: int, **kwargs):
+        super().__init__(audio.iter_range(start, end), media_type=audio.media_type, **kwargs)
+        self.audio = audio
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        # 客户端提前断开时 body 可能一次都没有迭代，不能靠迭代器关闭
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.audio.close()
+
+
+def _audio_response(audio: CachedAudio, key: str, range_header: str | None) -> Response:
+    headers = {"Accept-Ranges": "bytes", "Content-Location": f"{router.prefix}/text-to-audio/{key}"}
+    try:
+        byte_range = parse_range(range_header, audio.size)
+    except ValueError:
+        headers["Content-Range"] = f"bytes */{audio.size}"
+        audio.close()
+        return Response(status_code=416, headers=headers)
+    start, end = byte_range or (0, audio.size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if byte_range is not None:
+        headers["Content-Range"] = f"bytes {start}-{end}/{audio.size}"
+    return _AudioResponse(audio, start, end, status_code=206 if byte_range is not None else 200, headers=headers)
+
+
+@router.post("/text-to-audio", dependencies=_deadline)
+async def text_to_audio(http_request: Request,
+                        request: Annotated[TextToAudioRequest, Body()],
+                        range_header: Annotated[str | None, Header(alias="range")] = None):
+    cache = get_audio_cache() if get_config().audio_cache.enabled else None
+    key = AudioCache.key(request.text, request.id, request.voice)
+    if cache is not None and (audio := await asyncio.to_thread(cache.open, key)) is not None:
+        return _audio_response(audio, key, range_header)
+
+    await admit(http_request, _CLIENT_NAME, "interactive")
     client = get_chat_client(_CLIENT_NAME)
-    response = await client.text_to_audio(
-        request.text,
-        request.id,
-        _USERNAME,
-    )
-    response.raise_for_status()
-    logger.info(f"text to audio response: {response.json()}")
-    return response.json()
-
-
-@router.post("chat/{task_id}/stop")
+    response = await client.text_to_audio(request.id, request.text, _USERNAME, voice=request.voice)
+    if not response.is_success:
+        await response.aread()
+        await response.aclose()
+        logger.error(f"Failed to generate audio, code: {response.status_code}, message: {response.text}")
+        raise HTTPException(status_code=response.status_code, detail="Failed to generate audio")
+    media_type = response.headers.get("content-type", "audio/mpeg")
+    if cache is None:
+        return StreamingResponse(_relay_bytes(response), media_type=media_type)
+    return StreamingResponse(cache.tee(key, response),
+                             media_type=media_type,
+                             headers={"Content-Location": f"{router.prefix}/text-to-audio/{key}"})
+
+
+@router.get("/text-to-audio/{key}")
+async def cached_audio(key: Annotated[str, Path(pattern="^[0-9a-f]{64}$")],
+                       range_header: Annotated[str | None, Header(alias="range")] = None):
+    if not get_config().audio_cache.enabled:
+        raise HTTPException(status_code=404, detail="Audio not found")
+    audio = await asyncio.to_thread(get_audio_cache().open, key)
+    if audio is None:
+        raise HTTPException(status_code=404, detail="Audio not found")
+    return _audio_response(audio, key, range_header)
+
+
+async def _relay_bytes(response: httpx.Response):
+    try:
+        async for chunk in response.aiter_bytes():
+            yield chunk
+    finally:
+        await response.aclose()
+
+
+@router.post("chat/{task_id}/stop", dependencies=_admitted)
 async def stop_conversation(task_id: Annotated[str, Path()]):
     client = get_chat_client(_CLIENT_NAME)
     response = await client.stop_message(task_id, _USERNAME)
@@ -133,8 +236,51 @@ class GlossaryRequest(BaseModel):
     files_meta: list[FileMeta] = []
 
 
-@router.post("/chat")
-async def glossary(request: GlossaryRequest) -> StreamingResponse:
+def _answer_cache_key(request: GlossaryRequest, cache_control: str | None) -> tuple[str | None, bool]:
+    """
+    The answer cache key of a chat request and whether a cached answer may be served.
+
+    No key is given for follow-ups in a conversation, whose answer depends on its history, nor for
+    ``Cache-Control: no-store``; ``no-cache`` skips the lookup but still stores the fresh answer.
+    """
+    directives = {directive.strip().lower() for directive in (cache_control or "").split(",")}
+    if not get_config().answer_cache.enabled or request.conversation_id or "no-store" in directives:
+        return None, False
+    key = AnswerCache.key(request.query, request.mode.value if request.mode else None,
+                          (file_meta.id for file_meta in request.files_meta))
+    return key, "no-cache" not in directives
+
+
+async def _cached_answer(request: GlossaryRequest, key: str) -> tuple[CachedAnswer | None, dict[str, str]]:
+    """
+    The cached answer of ``key``, or else of the most similar answered query when ``answer_index.serve_similarity``
+    is set, with the response headers telling which one was served.
+    """
+    cache = get_answer_cache()
+    answer = await cache.get(key)
+    if answer is not None:
+        return answer, {"X-Answer-Cache": "hit"}
+    threshold = get_config().answer_index.serve_similarity
+    if threshold <= 0 or request.files_meta or not get_config().answer_index.enabled:
+        return None, {}
+    mode = request.mode.value if request.mode else "default"
+    for similar in answer_index.get_answer_index().search(request.query, k=1, mode=mode):
+        if similar["similarity"] >= threshold and (answer := await cache.get(similar["answer_key"])) is not None:
+            return answer, {"X-Answer-Cache": "similar", "X-Answered-Query": quote(similar["query"])}
+    return None, {}
+
+
+@router.get("/similar")
+async def similar_queries(query: Annotated[str, Query()],
+                          k: Annotated[int, Query(ge=1, le=50)] = 5,
+                          mode: Annotated[str | None, Query()] = None):
+    return answer_index.get_answer_index().search(query, k=k, mode=mode)
+
+
+@router.post("/chat", dependencies=_deadline)
+async def glossary(http_request: Request,
+                   request: GlossaryRequest,
+                   cache_control: Annotated[str | None, Header()] = None) -> StreamingResponse:
 
     logger.info(
         f"glossary request: {len(request.query) > 20 and request.query[:20] + '...' or request.query}, file: {request.files_meta}, mode: {request.mode}"
@@ -148,6 +294,17 @@ async def glossary(request: GlossaryRequest) -> StreamingResponse:
             raise HTTPException(status_code=400, detail=f"Invalid file type: {file_meta.name}")
         files[file_type] = file_meta
 
+    key, lookup = _answer_cache_key(request, cache_control)
+    if lookup:
+        answer, headers = await _cached_answer(request, key)
+        if answer is not None:
+            return StreamingResponse(AnswerCache.replay(answer,
+                                                        get_config().answer_cache.replay_rate),
+                                     media_type="text/event-stream",
+                                     headers=headers)
+
+    await admit(http_request, _CLIENT_NAME, "interactive")
+    started_at = time.perf_counter()
     response = await client.create_chat_message(query=request.query,
                                                 inputs={
                                                     "mode": request.mode.value if request.mode else None,
@@ -159,16 +316,33 @@ async def glossary(request: GlossaryRequest) -> StreamingResponse:
                                                     "transfer_method": "local_file",
                                                     "upload_file_id": file_meta.id,
                                                 } for file_type, file_meta in files.items()])
-    return StreamingResponse(parse_response(response), media_type="text/event-stream")
-
-
-async def parse_response(response: Response) -> AsyncGenerator[str, None]:
-    async for chunk in response.aiter_lines():
-        logger.info(f"chunk: {chunk}")
-        if chunk.startswith("data:"):
-            yield f"{chunk}\n\n"
-            await asyncio.sleep(0.1)
-        else:
-            logger.error(f"unknown chunk: {chunk}")
-    logger.info(f"close response")
-    await response.aclose()
+    mode = request.mode.value if request.mode else "default"
+    relay = parse_response(response, started_at, mode)
+    if key is None or not response.is_success:
+        return StreamingResponse(relay, media_type="text/event-stream")
+    on_stored = None
+    if not request.files_meta:
+        # 带文件的回答取决于文件内容，不作为相似问题的回答
+        on_stored = lambda frames: answer_index.submit(request.query, mode, key, frames)
+    return StreamingResponse(get_answer_cache().record(key, aiter(relay), on_stored=on_stored),
+                             media_type="text/event-stream",
+                             headers={"X-Answer-Cache": "miss"})
+
+
+def parse_response(response: httpx.Response, started_at: float | None = None, mode: str = "default") -> SSERelay:
+    handlers = {}
+    if get_config().usage.enabled:
+        handlers[ChatEventType.MESSAGE_END.value] = lambda event: _record_usage(event, mode)
+    return SSERelay(response,
+                    name=f"{_CLIENT_NAME}/chat",
+                    raw=get_config().stream.raw,
+                    started_at=started_at,
+                    decoder=chat_decoder,
+                    handlers=handlers,
+                    log_sample=get_config().stream.log_sample)
+
+
+def _record_usage(event: LazyEvent, mode: str):
+    usage = event.model.metadata.get("usage")
+    if usage:
+        get_usage_ledger().record(_CLIENT_NAME, _USERNAME, mode, usage)
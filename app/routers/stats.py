@@ -0,0 +1,89 @@
+import asyncio
+from typing import Annotated
+from fastapi import APIRouter, Query
+from fastapi.responses import PlainTextResponse
+from app.internal.dify.cache import get_response_cache
+from app.internal.dify import pool
+from app.internal.dify.coalesce import single_flight
+from app.internal.dify.client import key_pool_stats
+from app.internal.dify.limiter import limiter_stats
+from app.internal.dify.resilience import breaker_stats
+from app.internal.dify.audio_cache import get_audio_cache
+from app.internal.dify.answer_cache import get_answer_cache
+from app.internal.usage import get_usage_ledger
+from app.internal.admission import admission_stats
+from app.internal.answer_index import get_answer_index
+from app.internal.workflow_profile import get_workflow_profiler
+
+router = APIRouter(prefix="/stats", tags=["stats"])
+
+
+@router.get("/cache")
+async def cache_stats():
+    return get_response_cache().stats()
+
+
+@router.get("/pool")
+async def pool_stats():
+    return pool.stats.as_dict()
+
+
+@router.get("/coalesce")
+async def coalesce_stats():
+    return single_flight.stats()
+
+
+@router.get("/keys")
+async def keys_stats():
+    return key_pool_stats()
+
+
+@router.get("/limiter")
+async def upstream_limiter_stats():
+    return limiter_stats()
+
+
+@router.get("/breakers")
+async def circuit_breaker_stats():
+    return breaker_stats()
+
+
+@router.get("/admission")
+async def admission_queue_stats():
+    return admission_stats()
+
+
+@router.get("/audio-cache")
+async def audio_cache_stats():
+    return get_audio_cache().stats()
+
+
+@router.get("/answer-cache")
+async def answer_cache_stats():
+    return get_answer_cache().stats()
+
+
+@router.get("/answer-index")
+async def answer_index_stats():
+    return get_answer_index().stats()
+
+
+@router.get("/workflows")
+async def workflow_stats():
+    return get_workflow_profiler().stats()
+
+
+@router.get("/workflows/flamegraph", response_class=PlainTextResponse)
+async def workflow_flamegraph():
+    """Node time in folded stack format, for flamegraph.pl or speedscope."""
+    return get_workflow_profiler().folded()
+
+
+@router.get("/usage")
+async def usage_stats(client: Annotated[str | None, Query()] = None,
+                      user: Annotated[str | None, Query()] = None,
+                      mode: Annotated[str | None, Query()] = None):
+    ledger = get_usage_ledger()
+    # 其他 worker 写入的用量
+    await asyncio.to_thread(ledger.refresh)
+    return ledger.report(client=client, user=user, mode=mode)
@@ -0,0 +1,63 @@
+import time
+from typing import Annotated, Any
+from fastapi import APIRouter, HTTPException, Path, Body, Depends
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from app.internal.dify import get_workflow_client
+from app.internal.dify.stream import SSERelay
+from app.internal.dify.models.workflow import decoder as workflow_decoder
+from app.internal.admission import admission
+from app.internal.deadline import request_deadline
+from app.internal.workflow_profile import get_workflow_profiler
+from app.internal import get_config
+
+router = APIRouter(prefix="/workflow", tags=["workflow"])
+
+_CLIENT_NAME = "workflow"
+
+_USERNAME = "heliannuuthus"
+
+
+async def _configured():
+    if get_config().workflow is None:
+        raise HTTPException(status_code=404, detail="No workflow app is configured")
+
+
+# 运行工作流按最低的类别排队，停止要尽快送达
+_admitted = [Depends(_configured), Depends(request_deadline), Depends(admission(_CLIENT_NAME))]
+
+
+class WorkflowRequest(BaseModel):
+    inputs: dict[str, Any] = {}
+
+
+@router.post("/run", dependencies=_admitted)
+async def run(request: Annotated[WorkflowRequest, Body()]) -> StreamingResponse:
+    client = get_workflow_client(_CLIENT_NAME)
+    started_at = time.perf_counter()
+    response = await client.run(request.inputs, "streaming", _USERNAME)
+    if not response.is_success:
+        await response.aread()
+        await response.aclose()
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+    handlers = get_workflow_profiler().track().handlers if get_config().workflow_profile.enabled else None
+    return StreamingResponse(SSERelay(response,
+                                      name=f"{_CLIENT_NAME}/run",
+                                      raw=get_config().stream.raw,
+                                      started_at=started_at,
+                                      decoder=workflow_decoder,
+                                      handlers=handlers,
+                                      log_sample=get_config().stream.log_sample),
+                             media_type="text/event-stream")
+
+
+@router.post(
+    "/tasks/{task_id}/stop",
+    dependencies=[Depends(_configured),
+                  Depends(request_deadline),
+                  Depends(admission(_CLIENT_NAME, "interactive"))])
+async def stop(task_id: Annotated[str, Path()]):
+    client = get_workflow_client(_CLIENT_NAME)
+    response = await client.stop(task_id, _USERNAME)
+    response.raise_for_status()
+    return response.json()
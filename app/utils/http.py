@@ -4,3 +4,28 @@ def unambiguous(**kwargs):
 
 def pagination(page: int, per_page: int):
     return {"page": page, "per_page": per_page}
+
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """
+    Parse a single ``Range: bytes=start-end`` header into an inclusive ``(start, end)``.
+
+    Returns None when there is no usable range header, raises ValueError when the range cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[6:].strip().partition("-")
+    try:
+        if start:
+            first = int(start)
+            last = int(end) if end else size - 1
+        else:
+            first = size - int(end)
+            last = size - 1
+    except ValueError:
+        return None
+    first = max(first, 0)
+    last = min(last, size - 1)
+    if first > last:
+        raise ValueError(f"unsatisfiable range {header} for {size} bytes")
+    return first, last
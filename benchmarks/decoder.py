@@ -0,0 +1,77 @@
+"""
+Events/s of the SSE event decoder, before and after the shared precompiled decoder.
+
+    python -m benchmarks.decoder [--events 50000]
+"""
+import argparse
+import json
+import time
+from app.internal.dify.models import chat
+from app.internal.dify.models.chat import DifyEventType
+
+
+def legacy_form_raw(data: str):
+    # BaseEvent.form_raw before the shared decoder: event_map per call, stdlib json, full validation
+    if data.startswith("data: "):
+        data = data[6:]
+    event_dict = json.loads(data)
+    event_map = {
+        DifyEventType.MESSAGE.value: chat.MessageEvent,
+        DifyEventType.AGENT_MESSAGE.value: chat.AgentMessageEvent,
+        DifyEventType.AGENT_THOUGHT.value: chat.AgentThoughtEvent,
+        DifyEventType.MESSAGE_FILE.value: chat.MessageFileEvent,
+        DifyEventType.MESSAGE_END.value: chat.MessageEndEvent,
+        DifyEventType.TTS_MESSAGE.value: chat.TTSMessageEvent,
+        DifyEventType.TTS_MESSAGE_END.value: chat.TTSMessageEndEvent,
+        DifyEventType.MESSAGE_REPLACE.value: chat.MessageReplaceEvent,
+        DifyEventType.ERROR.value: chat.ErrorEvent,
+        DifyEventType.PING.value: chat.PingEvent,
+    }
+    return event_map[event_dict.get("event")](**event_dict)
+
+
+def synthetic_stream(events: int) -> list[str]:
+    common = {"task_id": "t" * 36, "message_id": "m" * 36, "conversation_id": "c" * 36, "created_at": 1700000000}
+    lines = []
+    for i in range(events - 1):
+        if i % 50 == 0:
+            lines.append("data: " + json.dumps({"event": "ping"}))
+        elif i % 10 == 0:
+            lines.append("data: " + json.dumps({"event": "tts_message", "audio": "A" * 512, **common}))
+        else:
+            lines.append("data: " + json.dumps({"event": "message", "answer": f"token {i} ", **common}))
+    usage = {"prompt_tokens": 10, "completion_tokens": events, "total_tokens": events + 10, "latency": 1.0}
+    lines.append("data: " + json.dumps({"event": "message_end", "metadata": {"usage": usage}, **common}))
+    return lines
+
+
+def measure(name: str, fn, lines: list[str]) -> float:
+    start = time.perf_counter()
+    for line in lines:
+        fn(line)
+    elapsed = time.perf_counter() - start
+    rate = len(lines) / elapsed
+    print(f"{name:<32} {rate:>12,.0f} events/s")
+    return rate
+
+
+def relay_lazy(line: str):
+    # relay path: only message_end is materialized, everything else is peeked
+    if chat.decoder.peek(line) == DifyEventType.MESSAGE_END.value:
+        return chat.decoder.lazy(line).model
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=50000)
+    args = parser.parse_args()
+    lines = synthetic_stream(args.events)
+    before = measure("legacy form_raw", legacy_form_raw, lines)
+    measure("BaseEvent.form_raw", chat.BaseEvent.form_raw, lines)
+    measure("decoder.decode (skip ping/tts)", chat.decoder.decode, lines)
+    after = measure("relay peek + lazy message_end", relay_lazy, lines)
+    print(f"speedup on the relay path: {after / before:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
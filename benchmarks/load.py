@@ -0,0 +1,212 @@
+"""
+End-to-end load test of ``/glossary/chat`` against the local mock Dify server, fully offline.
+
+Starts ``benchmarks.mock_dify`` and the app in separate processes, keeps ``--concurrency`` chat streams open for
+``--duration`` seconds and reports time to first byte, inter-event latency, completed streams per second and the
+app's resident memory per open stream.
+
+    python -m benchmarks.load [--concurrency 50] [--duration 20] [--workers 1] [--ttfb 0.2] [--token-rate 50]
+                              [--tokens 200] [--token-bytes 4] [--error-rate 0] [--stream-error-rate 0]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = """
+[glossary]
+api_key = "plaintext(app-glossary)"
+base_url = "{base_url}"
+
+[deep_search]
+api_key = "plaintext(app-deep-search)"
+base_url = "{base_url}"
+
+[deep_gemini]
+api_key = "plaintext(app-deep-gemini)"
+base_url = "{base_url}"
+
+[proxy]
+
+[usage]
+enabled = false
+
+[server]
+reload_interval = 0
+"""
+
+MOCK_OPTIONS = ("ttfb", "token_rate", "tokens", "token_bytes", "error_rate", "error_status", "stream_error_rate")
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def rss_mb(pids: list[int]) -> float:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        except (FileNotFoundError, StopIteration):
+            pass
+    return total / 1024
+
+
+def process_tree(pid: int) -> list[int]:
+    """``pid`` and its children, so the uvicorn workers are counted when ``--workers`` > 1."""
+    pids = [pid]
+    for child in os.listdir("/proc"):
+        if not child.isdigit():
+            continue
+        try:
+            with open(f"/proc/{child}/stat") as f:
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    pids.append(int(child))
+        except (FileNotFoundError, ProcessLookupError):
+            pass
+    return pids
+
+
+async def wait_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+class Results:
+
+    def __init__(self):
+        self.ttfb: list[float] = []
+        self.gaps: list[float] = []
+        self.completed = 0
+        self.errors: dict[str, int] = {}
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def one_stream(client: httpx.AsyncClient, results: Results):
+    started_at = time.perf_counter()
+    last_event_at = None
+    try:
+        async with client.stream("POST", "/glossary/chat", json={"query": "what is a glossary"}) as response:
+            if response.status_code != 200:
+                results.error(str(response.status_code))
+                return
+            async for chunk in response.aiter_bytes():
+                now = time.perf_counter()
+                if last_event_at is None:
+                    results.ttfb.append(now - started_at)
+                elif b"\n\n" in chunk:
+                    results.gaps.append(now - last_event_at)
+                if b"\n\n" in chunk:
+                    last_event_at = now
+                if b'"event": "error"' in chunk or b'"event":"error"' in chunk:
+                    results.error("stream_error")
+                    return
+        results.completed += 1
+    except httpx.HTTPError as e:
+        results.error(type(e).__name__)
+
+
+async def drive(base_url: str, concurrency: int, duration: float, app_pid: int) -> tuple[Results, float, float]:
+    results = Results()
+    deadline = time.monotonic() + duration
+    peak = 0.0
+
+    async def worker(client: httpx.AsyncClient):
+        while time.monotonic() < deadline:
+            await one_stream(client, results)
+
+    async def sample_rss():
+        nonlocal peak
+        while time.monotonic() < deadline:
+            peak = max(peak, rss_mb(process_tree(app_pid)))
+            await asyncio.sleep(0.5)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=None) as client:
+        started_at = time.perf_counter()
+        await asyncio.gather(sample_rss(), *(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started_at
+    return results, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--mock-port", type=int, default=18080)
+    parser.add_argument("--app-port", type=int, default=18081)
+    parser.add_argument("--ttfb", type=float, default=0.2)
+    parser.add_argument("--token-rate", type=float, default=50)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--token-bytes", type=int, default=4)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--stream-error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    mock_args = []
+    for name in MOCK_OPTIONS:
+        mock_args += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    processes = []
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, "config.toml")
+        with open(config_path, "w") as f:
+            f.write(CONFIG.format(base_url=f"http://127.0.0.1:{args.mock_port}/v1"))
+        env = {**os.environ, "PYTHONPATH": ROOT, "CONFIG": config_path, "LOG_LEVEL": "WARNING"}
+        try:
+            processes.append(
+                subprocess.Popen([sys.executable, "-m", "benchmarks.mock_dify", "--port",
+                                  str(args.mock_port)] + mock_args,
+                                 cwd=ROOT))
+            app = subprocess.Popen([
+                sys.executable, "-m", "uvicorn", "app.main:app", "--port",
+                str(args.app_port), "--workers",
+                str(args.workers), "--log-level", "warning", "--no-access-log"
+            ],
+                                   cwd=directory,
+                                   env=env)
+            processes.append(app)
+            base_url = f"http://127.0.0.1:{args.app_port}"
+            asyncio.run(wait_ready(f"http://127.0.0.1:{args.mock_port}/v1/conversations"))
+            asyncio.run(wait_ready(f"{base_url}/glossary/file-types"))
+            idle = rss_mb(process_tree(app.pid))
+            results, elapsed, peak = asyncio.run(drive(base_url, args.concurrency, args.duration, app.pid))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    print(f"concurrency {args.concurrency}, {elapsed:.1f}s, upstream ttfb {args.ttfb}s, "
+          f"{args.tokens} tokens at {args.token_rate}/s")
+    print(f"streams completed: {results.completed} ({results.completed / elapsed:.1f}/s), errors: {results.errors}")
+    for name, values in (("ttfb", results.ttfb), ("inter-event", results.gaps)):
+        print(f"{name:>12}: p50 {percentile(values, 0.5) * 1000:.1f} ms, p95 {percentile(values, 0.95) * 1000:.1f} ms, "
+              f"p99 {percentile(values, 0.99) * 1000:.1f} ms, mean {statistics.fmean(values or [0]) * 1000:.1f} ms")
+    print(f"app rss: idle {idle:.1f} MB, peak {peak:.1f} MB, "
+          f"{(peak - idle) * 1024 / args.concurrency:.1f} KB per open stream")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Event-loop time spent in logging while relaying a stream, with the old synchronous handlers and with the
+QueueHandler/QueueListener setup in ``app.internal.logging``.
+
+    python -m benchmarks.logging_block [--chunks 10000]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import queue
+import sys
+import tempfile
+import time
+from logging.handlers import QueueListener
+from app.internal.logging import DeferredQueueHandler, TimedRotatingFileNameHandler, log_formatter
+
+
+def build_handlers(directory: str) -> list[logging.Handler]:
+    console = logging.StreamHandler(open(os.devnull, "w"))
+    file = TimedRotatingFileNameHandler(os.path.join(directory, "bench.log"), "midnight", 1, 1, encoding="utf-8")
+    for handler in (console, file):
+        handler.setFormatter(log_formatter)
+    return [console, file]
+
+
+async def relay(logger: logging.Logger, chunks: int, per_chunk_info: bool) -> tuple[float, float]:
+    """Returns (seconds spent in logging calls, worst loop lag seen by a 1 ms ticker)."""
+    worst_lag = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal worst_lag
+        while running:
+            expected = time.perf_counter() + 0.001
+            await asyncio.sleep(0.001)
+            worst_lag = max(worst_lag, time.perf_counter() - expected)
+
+    probe = asyncio.create_task(ticker())
+    spent = 0.0
+    for i in range(chunks):
+        line = f'data: {{"event": "message", "answer": "token {i}"}}'
+        started_at = time.perf_counter()
+        if per_chunk_info:
+            logger.info(f"chunk: {line}")
+        elif i % 50 == 1:
+            logger.debug("stream %s event %d: %s", "bench", i, line)
+        spent += time.perf_counter() - started_at
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+    logger.info("stream %s closed, events: %d", "bench", chunks)
+    running = False
+    await probe
+    return spent, worst_lag
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        before = logging.getLogger("bench.sync")
+        before.propagate = False
+        before.setLevel(logging.INFO)
+        for handler in build_handlers(directory):
+            before.addHandler(handler)
+        spent, lag = asyncio.run(relay(before, args.chunks, per_chunk_info=True))
+        print(f"sync handlers, info per chunk   {spent * 1000:>8.1f} ms in logging  worst loop lag {lag * 1000:.1f} ms")
+
+        after = logging.getLogger("bench.queue")
+        after.propagate = False
+        after.setLevel(logging.INFO)
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, *build_handlers(directory), respect_handler_level=True)
+        listener.start()
+        after.addHandler(DeferredQueueHandler(log_queue))
+        spent, lag = asyncio.run(relay(after, args.chunks, per_chunk_info=True))
+        print(f"queue handler, info per chunk   {spent * 1000:>8.1f} ms in logging  worst loop lag {lag * 1000:.1f} ms")
+        spent, lag = asyncio.run(relay(after, args.chunks, per_chunk_info=False))
+        print(f"queue handler, sampled debug    {spent * 1000:>8.1f} ms in logging  worst loop lag {lag * 1000:.1f} ms")
+        listener.stop()
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""
+Run the micro-benchmarks and compare them against the committed baseline.
+
+    python -m benchmarks.micro                       # run, write latest.json, compare with baseline.json
+    python -m benchmarks.micro --save-baseline       # run and overwrite baseline.json
+    python -m benchmarks.micro -k events             # only some benchmarks, extra args go to pytest
+"""
+import argparse
+import os
+import sys
+import pytest
+from benchmarks.micro.compare import main as compare
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, "baseline.json")
+LATEST = os.path.join(HERE, "latest.json")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args, pytest_args = parser.parse_known_args()
+    output = BASELINE if args.save_baseline else LATEST
+    # bench_*.py 不匹配默认的 test_*.py，普通的 pytest 运行不会收集到它们
+    code = pytest.main([
+        HERE, "-q", "-p", "benchmarks.micro.plugin", "-o", "python_files=bench_*.py", "-p", "no:cacheprovider",
+        f"--bench-output={output}", *pytest_args
+    ])
+    if code != 0 or args.save_baseline or not os.path.exists(BASELINE):
+        return code
+    return compare([BASELINE, LATEST, f"--threshold={args.threshold}"])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,43 @@
+"""Argument cleanup and request building in ``DifyClient``, with the upstream replaced by an in-memory transport."""
+import asyncio
+import httpx
+import pytest
+from app.internal.dify import pool
+from app.internal.dify.client import DifyClient
+from app.utils.http import unambiguous
+
+PARAMS = {"user": "heliannuuthus", "last_id": None, "limit": 20, "pinned": None, "sort_by": "-updated_at"}
+DATA = {
+    "inputs": {
+        "mode": "translate"
+    },
+    "query": "what does glossary mean",
+    "user": "heliannuuthus",
+    "response_mode": "blocking",
+    "conversation_id": None,
+    "files": [],
+}
+
+
+@pytest.fixture
+def client(app_config, monkeypatch):
+    upstream = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json={})))
+    monkeypatch.setattr(pool, "_client", upstream)
+    loop = asyncio.new_event_loop()
+    yield DifyClient(api_key="bench", base_url="http://dify/v1"), loop
+    loop.run_until_complete(upstream.aclose())
+    loop.close()
+
+
+def test_unambiguous(bench):
+    assert bench(lambda: unambiguous(**PARAMS)) == {"user": "heliannuuthus", "limit": 20, "sort_by": "-updated_at"}
+
+
+@pytest.mark.parametrize("method", ["GET", "POST"])
+def test_send_request(bench, client, method):
+    dify, loop = client
+    if method == "GET":
+        call = lambda: loop.run_until_complete(dify._send_request("GET", "/conversations", params=PARAMS))
+    else:
+        call = lambda: loop.run_until_complete(dify._send_request("POST", "/chat-messages", DATA))
+    assert bench(call).status_code == 200
@@ -0,0 +1,44 @@
+"""``Config.wrap_api_key`` for a key that is already encrypted and for a ``plaintext(...)`` key being encrypted."""
+import base64
+import os
+import pytest
+from app.internal import config as config_module
+from app.internal.config import Config, ModelConfig
+
+
+@pytest.fixture
+def config() -> Config:
+    # 不读取 config.toml，只准备 wrap_api_key 需要的密钥
+    instance = Config.__new__(Config)
+    instance.API_KEY_DEK = os.urandom(32)
+    instance.API_KEY_NONCE = os.urandom(12)
+    instance.existed_dek = True
+    instance.changed = False
+    return instance
+
+
+def encrypted(config: Config, api_key: str) -> str:
+    model_config = ModelConfig(api_key=f"plaintext({api_key})")
+    config.wrap_api_key(model_config)
+    return model_config.api_key
+
+
+def test_decrypt(bench, config):
+    api_key = encrypted(config, "app-bench")
+
+    def decrypt():
+        config_module._decrypt.cache_clear()
+        return config.wrap_api_key(ModelConfig(api_key=api_key))
+
+    assert bench(decrypt) == "app-bench"
+
+
+def test_decrypt_cached(bench, config):
+    api_key = encrypted(config, "app-bench")
+    model_config = ModelConfig(api_key=api_key)
+    assert bench(lambda: config.wrap_api_key(model_config)) == "app-bench"
+
+
+def test_encrypt(bench, config):
+    ciphertext = bench(lambda: encrypted(config, "app-bench"))
+    assert base64.b64decode(ciphertext)
@@ -0,0 +1,143 @@
+"""Parsing throughput of one SSE frame per event type through ``BaseEvent.form_raw`` / ``from_raw``."""
+import json
+import pytest
+from app.internal.dify.models import chat, workflow
+
+IDS = {"task_id": "5ad4cb98", "message_id": "5e4e9d1f", "conversation_id": "45701982", "created_at": 1705395332}
+USAGE = {
+    "prompt_tokens": 1033,
+    "prompt_unit_price": "0.001",
+    "prompt_price_unit": "0.001",
+    "prompt_price": "0.0010330",
+    "completion_tokens": 135,
+    "completion_unit_price": "0.002",
+    "completion_price_unit": "0.001",
+    "completion_price": "0.0002700",
+    "total_tokens": 1168,
+    "total_price": "0.0013030",
+    "currency": "USD",
+    "latency": 1.381760165997548,
+}
+NODE = {"id": "b5d3b6a4", "node_id": "llm", "index": 2, "predecessor_node_id": "start", "created_at": 1705395332}
+
+CHAT_EVENTS = {
+    "message": {
+        "answer": "术语"
+    },
+    "agent_message": {
+        "answer": "术语"
+    },
+    "agent_thought": {
+        "id": "8dcf3648",
+        "position": 1,
+        "thought": "look it up",
+        "tool": "dictionary",
+        "tool_input": {
+            "dictionary": {
+                "word": "glossary"
+            }
+        }
+    },
+    "message_file": {
+        "id": "d75b7a5c",
+        "type": "image",
+        "belongs_to": "assistant",
+        "url": "https://example.com/a.png"
+    },
+    "message_end": {
+        "metadata": {
+            "usage": USAGE,
+            "retriever_resources": []
+        }
+    },
+    "tts_message": {
+        "audio": "qqqq" * 64
+    },
+    "message_replace": {
+        "answer": "replaced"
+    },
+    "error": {
+        "status": 500,
+        "code": "internal_error",
+        "message": "boom"
+    },
+    "ping": {},
+}
+
+WORKFLOW_EVENTS = {
+    "workflow_started": {
+        "data": {
+            "id": "fd3ddc76",
+            "workflow_id": "0b3c6e2a",
+            "sequence_number": 1,
+            "created_at": 1705395332
+        }
+    },
+    "node_started": {
+        "data": {
+            **NODE, "node_type": "llm",
+            "title": "LLM",
+            "inputs": {
+                "query": "glossary"
+            }
+        }
+    },
+    "node_finished": {
+        "data": {
+            **NODE, "status": "succeeded",
+            "outputs": {
+                "text": "术语" * 64
+            },
+            "elapsed_time": 1.2,
+            "execution_metadata": {
+                "total_tokens": 1168,
+                "total_price": 0.0013,
+                "currency": "USD"
+            }
+        }
+    },
+    "workflow_finished": {
+        "data": {
+            "id": "fd3ddc76",
+            "workflow_id": "0b3c6e2a",
+            "status": "succeeded",
+            "outputs": {
+                "text": "done"
+            },
+            "elapsed_time": 3.5,
+            "total_tokens": 1168,
+            "total_steps": 3,
+            "created_at": 1705395332,
+            "finished_at": 1705395336
+        }
+    },
+    "message": {
+        "answer": "术语"
+    },
+    "message_end": {
+        "metadata": {
+            "usage": USAGE
+        }
+    },
+    "iteration_started": {},
+    "ping": {},
+}
+
+
+def frame(event: str, body: dict) -> str:
+    # Dify 把 event 放在第一个字段
+    return "data: " + json.dumps({"event": event, **IDS, **body}, ensure_ascii=False)
+
+
+@pytest.mark.parametrize("event", CHAT_EVENTS)
+def test_chat_form_raw(bench, event):
+    data = frame(event, CHAT_EVENTS[event])
+    model = bench(lambda: chat.BaseEvent.form_raw(data))
+    assert model.event == event
+
+
+@pytest.mark.parametrize("event", WORKFLOW_EVENTS)
+def test_workflow_from_raw(bench, event):
+    data = frame(event, WORKFLOW_EVENTS[event])
+    model = bench(lambda: workflow.BaseEvent.from_raw(data))
+    assert model.event == event
@@ -0,0 +1,16 @@
+"""``FileType.from_meta`` classification for the first and last entries of the extension table and a miss."""
+import pytest
+from app.internal.dify.models import FileMeta, FileType
+
+
+@pytest.mark.parametrize("extension, expected", [("txt", FileType.DOCUMENT), (".EPUB", FileType.DOCUMENT),
+                                                 ("mpga", FileType.VIDEO), ("exe", None)])
+def test_from_meta(bench, extension, expected):
+    meta = FileMeta(id="f0",
+                    name=f"file.{extension.lstrip('.')}",
+                    size=1024,
+                    extension=extension,
+                    mime_type="application/octet-stream",
+                    created_by="bench",
+                    created_at=1705395332)
+    assert bench(lambda: FileType.from_meta(meta)) is expected
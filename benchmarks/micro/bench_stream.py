@@ -0,0 +1,48 @@
+"""``parse_response`` relaying a synthetic 10k event chat stream, line by line and as raw bytes."""
+import asyncio
+import json
+import httpx
+import pytest
+from app.routers.glossary import parse_response
+
+EVENTS = 10_000
+IDS = {"task_id": "5ad4cb98", "message_id": "5e4e9d1f", "conversation_id": "45701982", "created_at": 1705395332}
+
+
+def stream_body() -> list[bytes]:
+    frames = [f"data: {json.dumps({'event': 'message', **IDS, 'answer': f'token {i}'})}\n\n" for i in range(EVENTS - 1)]
+    usage = {"prompt_tokens": 10, "completion_tokens": EVENTS, "total_tokens": EVENTS + 10, "total_price": "0.01"}
+    frames.append(f"data: {json.dumps({'event': 'message_end', **IDS, 'metadata': {'usage': usage}})}\n\n")
+    body = "".join(frames).encode("utf-8")
+    # 模拟网络上的 4KB 分片，帧会跨分片
+    return [body[offset:offset + 4096] for offset in range(0, len(body), 4096)]
+
+
+class ChunkStream(httpx.AsyncByteStream):
+
+    def __init__(self, chunks: list[bytes]):
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+@pytest.mark.parametrize("raw", [False, True], ids=["lines", "raw"])
+def test_parse_response(bench, app_config, raw):
+    app_config.stream.raw = raw
+    app_config.usage.enabled = False
+    chunks = stream_body()
+    loop = asyncio.new_event_loop()
+
+    async def relay() -> int:
+        response = httpx.Response(200, stream=ChunkStream(chunks), headers={"content-type": "text/event-stream"})
+        size = 0
+        async for chunk in parse_response(response, mode="bench"):
+            size += len(chunk)
+        return size
+
+    try:
+        assert bench(lambda: loop.run_until_complete(relay()), items=EVENTS) > 0
+    finally:
+        loop.close()
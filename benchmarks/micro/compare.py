@@ -0,0 +1,62 @@
+"""
+Compare two micro-benchmark reports and fail when any benchmark got slower than the threshold.
+
+    python -m benchmarks.micro.compare benchmarks/micro/baseline.json benchmarks/micro/latest.json [--threshold 0.2]
+"""
+import argparse
+import json
+import sys
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> tuple[list[str], list[str]]:
+    """Returns (report lines, names of the benchmarks that regressed by more than ``threshold``)."""
+    lines = [f"{'benchmark':<64} {'baseline':>12} {'current':>12} {'change':>8}"]
+    regressions = []
+    for name, result in current["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            lines.append(f"{name:<64} {'-':>12} {_format_time(result['min']):>12} {'new':>8}")
+            continue
+        change = result["min"] / base["min"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  SLOWER"
+        elif change < -threshold:
+            flag = "  faster"
+        lines.append(f"{name:<64} {_format_time(base['min']):>12} {_format_time(result['min']):>12} "
+                     f"{change:>+8.1%}{flag}")
+    for name in baseline["benchmarks"].keys() - current["benchmarks"].keys():
+        lines.append(f"{name:<64} {_format_time(baseline['benchmarks'][name]['min']):>12} {'-':>12} {'gone':>8}")
+    return lines, regressions
+
+
+def _format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 is 20%%")
+    args = parser.parse_args(argv)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline.get("machine") != current.get("machine"):
+        print(f"warning: baseline was recorded on {baseline.get('machine')}", file=sys.stderr)
+    lines, regressions = compare(baseline, current, args.threshold)
+    print("\n".join(lines))
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) slower than baseline by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
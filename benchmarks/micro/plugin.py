@@ -0,0 +1,101 @@
+"""
+pytest plugin providing the ``bench`` fixture used by the ``bench_*.py`` modules, loaded by ``benchmarks.micro``.
+"""
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Any, Callable
+import pytest
+import app.internal.config as config_module
+from app.internal.config import ConfigInner
+
+_results: dict[str, dict] = {}
+
+
+class Bench:
+    """
+    Times a callable: the number of calls per round is grown until a round takes ``min_time``, then ``rounds``
+    rounds are run and the fastest and median time per call are kept.
+
+    :param name: key of the result in the JSON report, the test id
+    :param items: units of work done by one call, e.g. events relayed, to report a throughput
+    """
+
+    def __init__(self, name: str, rounds: int = 7, min_time: float = 0.05):
+        self.name = name
+        self.rounds = rounds
+        self.min_time = min_time
+
+    def _round(self, func: Callable[[], Any], number: int) -> float:
+        # 回收时机不可控，计时期间关掉 gc 以减少抖动
+        gc.disable()
+        try:
+            started_at = time.perf_counter()
+            for _ in range(number):
+                func()
+            return time.perf_counter() - started_at
+        finally:
+            gc.enable()
+
+    def __call__(self, func: Callable[[], Any], items: int = 1) -> Any:
+        result = func()
+        number = 1
+        while (elapsed := self._round(func, number)) < self.min_time:
+            number = max(number * 2, int(number * self.min_time / max(elapsed, 1e-9)))
+        timings = [self._round(func, number) / number for _ in range(self.rounds)]
+        fastest = min(timings)
+        _results[self.name] = {
+            "min": fastest,
+            "median": statistics.median(timings),
+            "rounds": self.rounds,
+            "number": number,
+            "items": items,
+            "ops_per_sec": items / fastest,
+        }
+        return result
+
+
+@pytest.fixture
+def bench(request) -> Bench:
+    return Bench(request.node.nodeid.split("::", 1)[-1])
+
+
+@pytest.fixture
+def app_config(tmp_path, monkeypatch) -> ConfigInner:
+    """A default config installed as the current snapshot without reading config.toml."""
+    monkeypatch.chdir(tmp_path)
+    inner = ConfigInner(glossary={"api_key": "bench"},
+                        deep_search={"api_key": "bench"},
+                        deep_gemini={"api_key": "bench"},
+                        proxy={})
+    snapshot = type("Snapshot", (), {"config": inner})()
+    monkeypatch.setattr(config_module, "config", snapshot)
+    return inner
+
+
+def pytest_addoption(parser):
+    parser.addoption("--bench-output", default=None, help="write the results as JSON to this path")
+
+
+def pytest_sessionfinish(session):
+    output = session.config.getoption("--bench-output")
+    if not output or not _results:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "machine": {
+                    "python": sys.version.split()[0],
+                    "implementation": platform.python_implementation(),
+                    "platform": platform.platform(),
+                    "processor": platform.processor() or platform.machine(),
+                },
+                "benchmarks": dict(sorted(_results.items())),
+            },
+            f,
+            indent=2)
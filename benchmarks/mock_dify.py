@@ -0,0 +1,277 @@
+"""
+A local stand-in for the Dify API, for load tests that must not reach api.dify.ai.
+
+Streams ``/chat-messages`` and ``/workflows/run`` as server-sent events at a configurable token rate, after a
+configurable time to first byte, and answers ``/messages``, ``/conversations`` and ``/files/upload`` with canned
+payloads. A fraction of requests can be failed with a given status, or broken off with an ``error`` event mid-stream.
+
+    python -m benchmarks.mock_dify [--port 18080] [--ttfb 0.2] [--token-rate 50] [--tokens 200] [--token-bytes 4]
+                                   [--error-rate 0] [--error-status 500] [--stream-error-rate 0]
+
+Point an app at it with ``base_url = "http://127.0.0.1:18080/v1"`` in its config.toml section.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class MockSettings:
+    ttfb: float = 0.2
+    token_rate: float = 50
+    tokens: int = 200
+    token_bytes: int = 4
+    nodes: int = 3
+    error_rate: float = 0.0
+    error_status: int = 500
+    stream_error_rate: float = 0.0
+    page_size: int = 20
+
+
+settings = MockSettings()
+
+app = FastAPI()
+
+
+def _sse(payload: dict) -> bytes:
+    return f"data: {json.dumps(payload)}\n\n".encode("utf-8")
+
+
+def _usage(prompt_tokens: int, completion_tokens: int, latency: float) -> dict:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "prompt_unit_price": "0.001",
+        "prompt_price_unit": "0.001",
+        "prompt_price": f"{prompt_tokens * 0.000001:.7f}",
+        "completion_tokens": completion_tokens,
+        "completion_unit_price": "0.002",
+        "completion_price_unit": "0.001",
+        "completion_price": f"{completion_tokens * 0.000002:.7f}",
+        "total_tokens": prompt_tokens + completion_tokens,
+        "total_price": f"{prompt_tokens * 0.000001 + completion_tokens * 0.000002:.7f}",
+        "currency": "USD",
+        "latency": latency,
+    }
+
+
+def _injected_error() -> JSONResponse | None:
+    if random.random() < settings.error_rate:
+        return JSONResponse(status_code=settings.error_status,
+                            content={
+                                "code": "mock_error",
+                                "message": "injected by mock_dify",
+                                "status": settings.error_status
+                            })
+    return None
+
+
+async def _paced(count: int):
+    """Yields ``count`` times, the first after ``ttfb`` and then ``token_rate`` times per second."""
+    await asyncio.sleep(settings.ttfb)
+    interval = 1 / settings.token_rate if settings.token_rate > 0 else 0
+    started_at = time.perf_counter()
+    for i in range(count):
+        # 按绝对时间对齐，避免 sleep 误差累积
+        delay = started_at + i * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield i
+
+
+async def _chat_events(body: dict):
+    started_at = time.perf_counter()
+    ids = {
+        "task_id": str(uuid.uuid4()),
+        "message_id": str(uuid.uuid4()),
+        "conversation_id": body.get("conversation_id") or str(uuid.uuid4()),
+    }
+    token = "x" * settings.token_bytes
+    broken_at = settings.tokens // 2 if random.random() < settings.stream_error_rate else -1
+    async for i in _paced(settings.tokens):
+        if i == broken_at:
+            yield _sse({"event": "error", **ids, "status": 500, "code": "mock_error", "message": "stream broken"})
+            return
+        yield _sse({"event": "message", **ids, "answer": token, "created_at": int(time.time())})
+    usage = _usage(len(body.get("query", "")), settings.tokens, time.perf_counter() - started_at)
+    yield _sse({"event": "message_end", **ids, "metadata": {"usage": usage}, "created_at": int(time.time())})
+
+
+@app.post("/v1/chat-messages")
+async def chat_messages(request: Request):
+    body = await request.json()
+    error = _injected_error()
+    if error is not None:
+        return error
+    if body.get("response_mode") == "blocking":
+        await asyncio.sleep(settings.ttfb + settings.tokens / settings.token_rate if settings.token_rate > 0 else 0)
+        return {
+            "event": "message",
+            "message_id": str(uuid.uuid4()),
+            "conversation_id": body.get("conversation_id") or str(uuid.uuid4()),
+            "answer": "x" * settings.token_bytes * settings.tokens,
+            "metadata": {
+                "usage": _usage(len(body.get("query", "")), settings.tokens, 0)
+            },
+            "created_at": int(time.time()),
+        }
+    return StreamingResponse(_chat_events(body), media_type="text/event-stream")
+
+
+@app.post("/v1/chat-messages/{task_id}/stop")
+async def stop_message(task_id: str):
+    return {"result": "success"}
+
+
+@app.get("/v1/messages")
+async def messages(conversation_id: str | None = None, limit: int = 20):
+    error = _injected_error()
+    if error is not None:
+        return error
+    data = [{
+        "id": str(uuid.uuid4()),
+        "conversation_id": conversation_id,
+        "query": f"question {i}",
+        "answer": "x" * settings.token_bytes * settings.tokens,
+        "created_at": int(time.time()),
+    } for i in range(min(limit, settings.page_size))]
+    return {"limit": limit, "has_more": False, "data": data}
+
+
+@app.get("/v1/messages/{message_id}/suggested")
+async def suggested(message_id: str):
+    return {"result": "success", "data": ["first follow up", "second follow up", "third follow up"]}
+
+
+@app.get("/v1/conversations")
+async def conversations(limit: int = 20):
+    error = _injected_error()
+    if error is not None:
+        return error
+    data = [{
+        "id": str(uuid.uuid4()),
+        "name": f"conversation {i}",
+        "status": "normal",
+        "created_at": int(time.time()),
+    } for i in range(min(limit, settings.page_size))]
+    return {"limit": limit, "has_more": False, "data": data}
+
+
+@app.post("/v1/files/upload")
+async def upload(request: Request):
+    error = _injected_error()
+    if error is not None:
+        return error
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+    return JSONResponse(status_code=201,
+                        content={
+                            "id": str(uuid.uuid4()),
+                            "name": "upload",
+                            "size": size,
+                            "extension": "bin",
+                            "mime_type": "application/octet-stream",
+                            "created_by": "mock",
+                            "created_at": int(time.time()),
+                        })
+
+
+async def _workflow_events():
+    run_id = str(uuid.uuid4())
+    workflow_id = str(uuid.uuid4())
+    now = int(time.time())
+    base = {"task_id": str(uuid.uuid4()), "workflow_run_id": run_id}
+    yield _sse({
+        "event": "workflow_started",
+        **base, "data": {
+            "id": run_id,
+            "workflow_id": workflow_id,
+            "sequence_number": 1,
+            "created_at": now
+        }
+    })
+    predecessor = None
+    # 每个节点占用一段 token 时间，模拟串行的节点执行
+    per_node = max(settings.tokens // max(settings.nodes, 1), 1)
+    for index in range(settings.nodes):
+        node_id = f"node-{index}"
+        node = {"id": str(uuid.uuid4()), "node_id": node_id, "index": index, "predecessor_node_id": predecessor}
+        yield _sse({
+            "event": "node_started",
+            **base, "data": {
+                **node, "node_type": "llm",
+                "title": f"Node {index}",
+                "created_at": int(time.time())
+            }
+        })
+        started_at = time.perf_counter()
+        async for _ in _paced(per_node):
+            pass
+        yield _sse({
+            "event": "node_finished",
+            **base, "data": {
+                **node, "node_type": "llm",
+                "title": f"Node {index}",
+                "status": "succeeded",
+                "outputs": {
+                    "text": "x" * settings.token_bytes * per_node
+                },
+                "elapsed_time": time.perf_counter() - started_at,
+                "execution_metadata": {
+                    "total_tokens": per_node
+                },
+                "created_at": int(time.time())
+            }
+        })
+        predecessor = node_id
+    yield _sse({
+        "event": "workflow_finished",
+        **base, "data": {
+            "id": run_id,
+            "workflow_id": workflow_id,
+            "status": "succeeded",
+            "outputs": {
+                "text": "done"
+            },
+            "elapsed_time": time.time() - now,
+            "total_tokens": per_node * settings.nodes,
+            "total_steps": settings.nodes,
+            "created_at": now,
+            "finished_at": int(time.time())
+        }
+    })
+
+
+@app.post("/v1/workflows/run")
+async def run_workflow(request: Request):
+    body = await request.json()
+    error = _injected_error()
+    if error is not None:
+        return error
+    if body.get("response_mode") == "blocking":
+        events = [chunk async for chunk in _workflow_events()]
+        return json.loads(events[-1].decode("utf-8")[len("data: "):])
+    return StreamingResponse(_workflow_events(), media_type="text/event-stream")
+
+
+def main():
+    import uvicorn
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    for name, value in MockSettings().__dict__.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+    for name in MockSettings().__dict__:
+        setattr(settings, name, getattr(args, name))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Cold start cost of the app: the slowest imports reported by ``python -X importtime`` and the wall time from spawning
+a fresh interpreter to the first answered request.
+
+The first start in an empty directory generates the key pair and encrypts config.toml, later starts reuse them and
+should leave the file untouched.
+
+    python -m benchmarks.startup [--runs 5] [--top 15]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dotenv import dotenv_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = """
+[glossary]
+api_key = "plaintext(app-glossary)"
+
+[deep_search]
+api_key = "plaintext(app-deep-search)"
+
+[deep_gemini]
+api_key = "plaintext(app-deep-gemini)"
+
+[proxy]
+"""
+
+FIRST_REQUEST = """
+from fastapi.testclient import TestClient
+from app.main import app
+with TestClient(app) as client:
+    assert client.get("/glossary/file-types").status_code == 200
+"""
+
+
+def importtime(top: int) -> tuple[int, list[tuple[int, str]]]:
+    """Returns (total microseconds, the ``top`` slowest modules by cumulative time)."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app.main"],
+                            cwd=ROOT,
+                            capture_output=True,
+                            text=True,
+                            check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative), name.rstrip()))
+    total = next(cumulative for cumulative, name in modules if name.strip() == "app.main")
+    return total, sorted(modules, reverse=True)[:top]
+
+
+def first_request(directory: str, env: dict[str, str]) -> float:
+    started_at = time.perf_counter()
+    subprocess.run([sys.executable, "-c", FIRST_REQUEST], cwd=directory, env=env, check=True, capture_output=True)
+    return time.perf_counter() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    total, modules = importtime(args.top)
+    print(f"import app.main: {total / 1000:.1f} ms")
+    for cumulative, name in modules:
+        print(f"  {cumulative / 1000:8.1f} ms {name}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, "config.toml")
+        with open(config_path, "w") as f:
+            f.write(CONFIG)
+        env = {**os.environ, "PYTHONPATH": ROOT, "CONFIG": config_path, "LOG_LEVEL": "WARNING"}
+        env.pop("API_KEY_DEK", None)
+        env.pop("API_KEY_NONCE", None)
+        cold = first_request(directory, env)
+        print(f"first request, new config: {cold * 1000:.0f} ms")
+
+        env.update(dotenv_values(os.path.join(directory, ".env")))
+        mtime = os.stat(config_path).st_mtime_ns
+        restarts = [first_request(directory, env) for _ in range(args.runs)]
+        print(f"first request, restart:    {statistics.median(restarts) * 1000:.0f} ms "
+              f"(median of {args.runs}, config.toml rewritten: {os.stat(config_path).st_mtime_ns != mtime})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Peak RSS of one upload through the streaming multipart body versus the old ``await file.read()`` path.
+
+Each (mode, size) pair runs in a fresh interpreter so ``ru_maxrss`` is not polluted by earlier runs.
+
+    python -m benchmarks.upload_rss [--sizes 10 100]
+"""
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+from starlette.datastructures import UploadFile
+from app.internal.dify.multipart import MultipartStream
+
+
+class DrainTransport(httpx.AsyncBaseTransport):
+    """Stands in for Dify: reads the request body chunk by chunk and throws it away."""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        received = 0
+        async for chunk in request.stream:
+            received += len(chunk)
+        return httpx.Response(201, json={"received": received})
+
+
+def peak_rss_mb() -> float:
+    # linux 上 ru_maxrss 单位是 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def upload(path: str, mode: str) -> int:
+    size = os.path.getsize(path)
+    async with httpx.AsyncClient(transport=DrainTransport()) as client:
+        with open(path, "rb") as f:
+            file = UploadFile(f, size=size, filename=os.path.basename(path))
+            if mode == "stream":
+                body = MultipartStream({"user": "bench"}, {"file": (file.filename, file, "application/pdf")},
+                                       sizes={"file": size})
+                request = client.build_request("POST", "http://dify/files/upload", headers=body.headers, content=body)
+                response = await client.send(request)
+            else:
+                response = await client.post("http://dify/files/upload",
+                                             data={"user": "bench"},
+                                             files={"file": (file.filename, await file.read(), "application/pdf")})
+    return response.json()["received"]
+
+
+def child(path: str, mode: str):
+    baseline = peak_rss_mb()
+    started_at = time.perf_counter()
+    received = asyncio.run(upload(path, mode))
+    elapsed = time.perf_counter() - started_at
+    print(f"{mode:<9} {os.path.getsize(path) / 1024 / 1024:>6.0f} MB  peak rss +{peak_rss_mb() - baseline:>7.1f} MB  "
+          f"{received / 1024 / 1024 / elapsed:>8.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--child", nargs=2, metavar=("PATH", "MODE"))
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            path = os.path.join(directory, f"upload-{size}.pdf")
+            with open(path, "wb") as f:
+                for _ in range(size):
+                    f.write(os.urandom(1024 * 1024))
+            for mode in ("buffered", "stream"):
+                subprocess.run([sys.executable, "-m", "benchmarks.upload_rss", "--child", path, mode], check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+import httpx
+import pytest
+from app.internal import config as config_module
+from app.internal.config import ConfigInner, ModelConfig
+from app.internal import admission, answer_index, usage, workflow_profile
+from app.internal.dify import answer_cache, audio_cache, cache, client as client_module, limiter, pool, resilience
+
+# 模块级的单例，每个测试都从空的开始
+_SINGLETONS = [
+    (cache, "_cache", lambda: None),
+    (client_module, "_dify_clients", dict),
+    (resilience, "_breakers", dict),
+    (limiter, "_limiters", dict),
+    (admission, "_schedulers", dict),
+    (admission, "_warned_untrusted_proxy", lambda: False),
+    (answer_cache, "_answer_cache", lambda: None),
+    (audio_cache, "_audio_cache", lambda: None),
+    (answer_index, "_index", lambda: None),
+    (usage, "_ledger", lambda: None),
+    (workflow_profile, "_profiler", lambda: None),
+]
+
+
+@pytest.fixture(autouse=True)
+def fresh_singletons(monkeypatch):
+    for module, attribute, factory in _SINGLETONS:
+        monkeypatch.setattr(module, attribute, factory())
+
+
+@pytest.fixture
+def configure(monkeypatch, tmp_path):
+    """
+    Install an in-memory config instead of reading config.toml, ``configure(cache={"enabled": False})`` replaces it
+    with one whose sections are overridden. API keys are used as is, without encryption.
+    """
+    monkeypatch.chdir(tmp_path)
+
+    def install(**sections) -> ConfigInner:
+        app = {"api_key": "app-key", "base_url": "http://dify.test/v1"}
+        inner = ConfigInner(**{"glossary": app, "deep_search": app, "deep_gemini": app, "proxy": {}, **sections})
+        for value in inner.__dict__.values():
+            if isinstance(value, ModelConfig):
+                value._api_key_plaintext = value.api_key
+                value._api_keys_plaintext = list(value.api_keys)
+        monkeypatch.setattr(config_module, "config", SimpleNamespace(config=inner))
+        client_module._dify_clients.clear()
+        return inner
+
+    install()
+    return install
+
+
+@pytest.fixture
+def upstream(monkeypatch, configure):
+    """``upstream(handler)`` answers every Dify call with ``handler(request)`` through an ``httpx.MockTransport``."""
+
+    def install(handler):
+        monkeypatch.setattr(pool, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+    return install
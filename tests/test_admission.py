@@ -0,0 +1,110 @@
+import asyncio
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+from app.internal.admission import AdmissionScheduler, request_class, request_user
+from app.internal.config import AdmissionConfig
+from app.internal.dify.errors import UpstreamUnavailableError
+from app.main import app
+
+
+def _request(headers: dict | None = None, peer: str = "10.0.0.1", user: str | None = None) -> Request:
+    request = Request({
+        "type": "http",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        "client": (peer, 50000),
+    })
+    if user:
+        request.state.user = user
+    return request
+
+
+def test_identity_is_not_taken_from_headers(configure):
+    assert request_user(_request({"x-user": "someone-else"})) == "10.0.0.1"
+    assert request_user(_request({"x-forwarded-for": "1.2.3.4"})) == "10.0.0.1"
+    assert request_user(_request({"x-user": "someone-else"}, user="alice")) == "alice"
+
+
+def test_forwarded_for_is_read_from_trusted_proxies(configure):
+    configure(admission={"trusted_proxies": ["10.0.0.1"]})
+    assert request_user(_request({"x-forwarded-for": "6.6.6.6, 1.2.3.4"})) == "1.2.3.4"
+
+
+def test_request_class_defaults_to_lowest_and_can_only_go_down(configure):
+    assert request_class(_request()) == "bulk"
+    assert request_class(_request({"x-request-class": "interactive"})) == "bulk"
+    assert request_class(_request(), "interactive") == "interactive"
+    assert request_class(_request({"x-request-class": "bulk"}), "interactive") == "bulk"
+
+
+def test_interactive_overtakes_queued_bulk():
+
+    async def scenario():
+        scheduler = AdmissionScheduler("app", AdmissionConfig(user_rate=0, client_rate=50, client_burst=1))
+        await scheduler.admit("a", "bulk")
+        order = []
+
+        async def admit(user, request_class):
+            await scheduler.admit(user, request_class)
+            order.append(user)
+
+        tasks = [asyncio.create_task(admit("a", "bulk")) for _ in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(admit("b", "interactive")))
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["b", "a", "a", "a"]
+
+
+def test_full_queue_and_long_wait_are_rejected():
+
+    async def scenario():
+        config = AdmissionConfig(user_rate=0, client_rate=0.01, client_burst=1, max_queue=1, max_wait=0.05)
+        scheduler = AdmissionScheduler("app", config)
+        await scheduler.admit("a")
+        waiting = asyncio.create_task(scheduler.admit("a"))
+        await asyncio.sleep(0)
+        with pytest.raises(UpstreamUnavailableError, match="full"):
+            await scheduler.admit("b")
+        with pytest.raises(UpstreamUnavailableError, match="timed out"):
+            await waiting
+        return scheduler.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["queue_depth"] == 0
+
+
+def test_cache_hits_are_not_admitted(configure, upstream):
+    configure(admission={"client_rate": 0.01, "client_burst": 1, "max_queue": 0})
+    upstream(lambda request: httpx.Response(200, content=b"audio", headers={"content-type": "audio/mpeg"}))
+    client = TestClient(app)
+    assert client.post("/glossary/text-to-audio", json={"text": "hello"}).content == b"audio"
+    # 令牌已经用完，命中缓存的请求照样返回
+    assert client.post("/glossary/text-to-audio", json={"text": "hello"}).content == b"audio"
+    assert client.post("/glossary/text-to-audio", json={"text": "other"}).status_code == 503
+
+
+def test_cached_reads_are_admitted_only_on_a_miss(configure, upstream):
+    configure(admission={"client_rate": 0.01, "client_burst": 1, "max_queue": 0})
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.params.get("limit"))
+        return httpx.Response(200, json={"data": [], "has_more": False})
+
+    upstream(handler)
+    client = TestClient(app)
+    assert client.get("/glossary/conversations").status_code == 200
+    for _ in range(3):
+        assert client.get("/glossary/conversations").status_code == 200
+    assert calls == ["20"]
+    assert client.get("/glossary/conversations", params={"limit": 5}).status_code == 503
+
+
+def test_forwarded_for_from_an_untrusted_peer_is_warned_about(configure, caplog):
+    request_user(_request({"x-forwarded-for": "1.2.3.4"}))
+    request_user(_request({"x-forwarded-for": "1.2.3.5"}))
+    warnings = [record for record in caplog.records if "trusted_proxies" in record.getMessage()]
+    assert len(warnings) == 1
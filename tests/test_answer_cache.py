@@ -0,0 +1,75 @@
+import json
+import os
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from app.internal.dify import answer_cache
+from app.internal.dify.answer_cache import answer_frames
+from app.main import app
+
+_IDS = '"conversation_id": "conv-1", "message_id": "msg-1", "task_id": "task-1"'
+_ANSWER = (f'data: {{"event": "message", "id": "msg-1", {_IDS}, "answer": "你好"}}\n\n'
+           f'data: {{"event": "ping"}}\n\n'
+           f'data: {{"event": "message_end", "id": "msg-1", {_IDS}, "metadata": {{}}}}\n\n').encode()
+
+
+def _events(body: bytes) -> list[dict]:
+    return [json.loads(frame[len(b"data:"):]) for frame in body.split(b"\n\n") if frame.strip()]
+
+
+def test_stored_frames_are_detached_from_their_conversation():
+    events = _events(b"".join(answer_frames(_ANSWER)))
+    assert [event["event"] for event in events] == ["message", "message_end"]
+    assert events[0]["answer"] == "你好"
+    for event in events:
+        assert (event["id"], event["conversation_id"], event["message_id"], event["task_id"]) == (None, ) * 4
+
+
+def test_unfinished_or_failed_answers_are_not_stored():
+    assert answer_frames(_ANSWER.split(b"data: {\"event\": \"message_end\"")[0]) is None
+    assert answer_frames(_ANSWER + b'data: {"event": "error", "message": "boom"}\n\n') is None
+
+
+@pytest.fixture
+def chat(configure, upstream):
+    configure(admission={"enabled": False})
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        return httpx.Response(200, stream=httpx.ByteStream(_ANSWER), headers={"content-type": "text/event-stream"})
+
+    upstream(handler)
+    return calls
+
+
+def test_replayed_answer_cannot_seed_a_conversation(chat):
+    client = TestClient(app)
+    first = client.post("/glossary/chat", json={"query": "What is  SSE?"})
+    assert first.headers["x-answer-cache"] == "miss"
+    assert _events(first.content)[0]["conversation_id"] == "conv-1"
+
+    replay = client.post("/glossary/chat", json={"query": "what is sse?"})
+    assert replay.headers["x-answer-cache"] == "hit"
+    assert len(chat) == 1
+    events = _events(replay.content)
+    assert events[0]["answer"] == "你好"
+    assert b"conv-1" not in replay.content and b"msg-1" not in replay.content and b"task-1" not in replay.content
+    assert all(event["conversation_id"] is None for event in events)
+
+
+def test_answers_stored_in_an_older_format_are_misses(chat):
+    client = TestClient(app)
+    client.post("/glossary/chat", json={"query": "hello"})
+    for root, _, names in os.walk("cache/answers"):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                header, body = f.read().split(b"\n", 1)
+            with open(path, "wb") as f:
+                f.write(json.dumps({"expires_at": json.loads(header)["expires_at"]}).encode() + b"\n" + _ANSWER)
+    # 丢掉内存中的缓存，只能从磁盘读
+    answer_cache._answer_cache = None
+
+    assert client.post("/glossary/chat", json={"query": "hello"}).headers["x-answer-cache"] == "miss"
+    assert len(chat) == 2
@@ -0,0 +1,65 @@
+import asyncio
+from app.internal.answer_index import AnswerIndex, AnsweredQuery, _sync, tokenize
+
+
+def _document(query: str, answered_at: float) -> AnsweredQuery:
+    return AnsweredQuery(query, "chat", f"key-{query}", "answer", answered_at)
+
+
+def test_tokenize_splits_cjk_into_bigrams():
+    assert tokenize("What is 机器学习?") == ["what", "is", "机器", "器学", "学习"]
+
+
+def test_search_ranks_similar_queries(tmp_path):
+    index = AnswerIndex(str(tmp_path / "index.jsonl.gz"), 100)
+    index.add(_document("what is machine learning", 1))
+    index.add(_document("how to cook rice", 2))
+    results = index.search("machine learning, what is it?", k=2)
+    assert results[0]["query"] == "what is machine learning"
+    assert 0 < results[0]["similarity"] <= 1
+    assert len(results) == 1
+
+
+def test_workers_keep_each_others_documents(tmp_path):
+    path = str(tmp_path / "index.jsonl.gz")
+    first, second = AnswerIndex(path, 100), AnswerIndex(path, 100)
+    first.add(_document("first worker question", 1))
+    second.add(_document("second worker question", 2))
+
+    async def sync():
+        await _sync(first)
+        await _sync(second)
+        await _sync(first)
+
+    asyncio.run(sync())
+    for index in (first, second):
+        assert sorted(document.query
+                      for document in index.documents.values()) == ["first worker question", "second worker question"]
+    restarted = AnswerIndex(path, 100)
+    restarted.merge(restarted.read_new())
+    assert len(restarted.documents) == 2
+
+
+def test_compaction_keeps_the_latest_documents_of_every_worker(tmp_path):
+    path = str(tmp_path / "index.jsonl.gz")
+    first, second = AnswerIndex(path, 3), AnswerIndex(path, 3)
+
+    async def scenario():
+        for i in range(4):
+            first.add(_document(f"first {i}", i))
+            await _sync(first)
+        # second 写入的文档还没被 first 读到时，first 压缩文件
+        second.add(_document("second 0", 10))
+        second.add(_document("first 3", 11))
+        await _sync(second)
+        for i in range(4, 8):
+            first.add(_document(f"first {i}", i))
+        await _sync(first)
+
+    asyncio.run(scenario())
+    assert first.logged <= 2 * first.max_documents
+    latest = ["first 3", "first 7", "second 0"]
+    assert sorted(document.query for document in first.documents.values()) == latest
+    restarted = AnswerIndex(path, 3)
+    restarted.merge(restarted.read_new())
+    assert sorted(document.query for document in restarted.documents.values()) == latest
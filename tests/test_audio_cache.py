@@ -0,0 +1,46 @@
+import asyncio
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import ClientDisconnect
+from app.internal.dify.audio_cache import AudioCache, get_audio_cache
+from app.main import app
+from app.routers.glossary import _audio_response
+
+_KEY = AudioCache.key("hello", None, None)
+
+
+@pytest.fixture
+def cached(configure, upstream):
+    configure(admission={"enabled": False})
+    upstream(lambda request: httpx.Response(200, content=b"audio", headers={"content-type": "audio/mpeg"}))
+    client = TestClient(app)
+    assert client.post("/glossary/text-to-audio", json={"text": "hello"}).content == b"audio"
+    return client
+
+
+def test_cached_audio_is_served_by_key(cached):
+    assert cached.get(f"/glossary/text-to-audio/{_KEY}").content == b"audio"
+    response = cached.get(f"/glossary/text-to-audio/{_KEY}", headers={"range": "bytes=1-2"})
+    assert (response.status_code, response.content) == (206, b"ud")
+
+
+def test_cached_audio_is_not_served_when_the_cache_is_disabled(cached, configure):
+    configure(admission={"enabled": False}, audio_cache={"enabled": False})
+    assert cached.get(f"/glossary/text-to-audio/{_KEY}").status_code == 404
+
+
+def test_audio_is_unmapped_when_the_client_is_gone_before_the_body(cached):
+    audio = get_audio_cache().open(_KEY)
+    response = _audio_response(audio, _KEY, None)
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        raise OSError("client gone")
+
+    scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+    with pytest.raises(ClientDisconnect):
+        asyncio.run(response(scope, receive, send))
+    assert audio.data.closed
@@ -0,0 +1,71 @@
+import asyncio
+import httpx
+from app.internal.dify.cache import get_response_cache
+from app.internal.dify.client import get_chat_client
+
+
+def _conversations(calls: list):
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append((request.method, request.url.path))
+        return httpx.Response(200, json={"data": [{"id": f"c{len(calls)}"}]})
+
+    return handler
+
+
+def test_reads_are_cached_until_a_write_invalidates_them(upstream):
+    calls = []
+    upstream(_conversations(calls))
+    client = get_chat_client("glossary")
+
+    async def scenario():
+        first = await client.get_conversations(user="u1")
+        second = await client.get_conversations(user="u1")
+        await client.get_conversations(user="u2")
+        await client.rename_conversation("c1", "name", False, user="u1")
+        third = await client.get_conversations(user="u1")
+        return first.json(), second.json(), third.json()
+
+    first, second, third = asyncio.run(scenario())
+    assert first == second
+    assert third != first
+    assert [path for method, path in calls if method == "GET"] == ["/v1/conversations"] * 3
+    # 缓存命中的响应保留了 request，可以直接 raise_for_status
+    assert get_response_cache().stats()["namespaces"]["conversations"] == {"hits": 1, "misses": 3}
+
+
+def test_cache_hit_supports_raise_for_status(upstream):
+    upstream(_conversations([]))
+    client = get_chat_client("glossary")
+
+    async def scenario():
+        await client.get_conversations(user="u1")
+        return await client.get_conversations(user="u1")
+
+    asyncio.run(scenario()).raise_for_status()
+
+
+def test_read_in_flight_during_invalidation_is_not_stored(upstream):
+    calls = []
+
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request.method)
+            if request.method == "GET" and len(calls) == 1:
+                await gate.wait()
+            return httpx.Response(200, json={"data": [], "call": len(calls)})
+
+        upstream(handler)
+        client = get_chat_client("glossary")
+        read = asyncio.create_task(client.get_conversations(user="u1"))
+        await asyncio.sleep(0)
+        await client.delete_conversation("c1", user="u1")
+        gate.set()
+        await read
+        return (await client.get_conversations(user="u1")).json()
+
+    # 删除之前发出的读取结果不进缓存，之后的读取重新请求上游
+    assert asyncio.run(scenario())["call"] == 3
+    assert get_response_cache().stats()["entries"] == 1
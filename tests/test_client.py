@@ -0,0 +1,70 @@
+import asyncio
+import json
+import httpx
+import pytest
+from app.internal.config import get_config
+from app.internal.dify.client import (ChatClient, WorkflowClient, drop_stale_clients, get_chat_client,
+                                      get_workflow_client, key_pool_stats)
+from app.internal.dify.models.workflow import MessageEvent, NodeFinishedEvent, WorkflowStartedEvent
+
+
+def test_clients_of_one_app_are_cached_per_class(configure):
+    chat = get_chat_client("glossary")
+    workflow = get_workflow_client("glossary")
+    assert isinstance(chat, ChatClient) and isinstance(workflow, WorkflowClient)
+    assert get_chat_client("glossary") is chat
+    assert get_workflow_client("glossary") is workflow
+    # 并发上限按应用计算，两类客户端共用密钥池
+    assert workflow.keys is chat.keys
+    assert list(key_pool_stats()) == ["glossary"]
+
+
+def test_changed_apps_drop_all_their_clients(configure):
+    chat = get_chat_client("glossary")
+    get_workflow_client("glossary")
+    get_chat_client("deep_search")
+    new = get_config().model_copy(deep=True)
+    new.glossary.base_url = "http://moved.test/v1"
+    assert drop_stale_clients(new) == ["glossary"]
+    assert get_chat_client("glossary") is not chat
+
+
+_RUN = (b'data: {"event": "workflow_started", "task_id": "t", "workflow_run_id": "r", '
+        b'"data": {"id": "r", "workflow_id": "w", "sequence_number": 1, "created_at": 0}}\n\n'
+        b'data: {"event": "ping"}\n\n'
+        b'data: {"event": "workflow_paused", "task_id": "t"}\n\n'
+        b'data: {"event": "node_finished", "task_id": "t", "data": {"id": "n", "node_id": "llm", "index": 1, '
+        b'"status": "succeeded", "created_at": 0}}\n\n'
+        b'data: {"event": "message", "task_id": "t", "answer": "hi"}\n\n')
+
+
+def test_run_events_yields_typed_workflow_events(configure, upstream):
+    configure(workflow={"api_key": "wf-key", "base_url": "http://dify.test/v1"})
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, stream=httpx.ByteStream(_RUN), headers={"content-type": "text/event-stream"})
+
+    upstream(handler)
+
+    async def scenario():
+        return [event async for event in get_workflow_client("workflow").run_events({"q": "x"}, "u1")]
+
+    events = asyncio.run(scenario())
+    assert [type(event) for event in events] == [WorkflowStartedEvent, NodeFinishedEvent, MessageEvent]
+    assert events[1].data.status == "succeeded"
+    assert events[2].answer == "hi"
+    assert requests[0].url.path == "/v1/workflows/run"
+    assert json.loads(requests[0].content)["response_mode"] == "streaming"
+
+
+def test_failed_run_raises_before_the_first_event(configure, upstream):
+    configure(workflow={"api_key": "wf-key", "base_url": "http://dify.test/v1"})
+    upstream(lambda request: httpx.Response(400, json={"code": "invalid_param"}))
+
+    async def scenario():
+        return [event async for event in get_workflow_client("workflow").run_events({}, "u1")]
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(scenario())
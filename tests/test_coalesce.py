@@ -0,0 +1,114 @@
+import asyncio
+import httpx
+import pytest
+from app.internal.dify.client import get_chat_client
+from app.internal.dify.coalesce import SingleFlight
+
+
+def _call(calls: list, gate: asyncio.Event, body: bytes = b"ok"):
+
+    async def call() -> httpx.Response:
+        calls.append(1)
+        await gate.wait()
+        return httpx.Response(200, content=body, request=httpx.Request("GET", "http://dify.test/v1/meta"))
+
+    return call
+
+
+def test_followers_share_the_leader_response():
+
+    async def scenario():
+        flight, calls, gate = SingleFlight(), [], asyncio.Event()
+        tasks = [asyncio.create_task(flight.do(("k", ), _call(calls, gate))) for _ in range(5)]
+        await asyncio.sleep(0)
+        gate.set()
+        responses = await asyncio.gather(*tasks)
+        return flight, calls, responses
+
+    flight, calls, responses = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert [response.content for response in responses] == [b"ok"] * 5
+    # 每个调用方拿到自己的响应对象
+    assert len({id(response) for response in responses}) == 5
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "followers": 4, "coalesce_rate": 0.8}
+
+
+def test_cancelled_leader_hands_the_call_to_followers():
+
+    async def scenario():
+        flight, calls, gate = SingleFlight(), [], asyncio.Event()
+        leader = asyncio.create_task(flight.do(("k", ), _call(calls, gate)))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do(("k", ), _call(calls, gate, b"retried")))
+        await asyncio.sleep(0)
+        leader.cancel()
+        gate.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return calls, await follower
+
+    calls, response = asyncio.run(scenario())
+    assert len(calls) == 2
+    assert response.content == b"retried"
+
+
+def test_cancelled_follower_does_not_cancel_the_leader():
+
+    async def scenario():
+        flight, calls, gate = SingleFlight(), [], asyncio.Event()
+        leader = asyncio.create_task(flight.do(("k", ), _call(calls, gate)))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do(("k", ), _call(calls, gate)))
+        await asyncio.sleep(0)
+        follower.cancel()
+        gate.set()
+        return await leader
+
+    assert asyncio.run(scenario()).content == b"ok"
+
+
+def test_leader_errors_reach_followers():
+
+    async def scenario():
+        flight, gate = SingleFlight(), asyncio.Event()
+
+        async def failing() -> httpx.Response:
+            await gate.wait()
+            raise httpx.ConnectError("refused")
+
+        tasks = [asyncio.create_task(flight.do(("k", ), failing)) for _ in range(3)]
+        await asyncio.sleep(0)
+        gate.set()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    assert all(isinstance(result, httpx.ConnectError) for result in asyncio.run(scenario()))
+
+
+def test_reads_after_an_invalidation_do_not_join_earlier_flights(upstream):
+    calls = []
+
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request.method)
+            call = len(calls)
+            if call == 1:
+                await gate.wait()
+            return httpx.Response(200, json={"data": [], "call": call})
+
+        upstream(handler)
+        client = get_chat_client("glossary")
+        before = asyncio.create_task(client.get_conversations(user="u1"))
+        await asyncio.sleep(0)
+        await client.delete_conversation("c1", user="u1")
+        after = asyncio.create_task(client.get_conversations(user="u1"))
+        await asyncio.sleep(0.01)
+        gate.set()
+        results = [(await task).json()["call"] for task in (before, after)]
+        return results, (await client.get_conversations(user="u1")).json()["call"]
+
+    (before, after), cached = asyncio.run(scenario())
+    # 删除之后的读取自己请求上游，缓存的是它拿到的新结果
+    assert (before, after, cached) == (1, 3, 3)
+    assert calls == ["GET", "DELETE", "GET"]
@@ -0,0 +1,56 @@
+import tomllib
+import pytest
+from app.internal.config import Config
+
+_CONFIG = """
+[glossary]
+api_key = "plaintext(glossary-key)"
+
+[deep_search]
+api_key = "plaintext(search-key)"
+depth = 5
+
+[deep_gemini]
+api_key = "plaintext(gemini-key)"
+api_keys = ["plaintext(gemini-key-2)"]
+
+[proxy]
+
+[cache]
+enabled = false
+"""
+
+
+@pytest.fixture
+def config_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # load_config 会把密钥写进环境变量，测试结束后恢复
+    for name in ("API_KEY_DEK", "API_KEY_NONCE", "AI_ENDPOINT_CONFIG_BOOTSTRAPPED"):
+        monkeypatch.setenv(name, "")
+        monkeypatch.delenv(name)
+    path = tmp_path / "config.toml"
+    path.write_text(_CONFIG)
+    return path
+
+
+def test_first_start_encrypts_keys_and_writes_back_only_what_was_set(config_path):
+    config = Config(str(config_path))
+    config.load_config()
+    assert config.config.glossary._api_key_plaintext == "glossary-key"
+    assert config.config.deep_gemini._api_keys_plaintext == ["gemini-key-2"]
+    written = tomllib.loads(config_path.read_text())
+    assert set(written) == {"glossary", "deep_search", "deep_gemini", "proxy", "cache"}
+    assert written["cache"] == {"enabled": False}
+    assert written["deep_search"] == {"api_key": written["deep_search"]["api_key"], "depth": 5}
+    assert "api_keys" not in written["glossary"]
+    assert not written["glossary"]["api_key"].startswith("plaintext(")
+
+
+def test_restart_decrypts_without_rewriting(config_path):
+    Config(str(config_path)).load_config()
+    encrypted = config_path.read_text()
+    restarted = Config(str(config_path))
+    restarted.load_config()
+    assert not restarted.changed
+    assert config_path.read_text() == encrypted
+    assert restarted.config.deep_gemini._api_keys_plaintext == ["gemini-key-2"]
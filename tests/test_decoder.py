@@ -0,0 +1,31 @@
+import pytest
+from app.internal.dify.models.chat import decoder, MessageEvent
+
+
+def test_decode_returns_the_model_of_the_event():
+    event = decoder.decode(b'data: {"event": "message", "task_id": "t", "message_id": "m", "answer": "hi"}')
+    assert isinstance(event, MessageEvent)
+    assert event.answer == "hi"
+
+
+def test_skipped_events_are_dropped_before_parsing():
+    # 被跳过的事件不会解析 JSON，后面的内容无效也没关系
+    assert decoder.decode('data: {"event": "ping", not json') is None
+    assert decoder.decode(b'{"event": "tts_message", not json') is None
+
+
+def test_unknown_events_raise():
+    with pytest.raises(ValueError, match="Unknown event type"):
+        decoder.decode('{"event": "something_new"}')
+
+
+def test_peek_reads_the_event_name_without_parsing():
+    assert decoder.peek('data: {"event": "message_end", broken') == "message_end"
+    assert decoder.peek(b'data: {"answer": "x", "event": "message"}') is None
+
+
+def test_lazy_event_falls_back_to_the_payload_and_parses_once():
+    lazy = decoder.lazy(b'data: {"answer": "x", "event": "message", "task_id": "t", "message_id": "m"}')
+    assert lazy.event == "message"
+    assert lazy.model is lazy.model
+    assert lazy.model.answer == "x"
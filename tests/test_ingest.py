@@ -0,0 +1,82 @@
+import asyncio
+import httpx
+import pytest
+from app.internal.dify.ingest import ingest
+
+
+class FakeDataset:
+    """Answers uploads and indexing-status polls, failing the files and batches it is told to."""
+
+    dataset_id = "ds"
+
+    def __init__(self, upload_errors: dict | None = None, statuses: dict | None = None):
+        self.upload_errors = upload_errors or {}
+        self.statuses = statuses or {}
+
+    async def create_document_by_file(self, path, extra_params=None):
+        name = path.rsplit("/", 1)[-1]
+        if name in self.upload_errors:
+            raise self.upload_errors[name]
+        body = {"document": {"id": f"doc-{name}"}, "batch": f"batch-{name}"}
+        return httpx.Response(200, json=body, request=httpx.Request("POST", "http://dify.test"))
+
+    async def batch_indexing_status(self, batch):
+        status = self.statuses.get(batch, "completed")
+        if isinstance(status, Exception):
+            raise status
+        data = status if isinstance(status, list) else [{"id": f"doc-{batch[6:]}", "indexing_status": status}]
+        return httpx.Response(200, json={"data": data}, request=httpx.Request("GET", "http://dify.test"))
+
+
+@pytest.fixture
+def files(configure, tmp_path):
+    configure(ingest={
+        "poll_interval": 0.001,
+        "poll_max": 0.001,
+        "poll_errors": 2
+    },
+              upload={"limits_mb": {
+                  "document": 0.001
+              }})
+    for name in ("a.txt", "b.txt", "c.txt"):
+        (tmp_path / "docs").mkdir(exist_ok=True)
+        (tmp_path / "docs" / name).write_bytes(b"x" * (4096 if name == "c.txt" else 10))
+    return str(tmp_path / "docs")
+
+
+def _run(dataset: FakeDataset, source) -> dict[str, str]:
+    """The final event of every path, and the stats of the done event under ``None``."""
+
+    async def collect():
+        results = {}
+        async for event in ingest(dataset, source):
+            results[event.path and event.path.rsplit("/", 1)[-1]] = event.event
+            if event.event == "done":
+                results[None] = event.stats
+        return results
+
+    return asyncio.run(asyncio.wait_for(collect(), 5))
+
+
+def test_unexpected_upload_errors_fail_only_their_document(files):
+    results = _run(FakeDataset(upload_errors={"a.txt": RuntimeError("boom")}), files)
+    # c.txt 超过上传上限
+    assert (results["a.txt"], results["b.txt"], results["c.txt"]) == ("failed", "indexed", "failed")
+    assert results[None]["failed"] == 2
+    assert results[None]["indexed"] == 1
+
+
+def test_unexpected_poll_errors_fail_only_their_document(files):
+    # 状态不是字符串时判断是否结束就会出错，要在逐条解析之外兜住
+    malformed = [{"id": "doc-b.txt", "indexing_status": ["indexing"]}]
+    dataset = FakeDataset(statuses={"batch-a.txt": RuntimeError("boom"), "batch-b.txt": malformed})
+    results = _run(dataset, [f"{files}/a.txt", f"{files}/b.txt"])
+    assert results["a.txt"] == "failed"
+    assert results["b.txt"] == "failed"
+    assert results[None]["failed"] == 2
+
+
+def test_failed_indexing_is_reported(files):
+    results = _run(FakeDataset(statuses={"batch-a.txt": "error"}), [f"{files}/a.txt", f"{files}/b.txt"])
+    assert results["a.txt"] == "failed"
+    assert results["b.txt"] == "indexed"
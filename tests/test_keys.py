@@ -0,0 +1,112 @@
+import asyncio
+import httpx
+import pytest
+from app.internal.dify.client import get_chat_client
+from app.internal.dify.errors import UpstreamUnavailableError
+from app.internal.dify.keys import KeyPool, KeySlot
+
+_STREAM = (b'data: {"event": "message", "conversation_id": "conv-1", "message_id": "msg-1", "task_id": "task-1", '
+           b'"answer": "hi"}\n\n')
+
+
+@pytest.fixture
+def two_keys(configure, upstream):
+    app = {"api_key": "key-a", "base_url": "http://a.test/v1", "api_keys": ["key-b"], "base_urls": ["http://b.test/v1"]}
+    configure(glossary=app)
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append((request.url.host, request.url.path))
+        if request.url.path.endswith("/chat-messages"):
+            return httpx.Response(200, stream=httpx.ByteStream(_STREAM), headers={"content-type": "text/event-stream"})
+        return httpx.Response(200, json={"result": "success", "data": []})
+
+    upstream(handler)
+    return calls
+
+
+def test_message_and_task_calls_follow_the_key_of_their_conversation(two_keys):
+    client = get_chat_client("glossary")
+
+    async def scenario():
+        response = await client.create_chat_message({}, "hello", "u1")
+        await response.aread()
+        await response.aclose()
+        await client.get_meta("u1")
+        await client.get_suggested("msg-1", "u1")
+        await client.create_feedbacks("msg-1", "like", "u1", "")
+        await client.stop_message("task-1", "u1")
+        await client.get_conversation_messages("u1", conversation_id="conv-1")
+
+    asyncio.run(scenario())
+    hosts = [host for host, _ in two_keys]
+    # 未固定的 get_meta 落到另一个密钥，其余都跟随会话
+    assert hosts == ["a.test", "b.test", "a.test", "a.test", "a.test", "a.test"]
+
+
+def test_pins_split_across_stream_chunks():
+    pool = KeyPool([KeySlot("key-a", "http://a.test"), KeySlot("key-b", "http://b.test")])
+
+    class Chunked(httpx.AsyncByteStream):
+
+        async def __aiter__(self):
+            yield _STREAM[:40]
+            yield _STREAM[40:]
+
+    async def scenario():
+        slot = pool.acquire()
+        response = pool.track(slot, httpx.Response(200, stream=Chunked()))
+        await response.aread()
+        await response.aclose()
+        return slot
+
+    slot = asyncio.run(scenario())
+    assert pool.acquire("conv-1") is slot
+    assert pool.acquire("msg-1") is slot
+    assert pool.acquire("task-1") is slot
+    assert slot.in_flight == 3
+
+
+def test_failing_key_is_evicted_and_capacity_is_enforced():
+    first, second = KeySlot("key-a", "http://a.test", max_in_flight=1), KeySlot("key-b", "http://b.test", 1)
+    pool = KeyPool([first, second], evict_seconds=60)
+    slot = pool.acquire()
+    pool.release(slot, failed=True)
+    assert pool.acquire() is not slot
+    # 被驱逐的密钥在其他密钥满载时仍会使用
+    assert pool.acquire() is slot
+    with pytest.raises(UpstreamUnavailableError):
+        pool.acquire()
+
+
+def _workers(path: str, count: int = 2, max_pins: int = 10000) -> list[KeyPool]:
+    """Key pools of the same app as each worker process builds them."""
+    return [
+        KeyPool(
+            [KeySlot("key-a", "http://a.test"), KeySlot("key-b", "http://b.test")], max_pins=max_pins, pins_path=path)
+        for _ in range(count)
+    ]
+
+
+def test_pins_are_shared_between_workers_and_restarts(tmp_path):
+    first, second = _workers(str(tmp_path / "pins.log"))
+    first.pin("conv-1", first.slots[1])
+    assert second.acquire("conv-1").base_url == "http://b.test"
+    restarted, = _workers(str(tmp_path / "pins.log"), count=1)
+    assert restarted.acquire("conv-1").base_url == "http://b.test"
+    # 文件里只有密钥的摘要，没有明文
+    assert b"key-b" not in (tmp_path / "pins.log").read_bytes()
+
+
+def test_shared_pins_are_compacted_to_the_latest(tmp_path):
+    first, second = _workers(str(tmp_path / "pins.log"), max_pins=3)
+    for i in range(7):
+        first.pin(f"conv-{i}", first.slots[i % 2])
+    assert len((tmp_path / "pins.log").read_bytes().splitlines()) <= 6
+    assert second.acquire("conv-6").base_url == "http://a.test"
+    assert second.acquire("conv-5").base_url == "http://b.test"
+
+
+def test_single_key_pools_keep_no_pin_file(configure, tmp_path):
+    get_chat_client("glossary").keys.pin("conv-1", get_chat_client("glossary").keys.slots[0])
+    assert not (tmp_path / "data" / "pins").exists()
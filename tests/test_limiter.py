@@ -0,0 +1,78 @@
+import asyncio
+import httpx
+import pytest
+from app.internal.config import LimiterConfig
+from app.internal.dify.client import get_chat_client
+from app.internal.dify.errors import UpstreamUnavailableError
+from app.internal.dify.limiter import AdaptiveLimiter, get_limiter
+
+
+def test_calls_over_the_limit_are_shed():
+    limiter = AdaptiveLimiter("app", LimiterConfig(initial_limit=2))
+    limiter.acquire()
+    limiter.acquire()
+    with pytest.raises(UpstreamUnavailableError):
+        limiter.acquire()
+    assert limiter.shed == 1
+    limiter.release()
+    limiter.acquire()
+
+
+def test_failures_back_off_down_to_the_minimum():
+    limiter = AdaptiveLimiter("app", LimiterConfig(initial_limit=10, min_limit=5, backoff=0.5))
+    limiter.sample(None, failed=True)
+    assert limiter.limit == 5
+    limiter._last_decrease = 0
+    limiter.sample(None, failed=True)
+    assert limiter.limit == 5
+
+
+def test_a_burst_of_slow_responses_decreases_once():
+    limiter = AdaptiveLimiter("app", LimiterConfig(initial_limit=10, backoff=0.5, latency_tolerance=2))
+    limiter.sample(0.1)
+    for _ in range(5):
+        limiter.sample(1.0)
+    assert limiter.decreases == 1
+    assert limiter.limit == 5
+
+
+def test_limit_grows_only_while_it_is_used():
+    limiter = AdaptiveLimiter("app", LimiterConfig(initial_limit=4))
+    for _ in range(10):
+        limiter.sample(0.1)
+    assert limiter.limit == 4
+    limiter.acquire()
+    limiter.acquire()
+    limiter.sample(0.1)
+    assert limiter.limit == 4.25
+
+
+def test_upstream_errors_lower_the_limit_of_the_client(configure, upstream):
+    configure(limiter={"initial_limit": 10, "backoff": 0.5}, breaker={"enabled": False})
+    upstream(lambda request: httpx.Response(500, json={"message": "boom"}))
+
+    async def scenario():
+        response = await get_chat_client("glossary").get_meta("u1")
+        await response.aclose()
+
+    asyncio.run(scenario())
+    limiter = get_limiter("glossary")
+    assert limiter.limit == 5
+    assert limiter.in_flight == 0
+
+
+def test_open_streams_hold_their_slot(configure, upstream):
+    configure(limiter={"initial_limit": 1, "min_limit": 1, "max_limit": 1})
+    upstream(lambda request: httpx.Response(200, stream=httpx.ByteStream(b"data: {}\n\n")))
+    client = get_chat_client("glossary")
+
+    async def scenario():
+        response = await client.create_chat_message({}, "hello", "u1")
+        with pytest.raises(UpstreamUnavailableError):
+            await client.create_chat_message({}, "again", "u1")
+        await response.aclose()
+        response = await client.create_chat_message({}, "again", "u1")
+        await response.aclose()
+
+    asyncio.run(scenario())
+    assert get_limiter("glossary").shed == 1
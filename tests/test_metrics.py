@@ -0,0 +1,36 @@
+import pytest
+from app.internal.metrics import Histogram, Metric, Registry, endpoint_label
+
+
+def test_metric_requires_samples():
+    with pytest.raises(TypeError):
+        Metric("untyped_metric", "no samples")
+
+
+def test_counter_and_histogram_exposition():
+    registry = Registry()
+    counter = registry.counter("requests_total", "Requests", ("status", ))
+    counter.inc("200")
+    counter.inc("200", amount=2)
+    histogram = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    histogram.observe(value=0.05)
+    histogram.observe(value=0.5)
+    histogram.observe(value=5)
+    lines = registry.render().splitlines()
+    assert 'requests_total{status="200"} 3' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert "latency_seconds_sum 5.55" in lines
+    assert "latency_seconds_count 3" in lines
+
+
+def test_registry_returns_the_existing_metric():
+    registry = Registry()
+    assert registry.histogram("h", "first") is registry.histogram("h", "second")
+    assert isinstance(registry.metrics["h"], Histogram)
+
+
+def test_endpoint_label_collapses_ids():
+    assert endpoint_label("/messages/3f2c9a1b-77aa/suggested") == "/messages/:id/suggested"
+    assert endpoint_label("/chat-messages") == "/chat-messages"
@@ -0,0 +1,37 @@
+import asyncio
+import pytest
+from app.internal.config import HttpConfig
+from app.internal.dify import pool
+
+
+@pytest.fixture
+def fresh_pool(monkeypatch, configure):
+    monkeypatch.setattr(pool, "_client", None)
+    monkeypatch.setattr(pool, "_transport", None)
+    yield
+    asyncio.run(pool.close_pool())
+
+
+def _swap_with_open_stream(http: HttpConfig, open_for: float) -> tuple[bool, bool]:
+    """Whether the old pool was closed while a stream was open on it, and once the swap finished retiring it."""
+
+    async def scenario():
+        old = pool.get_pool()
+        pool._transport.in_flight += 1
+        old_transport = pool._transport
+        await pool.swap_pool(http)
+        await asyncio.sleep(open_for)
+        closed_while_open = old.is_closed
+        old_transport.in_flight -= 1
+        await asyncio.gather(*pool._retiring)
+        return closed_while_open, old.is_closed
+
+    return asyncio.run(scenario())
+
+
+def test_reload_waits_for_streams_past_the_read_timeout(fresh_pool):
+    assert _swap_with_open_stream(HttpConfig(read_timeout=0.01, retire_timeout=30), open_for=0.1) == (False, True)
+
+
+def test_reload_closes_the_old_pool_after_retire_timeout(fresh_pool):
+    assert _swap_with_open_stream(HttpConfig(read_timeout=0.01, retire_timeout=0.01), open_for=0.6) == (True, True)
@@ -0,0 +1,124 @@
+import asyncio
+import httpx
+import pytest
+from app.internal.config import BreakerConfig
+from app.internal.dify import resilience
+from app.internal.dify.client import get_chat_client
+from app.internal.dify.errors import UpstreamUnavailableError
+from app.internal.dify.resilience import CircuitBreaker, CLOSED, HALF_OPEN, OPEN, resilient
+
+
+def _sender(*outcomes):
+    """A ``send`` returning or raising ``outcomes`` in turn, counting its calls."""
+    calls = []
+
+    async def send():
+        outcome = outcomes[len(calls)]
+        calls.append(outcome)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return httpx.Response(outcome, headers={"retry-after": "60"} if outcome == 429 else None)
+
+    return send, calls
+
+
+@pytest.fixture
+def no_backoff(configure):
+    configure(retry={"backoff_base": 0})
+
+
+def test_retryable_statuses_are_retried(no_backoff):
+    send, calls = _sender(503, 502, 200)
+    response = asyncio.run(resilient("app", "GET", "/messages", send))
+    assert response.status_code == 200
+    assert len(calls) == 3
+
+
+def test_buffered_posts_are_not_retried_after_sending(no_backoff):
+    send, calls = _sender(httpx.ReadError("reset"), 200)
+    with pytest.raises(httpx.ReadError):
+        asyncio.run(resilient("app", "POST", "/feedbacks", send))
+    send, calls = _sender(httpx.ConnectError("refused"), 200)
+    assert asyncio.run(resilient("app", "POST", "/feedbacks", send)).status_code == 200
+
+
+def test_posts_are_retried_only_on_statuses_that_were_not_run(no_backoff):
+    send, calls = _sender(502, 200)
+    assert asyncio.run(resilient("app", "POST", "/chat-messages", send, stream=True)).status_code == 502
+    assert len(calls) == 1
+    send, calls = _sender(504, 200)
+    assert asyncio.run(resilient("app", "POST", "/workflows/run", send)).status_code == 504
+    assert len(calls) == 1
+    send, calls = _sender(503, 200)
+    assert asyncio.run(resilient("app", "POST", "/chat-messages", send)).status_code == 200
+    assert len(calls) == 2
+
+
+def test_long_retry_after_is_not_waited_for(no_backoff):
+    send, calls = _sender(429, 200)
+    assert asyncio.run(resilient("app", "GET", "/messages", send)).status_code == 429
+    assert len(calls) == 1
+
+
+def test_failing_endpoint_opens_its_circuit(configure):
+    configure(retry={"retries": 0}, breaker={"failures": 2})
+    send, calls = _sender(500, 500, 200)
+    asyncio.run(resilient("app", "GET", "/messages", send))
+    asyncio.run(resilient("app", "GET", "/messages", send))
+    with pytest.raises(UpstreamUnavailableError, match="circuit open"):
+        asyncio.run(resilient("app", "GET", "/messages", send))
+    assert len(calls) == 2
+    # 其他接口不受影响
+    assert asyncio.run(resilient("app", "GET", "/conversations", send)).status_code == 200
+
+
+def _opened(monkeypatch) -> CircuitBreaker:
+    breaker = CircuitBreaker("app", "GET", "/messages", BreakerConfig(failures=1, open_seconds=30))
+    breaker.before()
+    breaker.record(False)
+    assert breaker.state == OPEN
+    clock = resilience.time.monotonic() + 31
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: clock)
+    return breaker
+
+
+def test_half_open_lets_one_probe_through(monkeypatch):
+    breaker = _opened(monkeypatch)
+    breaker.before()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(UpstreamUnavailableError, match="half open"):
+        breaker.before()
+    breaker.record(True)
+    assert breaker.state == CLOSED
+    breaker.before()
+
+
+def test_failed_probe_opens_again(monkeypatch):
+    breaker = _opened(monkeypatch)
+    breaker.before()
+    breaker.record(False)
+    assert breaker.state == OPEN
+    with pytest.raises(UpstreamUnavailableError, match="circuit open"):
+        breaker.before()
+
+
+def test_cancelled_probe_is_given_back(monkeypatch):
+    breaker = _opened(monkeypatch)
+    breaker.before()
+    breaker.cancel()
+    breaker.before()
+    assert breaker.state == HALF_OPEN
+
+
+def test_client_retries_through_a_fresh_attempt(no_backoff, upstream):
+    statuses = [503, 200]
+    upstream(lambda request: httpx.Response(statuses.pop(0), json={"data": []}))
+
+    async def scenario():
+        response = await get_chat_client("glossary").get_meta("u1")
+        await response.aread()
+        await response.aclose()
+        return response
+
+    assert asyncio.run(scenario()).status_code == 200
+    assert statuses == []
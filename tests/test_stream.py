@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import httpx
+import pytest
+from app.internal.dify.models.chat import decoder
+from app.internal.dify.models.workflow import decoder as workflow_decoder, TextChunkEvent
+from app.internal.dify.stream import SSERelay, iter_events
+from app.internal.logging import logger
+
+
+class CountingStream(httpx.AsyncByteStream):
+
+    def __init__(self, chunks: list[bytes]):
+        self.chunks = chunks
+        self.read = 0
+        self.closed = False
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+    async def aclose(self):
+        self.closed = True
+
+
+def _frames(count: int) -> list[bytes]:
+    return [f'data: {{"event": "message", "answer": "{i}"}}\n\n'.encode() for i in range(count)]
+
+
+def test_relay_reads_upstream_only_as_fast_as_downstream_consumes():
+    upstream = CountingStream(_frames(100))
+    relay = SSERelay(httpx.Response(200, stream=upstream), name="test")
+
+    async def consume():
+        frames = relay.__aiter__()
+        first = await anext(frames)
+        read_after_first = upstream.read
+        await frames.aclose()
+        return first, read_after_first
+
+    first, read_after_first = asyncio.run(consume())
+    assert first == b'data: {"event": "message", "answer": "0"}\n\n'
+    assert read_after_first <= 2
+    assert upstream.closed
+
+
+def test_raw_relay_forwards_bytes_and_dispatches_split_frames():
+    body = b"".join(_frames(3))
+    upstream = CountingStream([body[:10], body[10:50], body[50:]])
+    seen = []
+    relay = SSERelay(httpx.Response(200, stream=upstream),
+                     raw=True,
+                     decoder=decoder,
+                     handlers={"message": lambda event: seen.append(event.payload["answer"])})
+
+    async def consume():
+        return b"".join([chunk async for chunk in relay])
+
+    assert asyncio.run(consume()) == body
+    assert seen == ["0", "1", "2"]
+    assert relay.stats.events == 3
+    assert upstream.closed
+
+
+def test_iter_events_skips_events_it_does_not_know():
+    body = (b'data: {"event": "workflow_paused", "task_id": "t"}\n\n'
+            b'data: {"event": "ping"}\n\n'
+            b'data: {"event": "text_chunk", "task_id": "t", "data": {"text": "hi"}}\n\n')
+    upstream = CountingStream([body])
+
+    async def consume():
+        return [event async for event in iter_events(httpx.Response(200, stream=upstream), workflow_decoder)]
+
+    events = asyncio.run(consume())
+    assert [type(event) for event in events] == [TextChunkEvent]
+    assert events[0].data.text == "hi"
+    assert upstream.closed
+
+
+@pytest.mark.parametrize("log_sample, logged", [(1, [1, 2, 3, 4, 5]), (2, [1, 3, 5]), (10, [1])])
+def test_every_nth_event_is_logged(caplog, log_sample, logged):
+    caplog.set_level(logging.DEBUG, logger=logger.name)
+    relay = SSERelay(httpx.Response(200, stream=CountingStream(_frames(5))), name="test", log_sample=log_sample)
+
+    async def consume():
+        return [frame async for frame in relay]
+
+    asyncio.run(consume())
+    assert [record.args[1] for record in caplog.records if record.msg.startswith("stream %s event")] == logged
+
+
+def test_raw_relay_logs_chunks_holding_a_sampled_event(caplog):
+    caplog.set_level(logging.DEBUG, logger=logger.name)
+    body = b"".join(_frames(4))
+    chunks = [body[:10], body[10:], b""]
+    relay = SSERelay(httpx.Response(200, stream=CountingStream(chunks)), name="test", raw=True, log_sample=1)
+
+    async def consume():
+        return [chunk async for chunk in relay]
+
+    asyncio.run(consume())
+    # 第一片里还没有完整的事件，第二片包含了全部四个
+    assert len([record for record in caplog.records if record.msg.startswith("stream %s chunk")]) == 1
@@ -0,0 +1,46 @@
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+
+_FILE_META = {
+    "id": "f1",
+    "name": "notes.xyz",
+    "size": 5,
+    "extension": "xyz",
+    "mime_type": "application/octet-stream",
+    "created_by": "u",
+    "created_at": 0,
+}
+
+
+@pytest.fixture
+def uploads(upstream):
+    received = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        received.append(request.read())
+        return httpx.Response(200, json=_FILE_META)
+
+    upstream(handler)
+    return received
+
+
+def test_unknown_file_types_are_forwarded(uploads):
+    response = TestClient(app).post("/glossary/upload", files={"file": ("notes.xyz", b"hello")})
+    assert response.status_code == 200
+    assert b"hello" in uploads[0]
+    assert b'filename="notes.xyz"' in uploads[0]
+
+
+def test_unknown_file_types_use_the_default_limit(configure, uploads):
+    configure(upload={"default_mb": 0.001})
+    response = TestClient(app).post("/glossary/upload", files={"file": ("notes.xyz", b"x" * 2048)})
+    assert response.status_code == 413
+    assert uploads == []
+
+
+def test_known_file_types_use_their_own_limit(configure, uploads):
+    configure(upload={"limits_mb": {"document": 0.001}, "default_mb": None})
+    assert TestClient(app).post("/glossary/upload", files={"file": ("a.txt", b"x" * 2048)}).status_code == 413
+    assert TestClient(app).post("/glossary/upload", files={"file": ("a.xyz", b"x" * 2048)}).status_code == 200
@@ -0,0 +1,80 @@
+import asyncio
+import threading
+from app.internal.usage import UsageLedger
+
+_USAGE = {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15, "total_price": "0.01", "currency": "USD"}
+
+
+def _totals(ledger: UsageLedger) -> dict:
+    return {
+        (row["client"], row["user"]): (row["requests"], row["total_tokens"], row["total_price"])
+        for row in ledger.report()
+    }
+
+
+def test_workers_sharing_a_ledger_report_the_same_totals(tmp_path):
+    path = str(tmp_path / "usage.jsonl")
+    first, second = UsageLedger(path), UsageLedger(path)
+    first.record("glossary", "u1", "chat", _USAGE)
+    second.record("glossary", "u1", "chat", _USAGE)
+    second.record("glossary", "u2", "chat", _USAGE)
+
+    async def flush():
+        await first.flush()
+        await second.flush()
+
+    asyncio.run(flush())
+    first.refresh()
+    second.refresh()
+    expected = {("glossary", "u1"): (2, 30, "0.02"), ("glossary", "u2"): (1, 15, "0.01")}
+    assert _totals(first) == expected
+    assert _totals(second) == expected
+    # 再次 refresh 只读新增的部分，不会重复累计
+    first.refresh()
+    assert _totals(first) == expected
+
+
+def test_unflushed_usage_is_reported_by_its_own_worker(tmp_path):
+    ledger = UsageLedger(str(tmp_path / "usage.jsonl"))
+    ledger.record("glossary", "u1", "chat", _USAGE)
+    ledger.refresh()
+    assert _totals(ledger) == {("glossary", "u1"): (1, 15, "0.01")}
+
+
+def test_restart_loads_the_flushed_usage(tmp_path):
+    path = str(tmp_path / "usage.jsonl")
+    ledger = UsageLedger(path)
+    ledger.record("glossary", "u1", "chat", _USAGE)
+    asyncio.run(ledger.flush())
+    restarted = UsageLedger(path)
+    restarted.refresh()
+    assert _totals(restarted) == {("glossary", "u1"): (1, 15, "0.01")}
+
+
+def test_concurrent_refreshes_count_every_record_once(tmp_path, monkeypatch):
+    path = str(tmp_path / "usage.jsonl")
+    writer, reader = UsageLedger(path), UsageLedger(path)
+    writer.record("glossary", "u1", "chat", _USAGE)
+    asyncio.run(writer.flush())
+    read, refreshed = threading.Event(), threading.Event()
+    read_new = reader.log.read_new
+
+    def slow_read_new():
+        result = read_new()
+        if not read.is_set():
+            # 第一次 refresh 读完后停住，等第二次 refresh 做完
+            read.set()
+            refreshed.wait(0.2)
+        return result
+
+    monkeypatch.setattr(reader.log, "read_new", slow_read_new)
+    first = threading.Thread(target=reader.refresh)
+    first.start()
+    read.wait(1)
+    writer.record("glossary", "u1", "chat", _USAGE)
+    asyncio.run(writer.flush())
+    second = threading.Thread(target=lambda: (reader.refresh(), refreshed.set()))
+    second.start()
+    first.join()
+    second.join()
+    assert _totals(reader) == {("glossary", "u1"): (2, 30, "0.02")}